@@ -0,0 +1,232 @@
+import base64
+import json
+import threading
+import time
+from collections import deque
+from email.utils import format_datetime
+from typing import Any, Callable, Optional
+import httplib2
+from googleapiclient.errors import HttpError
+from src.gmail.rate_limiter import quota_units
+
+
+def make_message(message_id, subject='Subject', sender='sender@example.com', recipient='me@example.com',
+                 body='Body', received_date=None):
+    headers = [
+        {'name': 'Subject', 'value': subject},
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': recipient},
+        {'name': 'Date', 'value': format_datetime(received_date) if received_date else 'Mon, 1 Jan 2024 10:00:00 +0000'},
+    ]
+    data = base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')
+    return {
+        'id': message_id,
+        'payload': {'mimeType': 'text/plain', 'headers': headers, 'body': {'data': data}},
+    }
+
+
+def http_error(status, reason=None, retry_after=None):
+    headers = {'status': status}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    errors = [{'reason': reason}] if reason else []
+    content = json.dumps({'error': {'message': 'fake error', 'errors': errors}}).encode('utf-8')
+    return HttpError(httplib2.Response(headers), content)
+
+
+class FakeRequest:
+    def __init__(self, api, handler):
+        self.api = api
+        self.handler = handler
+
+    def execute(self, http=None):
+        self.api.round_trip()
+        return self.handler()
+
+
+class FakeBatchRequest:
+    def __init__(self, api, callback):
+        self.api = api
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        self.api.round_trip(len(self.requests))
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.handler(), None
+            except HttpError as error:
+                response, exception = None, error
+            callback(request_id, response, exception)
+
+
+class FakeHistoryResource:
+    def __init__(self, api):
+        self.api = api
+
+    def list(self, userId, startHistoryId, historyTypes=None, maxResults=100, pageToken=None, labelId=None):
+        def handler():
+            if int(startHistoryId) < self.api.oldest_history_id:
+                raise http_error(404)
+            records = [record for record in self.api.history_records if int(record['id']) > int(startHistoryId)
+                       and (labelId is None or labelId in record['messagesAdded'][0]['message']['labelIds'])]
+            start = int(pageToken or 0)
+            response = {'history': records[start:start + maxResults], 'historyId': str(self.api.history_id)}
+            if start + maxResults < len(records):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeRequest(self.api, handler)
+
+
+class FakeGmailApi:
+    # In-process stand-in for the discovery-built Gmail client, shared by the tests
+    # and the benchmarks. Every HTTP round trip (single request or whole batch)
+    # sleeps for `latency` seconds.
+    def __init__(self, messages, latency=0.0, failures=None, history_id=100, oldest_history_id=1,
+                 modify_failures=None):
+        self.store = {message['id']: message for message in messages}
+        self.history_id = history_id
+        self.oldest_history_id = oldest_history_id
+        self.history_records = []
+        self.latency = latency
+        self.failures = {message_id: list(statuses) for message_id, statuses in (failures or {}).items()}
+        self.modify_failures = list(modify_failures or [])
+        self.http_calls = 0
+        self.batch_sizes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.modifications = []
+        self.gets = []
+        self._lock = threading.Lock()
+
+    def round_trip(self, batch_size=None):
+        with self._lock:
+            self.http_calls += 1
+            if batch_size is not None:
+                self.batch_sizes.append(batch_size)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def add_message(self, message, label_ids=('INBOX',)):
+        self.store[message['id']] = message
+        self.history_id += 1
+        added = {'id': message['id'], 'labelIds': list(label_ids)}
+        self.history_records.append({'id': str(self.history_id), 'messagesAdded': [{'message': added}]})
+
+    def users(self):
+        return self
+
+    def history(self):
+        return FakeHistoryResource(self)
+
+    def getProfile(self, userId):
+        return FakeRequest(self, lambda: {'historyId': str(self.history_id)})
+
+    def messages(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+    def list(self, userId, maxResults=100, pageToken=None, q=None):
+        # A query only matches as a substring of the subject here.
+        def handler():
+            ids = [message_id for message_id, message in self.store.items() if not q or q.lower() in next(
+                (header['value'].lower() for header in message['payload']['headers'] if header['name'] == 'Subject'), '')]
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            response = {'messages': [{'id': message_id} for message_id in page]}
+            if start + maxResults < len(ids):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeRequest(self, handler)
+
+    def batchModify(self, userId, body):
+        def handler():
+            with self._lock:
+                error = self.modify_failures.pop(0) if self.modify_failures else None
+            if error is not None:
+                raise error if isinstance(error, HttpError) else http_error(error)
+            with self._lock:
+                self.modifications.append(body)
+            return {}
+        return FakeRequest(self, handler)
+
+    def get(self, userId, id, **kwargs):
+        def handler():
+            with self._lock:
+                statuses = self.failures.get(id)
+                status = statuses.pop(0) if statuses else None
+            if status:
+                raise http_error(status)
+            if id not in self.store:
+                raise http_error(404)
+            message = self.store[id]
+            with self._lock:
+                self.gets.append((id, kwargs.get('format', 'full')))
+            if kwargs.get('format') == 'metadata':
+                wanted = {name.lower() for name in kwargs.get('metadataHeaders', [])}
+                headers = [header for header in message['payload']['headers'] if header['name'].lower() in wanted]
+                return {'id': id, 'payload': {'mimeType': message['payload']['mimeType'], 'headers': headers}}
+            return message
+        return FakeRequest(self, handler)
+
+
+class QuotaGmailApi(FakeGmailApi):
+    # FakeGmailApi with per-user quota enforcement: every request (including each
+    # request inside a batch) is charged its quota units against a sliding one
+    # second window, and requests over `units_per_second` fail with a rate-limit 429
+    # like the real API does.
+    def __init__(self, messages, latency: float = 0.0, units_per_second: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic, **kwargs: Any):
+        super().__init__(messages, latency=latency, **kwargs)
+        self.units_per_second = units_per_second
+        self.clock = clock
+        self.units_charged = 0
+        self.rejected = 0
+        self._window = deque()
+        self._window_units = 0
+        self._quota_lock = threading.Lock()
+
+    def charge(self, method: str) -> None:
+        units = quota_units(method)
+        with self._quota_lock:
+            now = self.clock()
+            while self._window and self._window[0][0] <= now - 1.0:
+                self._window_units -= self._window.popleft()[1]
+            if self.units_per_second is not None and self._window_units + units > self.units_per_second:
+                self.rejected += 1
+                raise http_error(429, reason='userRateLimitExceeded')
+            self._window.append((now, units))
+            self._window_units += units
+            self.units_charged += units
+
+    def _charged(self, method: str, request: Any) -> Any:
+        handler = request.handler
+
+        def charged_handler():
+            self.charge(method)
+            return handler()
+        request.handler = charged_handler
+        return request
+
+    def get(self, userId, id, **kwargs):
+        return self._charged('messages.get', super().get(userId, id, **kwargs))
+
+    def list(self, userId, maxResults=100, pageToken=None, q=None):
+        return self._charged('messages.list', super().list(userId, maxResults, pageToken, q))
+
+    def batchModify(self, userId, body):
+        return self._charged('messages.batchModify', super().batchModify(userId, body))
+
+    def getProfile(self, userId):
+        return self._charged('getProfile', super().getProfile(userId))
@@ -0,0 +1,253 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from benchmarks.fake_gmail import QuotaGmailApi
+from benchmarks.synthetic import MailboxGenerator, generate_rules
+from src.data.fulltext import create_fulltext_index
+from src.data.models import Base, Email
+from src.data.record import EmailRecord
+from src.data.repository import EmailRepository
+from src.gmail.gmail_service import GmailService
+from src.gmail.rate_limiter import TokenBucket
+from src.main import parse_args, run_pipeline, run_sync
+from src.rules.action_planner import ActionPlanner
+from src.rules.needle_index import AhoCorasick
+from src.rules.rule_processor import RuleMatcher, RuleProcessor
+
+Result = Dict[str, Any]
+
+
+def result(name: str, items: int, seconds: float, **extra: Any) -> Result:
+    return dict({
+        'benchmark': name,
+        'items': items,
+        'seconds': round(seconds, 4),
+        'per_second': round(items / seconds, 1) if seconds else 0.0,
+    }, **extra)
+
+
+def timed(func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def session_factory(directory: str, fulltext_mode: str = 'off'):
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine), create_fulltext_index(engine, fulltext_mode)
+
+
+def bench_matching(emails: List[Any], rule_counts: List[int], senders: List[str], seed: int) -> List[Result]:
+    results = []
+    for count in rule_counts:
+        rules = generate_rules(count, seed, senders)
+        matcher = None
+
+        def compile_rules():
+            nonlocal matcher
+            matcher = RuleMatcher(rules)
+        compile_seconds = timed(compile_rules)
+        matches = 0
+
+        def match_each():
+            nonlocal matches
+            for email in emails:
+                matches += len(matcher.match(email))
+        seconds = timed(match_each)
+        results.append(result(f'match[{count} rules]', len(emails), seconds,
+                              compile_seconds=round(compile_seconds, 4), matches=matches))
+        seconds = timed(lambda: matcher.match_batch(emails))
+        results.append(result(f'match_batch[{count} rules]', len(emails), seconds))
+    return results
+
+
+def bench_parsing(messages: List[Dict[str, Any]]) -> List[Result]:
+    gmail_service = GmailService(None)
+    results = []
+    for message_format in (GmailService.FORMAT_FULL, GmailService.FORMAT_METADATA):
+        seconds = timed(lambda: [
+            gmail_service.parse_message(message['id'], message, message_format) for message in messages
+        ])
+        results.append(result(f'parse[{message_format}]', len(messages), seconds))
+    return results
+
+
+def bench_persistence(emails: List[Any], batch_size: int, fulltext_mode: str) -> List[Result]:
+    with tempfile.TemporaryDirectory() as directory:
+        Session, fulltext = session_factory(directory, fulltext_mode)
+        session = Session()
+        email_repo = EmailRepository(session, fulltext)
+
+        def persist():
+            for start in range(0, len(emails), batch_size):
+                email_repo.add_new_emails([copy_email(email) for email in emails[start:start + batch_size]])
+        seconds = timed(persist)
+        session.close()
+    return [result(f'persist[fulltext={fulltext_mode}]', len(emails), seconds)]
+
+
+def copy_email(email: Any) -> Any:
+    return type(email).create(email.message_id, email.sender, email.recipient, email.subject, email.body,
+                              email.received_date)
+
+
+def bench_records(count: int, rule_count: int, seed: int) -> List[Result]:
+    # The same parsed batch held as ORM instances and as EmailRecords: memory taken by
+    # the objects themselves (both share the field strings) and matching throughput.
+    generator = MailboxGenerator(seed=seed, body_size_median=200)
+    parser = GmailService(None)
+    fields = [
+        (email.message_id, email.sender, email.recipient, email.subject, email.body, email.received_date)
+        for email in (parser.parse_message(message['id'], message) for message in generator.messages(count))
+    ]
+    matcher = RuleMatcher(generate_rules(rule_count, seed, generator.senders))
+    results = []
+    for name, build in (('orm', Email.create), ('record', EmailRecord.create)):
+        tracemalloc.start()
+        emails = [build(*values) for values in fields]
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        seconds = timed(lambda: [matcher.match(email) for email in emails])
+        results.append(result(f'match_{name}[{count} emails]', count, seconds, bytes_per_email=round(memory / count)))
+        del emails
+    return results
+
+
+def bench_needles(needle_counts: List[int], text_size: int, seed: int) -> List[Result]:
+    # Scans one lower-cased body for N `contains` needles with the automaton and with
+    # one `in` per needle; the crossover sets AUTOMATON_MIN_NEEDLES.
+    generator = MailboxGenerator(seed=seed)
+    text = ''
+    for message in generator.messages(1000):
+        text += GmailService(None).parse_message(message['id'], message).body.lower()
+        if len(text) >= text_size:
+            break
+    text = text[:text_size]
+    words = sorted({word for word in text.split() if len(word) > 3})
+    results = []
+    for count in needle_counts:
+        # Mostly absent needles, as in real rule sets.
+        needles = [f'{words[index % len(words)]}-{index}' for index in range(count)]
+        automaton = AhoCorasick((needle, index) for index, needle in enumerate(needles))
+        repeats = 5
+        seconds = timed(lambda: [automaton.search(text) for _ in range(repeats)])
+        results.append(result(f'needles_automaton[{count}]', repeats, seconds))
+        seconds = timed(lambda: [[needle for needle in needles if needle in text] for _ in range(repeats)])
+        results.append(result(f'needles_in[{count}]', repeats, seconds))
+    return results
+
+
+def bench_end_to_end(messages: List[Dict[str, Any]], rules: List[Dict[str, Any]], latency: float,
+                     quota: Optional[float], concurrency: int, pipeline: bool) -> List[Result]:
+    api = QuotaGmailApi(messages, latency=latency, units_per_second=quota)
+    # The fake accepts any per-thread transport; a factory is what enables concurrent batches.
+    gmail_service = GmailService(api, concurrency=concurrency, backoff_base=0.05, http_factory=object,
+                                 rate_limiter=TokenBucket(quota) if quota else None)
+    action_planner = ActionPlanner(gmail_service)
+    rule_processor = RuleProcessor(RuleMatcher(rules), action_planner)
+    args = parse_args(['--all'] + (['--pipeline'] if pipeline else []))
+    with tempfile.TemporaryDirectory() as directory:
+        Session, fulltext = session_factory(directory)
+        if pipeline:
+            seconds = timed(lambda: run_pipeline(args, Session, fulltext, gmail_service, rule_processor))
+        else:
+            seconds = timed(lambda: run_sync(args, Session, fulltext, gmail_service, rule_processor))
+    name = 'end_to_end[pipeline]' if pipeline else 'end_to_end[sync]'
+    return [result(name, len(messages), seconds, http_calls=api.http_calls, quota_units=api.units_charged,
+                   rejected=api.rejected, modifications=len(api.modifications))]
+
+
+def compare(results: List[Result], baseline: List[Result], tolerance: float) -> List[str]:
+    previous = {entry['benchmark']: entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        before = previous.get(entry['benchmark'])
+        if before and before['per_second'] and entry['per_second'] < before['per_second'] * (1 - tolerance):
+            regressions.append(f"{entry['benchmark']}: {entry['per_second']}/s vs {before['per_second']}/s")
+    return regressions
+
+
+def print_table(results: List[Result]) -> None:
+    print(f"{'benchmark':<32} {'items':>8} {'seconds':>10} {'items/s':>12}  details")
+    for entry in results:
+        details = ', '.join(f'{key}={value}' for key, value in entry.items()
+                            if key not in ('benchmark', 'items', 'seconds', 'per_second'))
+        print(f"{entry['benchmark']:<32} {entry['items']:>8} {entry['seconds']:>10.3f} {entry['per_second']:>12.1f}  {details}")
+
+
+def parse_counts(spec: str) -> List[int]:
+    return [int(count) for count in spec.split(',') if count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure throughput of matching, parsing, persistence and full syncs.")
+    parser.add_argument('--emails', type=int, default=5000, help="synthetic messages to generate")
+    parser.add_argument('--match-emails', type=int, default=2000, help="messages matched per rule set size")
+    parser.add_argument('--rules', type=parse_counts, default=[10, 100, 1000, 10000], help="comma-separated rule set sizes")
+    parser.add_argument('--e2e-emails', type=int, default=1000, help="messages in the fake mailbox for end-to-end runs")
+    parser.add_argument('--e2e-rules', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds per fake HTTP round trip")
+    parser.add_argument('--quota', type=float, default=None, help="fake per-user quota units per second")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--record-emails', type=int, default=100000, help="batch size for the ORM vs record comparison")
+    parser.add_argument('--needles', type=parse_counts, default=[16, 64, 128, 256, 512, 1024],
+                        help="comma-separated needle counts for the automaton vs `in` comparison")
+    parser.add_argument('--needle-text', type=int, default=50000, help="characters of body scanned per needle count")
+    parser.add_argument('--batch-size', type=int, default=500, help="emails per persistence batch")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', default='', help="comma-separated subset of match,parse,persist,records,needles,e2e")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="earlier --json output to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed throughput drop against the baseline")
+    args = parser.parse_args(argv)
+    logging.getLogger('src').setLevel(logging.WARNING)
+
+    selected = set(filter(None, args.only.split(','))) or {'match', 'parse', 'persist', 'records', 'needles', 'e2e'}
+    generator = MailboxGenerator(seed=args.seed)
+    messages = list(generator.messages(max(args.emails, args.e2e_emails)))
+    parser_service = GmailService(None)
+    emails = [parser_service.parse_message(message['id'], message) for message in messages[:args.emails]]
+
+    results: List[Result] = []
+    if 'match' in selected:
+        results += bench_matching(emails[:args.match_emails], args.rules, generator.senders, args.seed)
+    if 'parse' in selected:
+        results += bench_parsing(messages[:args.emails])
+    if 'persist' in selected:
+        for fulltext_mode in ('off', 'auto'):
+            results += bench_persistence(emails, args.batch_size, fulltext_mode)
+    if 'records' in selected:
+        results += bench_records(args.record_emails, args.e2e_rules, args.seed)
+    if 'needles' in selected:
+        results += bench_needles(args.needles, args.needle_text, args.seed)
+    if 'e2e' in selected:
+        rules = generate_rules(args.e2e_rules, args.seed, generator.senders)
+        for pipeline in (False, True):
+            results += bench_end_to_end(messages[:args.e2e_emails], rules, args.latency, args.quota,
+                                        args.concurrency, pipeline)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
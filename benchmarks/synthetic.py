@@ -0,0 +1,128 @@
+import base64
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import Any, Dict, Iterator, List, Sequence
+
+WORDS = (
+    'account', 'alert', 'invoice', 'receipt', 'meeting', 'update', 'report', 'weekly', 'offer', 'sale',
+    'order', 'shipping', 'delivery', 'password', 'security', 'newsletter', 'project', 'review', 'team',
+    'lunch', 'travel', 'booking', 'ticket', 'payment', 'reminder', 'urgent', 'free', 'discount', 'release',
+    'build', 'deploy', 'incident', 'welcome', 'survey', 'feedback', 'schedule', 'agenda', 'contract',
+    'statement', 'subscription', 'renewal', 'trial', 'webinar', 'event', 'photo', 'family', 'weekend',
+)
+DOMAINS = (
+    'example.com', 'mail.example.org', 'shop.example.net', 'news.example.io', 'bank.example.co',
+    'travel.example.com', 'dev.example.org', 'spammer.com', 'promo.example.biz', 'social.example.app',
+)
+CONDITION_KINDS = ('sender', 'sender_domain', 'subject', 'body', 'recipient', 'received_date')
+ACTION_TYPES = ('MARK_AS_READ', 'MARK_AS_UNREAD', 'MOVE_TO_INBOX', 'MOVE_TO_SPAM', 'MOVE_TO_TRASH')
+
+
+def encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+class MailboxGenerator:
+    # Deterministic for a given seed. Senders follow a Zipf-like popularity curve,
+    # body sizes are log-normal around `body_size_median` bytes, and a share of the
+    # messages are multipart/alternative (plain + HTML), optionally wrapped in a
+    # multipart/mixed with an attachment part.
+    def __init__(self, seed: int = 0, sender_pool: int = 500, body_size_median: int = 2000,
+                 body_size_sigma: float = 1.0, max_body_size: int = 200000, multipart_ratio: float = 0.6,
+                 attachment_ratio: float = 0.1, html_only_ratio: float = 0.05, days: int = 365,
+                 now: datetime = datetime(2024, 6, 1, tzinfo=timezone.utc)):
+        self.random = random.Random(seed)
+        self.senders = [
+            f"{self.random.choice(WORDS)}{index}@{DOMAINS[index % len(DOMAINS)]}" for index in range(sender_pool)
+        ]
+        self.sender_weights = [1.0 / (rank + 1) for rank in range(sender_pool)]
+        self.body_size_median = body_size_median
+        self.body_size_sigma = body_size_sigma
+        self.max_body_size = max_body_size
+        self.multipart_ratio = multipart_ratio
+        self.attachment_ratio = attachment_ratio
+        self.html_only_ratio = html_only_ratio
+        self.days = days
+        self.now = now
+
+    def text(self, size: int) -> str:
+        words = []
+        length = 0
+        while length < size:
+            word = self.random.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)
+
+    def body_size(self) -> int:
+        size = int(self.random.lognormvariate(0, self.body_size_sigma) * self.body_size_median)
+        return max(1, min(size, self.max_body_size))
+
+    def message(self, index: int) -> Dict[str, Any]:
+        received = self.now - timedelta(seconds=self.random.randrange(self.days * 86400))
+        headers = [
+            {'name': 'Subject', 'value': self.text(self.random.randint(10, 60)).capitalize()},
+            {'name': 'From', 'value': self.random.choices(self.senders, self.sender_weights)[0]},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Date', 'value': format_datetime(received)},
+        ]
+        body = self.text(self.body_size())
+        roll = self.random.random()
+        if roll < self.html_only_ratio:
+            payload = self._part('text/html', f"<html><body><p>{body}</p></body></html>")
+        elif roll < self.html_only_ratio + self.multipart_ratio:
+            payload = {'mimeType': 'multipart/alternative', 'parts': [
+                self._part('text/plain', body),
+                self._part('text/html', f"<html><body><div>{body}</div></body></html>"),
+            ]}
+            if self.random.random() < self.attachment_ratio:
+                attachment = {'mimeType': 'application/pdf', 'filename': f'file{index}.pdf',
+                              'headers': [], 'body': {'attachmentId': f'att{index}', 'size': 1024}}
+                payload = {'mimeType': 'multipart/mixed', 'parts': [payload, attachment]}
+        else:
+            payload = self._part('text/plain', body)
+        payload['headers'] = headers + payload.get('headers', [])
+        return {'id': f'm{index:08d}', 'historyId': str(index + 1), 'payload': payload}
+
+    @staticmethod
+    def _part(mime_type: str, text: str) -> Dict[str, Any]:
+        return {
+            'mimeType': mime_type,
+            'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}],
+            'body': {'data': encode(text), 'size': len(text)},
+        }
+
+    def messages(self, count: int) -> Iterator[Dict[str, Any]]:
+        for index in range(count):
+            yield self.message(index)
+
+
+def generate_rules(count: int, seed: int = 0, senders: Sequence[str] = ()) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    rules = []
+    for index in range(count):
+        conditions = [_condition(rng, rng.choice(CONDITION_KINDS), senders) for _ in range(rng.randint(1, 3))]
+        rules.append({
+            'name': f'Rule {index}',
+            'predicate': rng.choice(('ALL', 'ANY')),
+            'conditions': conditions,
+            'actions': [{'type': rng.choice(ACTION_TYPES)}],
+        })
+    return rules
+
+
+def _condition(rng: random.Random, kind: str, senders: Sequence[str]) -> Dict[str, str]:
+    if kind == 'sender':
+        value = rng.choice(senders) if senders else f"{rng.choice(WORDS)}@{rng.choice(DOMAINS)}"
+        return {'field': 'sender', 'predicate': rng.choice(('equals', 'contains')), 'value': value}
+    if kind == 'sender_domain':
+        return {'field': 'sender', 'predicate': 'contains', 'value': '@' + rng.choice(DOMAINS)}
+    if kind == 'received_date':
+        return {'field': 'received_date', 'predicate': rng.choice(('greater_than', 'less_than')),
+                'value': f"{rng.randint(1, 365)} days"}
+    predicate = rng.choice(('contains', 'contains', 'contains', 'does_not_contain', 'equals'))
+    # Two-word needles keep most contains conditions selective, as real rules are.
+    value = rng.choice(WORDS) if predicate == 'equals' else f"{rng.choice(WORDS)} {rng.choice(WORDS)}"
+    return {'field': kind, 'predicate': predicate, 'value': value}
@@ -8,8 +8,33 @@ class Config:
         self._config = {
             'SCOPES': ['https://www.googleapis.com/auth/gmail.modify'],
             'DATABASE_URI': os.environ.get('DATABASE_URI', 'sqlite:///emails.db'),
+            'FULLTEXT_INDEX': os.environ.get('FULLTEXT_INDEX', 'auto'),
             'RULES_FILE': os.environ.get('RULES_FILE', 'config/rules.json'),
+            'RULES_CACHE_DIR': os.environ.get('RULES_CACHE_DIR', os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'gmail_rules_processor', 'rules')),
+            'RULES_POLL_SECONDS': float(os.environ.get('RULES_POLL_SECONDS', 2)),
+            'DAEMON_INTERVAL': float(os.environ.get('DAEMON_INTERVAL', 60)),
             'MAX_EMAILS': int(os.environ.get('MAX_EMAILS', 10)),
+            'GMAIL_QUERY': os.environ.get('GMAIL_QUERY'),
+            'HISTORY_LABEL': os.environ.get('HISTORY_LABEL', 'INBOX'),
+            'PAGE_SIZE': int(os.environ.get('PAGE_SIZE', 100)),
+            'FETCH_BODIES': os.environ.get('FETCH_BODIES', 'always'),
+            'MAX_BODY_BYTES': int(os.environ.get('MAX_BODY_BYTES', 1024 * 1024)),
+            'HTML_BODY_FALLBACK': os.environ.get('HTML_BODY_FALLBACK', 'true').lower() == 'true',
+            'MESSAGE_CACHE_SIZE': int(os.environ.get('MESSAGE_CACHE_SIZE', 1000)),
+            'MESSAGE_CACHE_BODY_BYTES': int(os.environ.get('MESSAGE_CACHE_BODY_BYTES', 64 * 1024 * 1024)),
+            'MESSAGE_CACHE_DIR': os.environ.get('MESSAGE_CACHE_DIR', ''),
+            'MESSAGE_CACHE_DIR_BYTES': int(os.environ.get('MESSAGE_CACHE_DIR_BYTES', 1024 * 1024 * 1024)),
+            'FETCH_BATCH_SIZE': int(os.environ.get('FETCH_BATCH_SIZE', 100)),
+            'FETCH_CONCURRENCY': int(os.environ.get('FETCH_CONCURRENCY', 4)),
+            'FETCH_MAX_RETRIES': int(os.environ.get('FETCH_MAX_RETRIES', 5)),
+            'QUOTA_UNITS_PER_SECOND': float(os.environ.get('QUOTA_UNITS_PER_SECOND', 250)),
+            'QUOTA_BURST_UNITS': float(os.environ.get('QUOTA_BURST_UNITS', 0)),
+            'PIPELINE_WORKERS': os.environ.get('PIPELINE_WORKERS', ''),
+            'PIPELINE_QUEUE_SIZE': int(os.environ.get('PIPELINE_QUEUE_SIZE', 8)),
+            'ACCOUNT_WORKERS': int(os.environ.get('ACCOUNT_WORKERS', 0)),
+            'METRICS_FORMAT': os.environ.get('METRICS_FORMAT', ''),
+            'METRICS_FILE': os.environ.get('METRICS_FILE', ''),
             'GMAIL_CLIENT_ID': os.getenv('GMAIL_CLIENT_ID'),
             'GMAIL_CLIENT_SECRET': os.getenv('GMAIL_CLIENT_SECRET'),
             'GMAIL_PROJECT_ID': os.getenv('GMAIL_PROJECT_ID'),
@@ -1,21 +1,114 @@
+import functools
+import json
 import os
+import threading
+from contextlib import contextmanager
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; refreshes are then only serialized within a process
+    fcntl = None
+
+class SharedCredentials(Credentials):
+    # Credentials whose refreshes go through a CredentialStore, so the threads of a
+    # run and concurrent runs (cron overlaps, multi-account workers) share one
+    # refreshed token instead of each refreshing and overwriting the token file.
+    store = None
+
+    def refresh(self, request):
+        if self.store is None:
+            super().refresh(request)
+        else:
+            self.store.refresh(self, request)
+
+class CredentialStore:
+    # token.json behind an exclusive lock on token.json.lock: a refresh first re-reads
+    # the file and adopts a token another process already refreshed, and writes are
+    # atomic, so a reader never sees a partial file.
+    def __init__(self, token_file, scopes):
+        self.token_file = token_file
+        self.scopes = scopes
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(f"{self.token_file}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self):
+        if not os.path.exists(self.token_file):
+            return None
+        with open(self.token_file) as token:
+            info = json.load(token)
+        creds = SharedCredentials.from_authorized_user_info(info, self.scopes)
+        creds.store = self
+        return creds
+
+    def load(self):
+        with self.locked():
+            return self.read()
+
+    def save(self, creds):
+        with self.locked():
+            self.write(creds)
+
+    def write(self, creds):
+        temporary = f"{self.token_file}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as token:
+            token.write(creds.to_json())
+        os.replace(temporary, self.token_file)
+
+    def refresh(self, creds, request):
+        with self.locked():
+            # Another thread of this process refreshed these credentials meanwhile.
+            if creds.valid:
+                return
+            stored = self.read()
+            if stored is not None and stored.valid and stored.token != creds.token:
+                creds.token = stored.token
+                creds.expiry = stored.expiry
+                creds._refresh_token = stored.refresh_token
+                return
+            Credentials.refresh(creds, request)
+            self.write(creds)
+
+@functools.lru_cache(maxsize=None)
+def discovery_document(service_name='gmail', version='v1'):
+    # The document bundled with google-api-python-client, parsed once per process.
+    return json.loads(get_static_doc(service_name, version))
 
 class GmailAuthenticator:
-    def __init__(self, config):
+    def __init__(self, config, token_file='token.json', interactive=True):
         self.config = config
+        self.token_file = token_file
+        self.interactive = interactive
+        self.store = CredentialStore(token_file, config['SCOPES'])
         self.creds = None
 
     def authenticate(self):
-        if os.path.exists('token.json'):
-            self.creds = Credentials.from_authorized_user_file('token.json', self.config['SCOPES'])
-        
+        self.creds = self.store.load()
+
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
+                # Saved by the store, unless another process had already refreshed them.
                 self.creds.refresh(Request())
+            elif not self.interactive:
+                raise RuntimeError(f"No valid credentials in {self.token_file} and interactive login is disabled")
             else:
                 flow = InstalledAppFlow.from_client_config(
                     {
@@ -31,14 +124,20 @@ class GmailAuthenticator:
                     },
                     scopes=self.config['SCOPES']
                 )
-                self.creds = flow.run_local_server(port=0)
-
-            with open('token.json', 'w') as token:
-                token.write(self.creds.to_json())
+                self.store.save(flow.run_local_server(port=0))
+                self.creds = self.store.load()
 
 class GmailServiceFactory:
     @staticmethod
     def create_service(authenticator):
         if not authenticator.creds:
             authenticator.authenticate()
-        return build('gmail', 'v1', credentials=authenticator.creds)
+        # Built from the bundled discovery document, so no startup fetch or re-parse.
+        return build_from_document(discovery_document(), credentials=authenticator.creds)
+
+    @staticmethod
+    def create_http_factory(authenticator):
+        # Transports for GmailService's HttpPool; all of them share the one credentials object.
+        if not authenticator.creds:
+            authenticator.authenticate()
+        return lambda: AuthorizedHttp(authenticator.creds, http=httplib2.Http())
@@ -1,4 +1,6 @@
-from src.data.models import Email
-from src.data.repository import EmailRepository
+from src.data.models import AppliedAction, Email, RuleScheduleState, ScheduledRule, SyncState, create_schema
+from src.data.record import EmailRecord
+from src.data.repository import AppliedActionRepository, EmailRepository, ScheduleRepository, SyncStateRepository
 
-__all__ = ['Email', 'EmailRepository']
\ No newline at end of file
+__all__ = ['AppliedAction', 'Email', 'EmailRecord', 'RuleScheduleState', 'ScheduledRule', 'SyncState', 'create_schema',
+           'AppliedActionRepository', 'EmailRepository', 'ScheduleRepository', 'SyncStateRepository']
\ No newline at end of file
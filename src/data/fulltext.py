@@ -0,0 +1,123 @@
+from abc import ABC, abstractmethod
+from typing import Iterable, Optional
+from sqlalchemy import and_, bindparam, literal_column, select, table, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import ColumnElement
+from .models import Email
+
+FULLTEXT_FIELDS = ('subject', 'body')
+
+
+class FullTextIndex(ABC):
+    # Full-text index over emails.subject/body used to answer `contains` conditions.
+    # Index hits are always re-checked with LIKE so results match the plain SQL path.
+    MIN_NEEDLE_LENGTH = 3
+
+    @abstractmethod
+    def setup(self, engine: Engine) -> bool:
+        pass
+
+    def index(self, session: Session, message_ids: Iterable[str]) -> None:
+        pass
+
+    def unindex(self, session: Session, message_ids: Iterable[str]) -> None:
+        pass
+
+    @abstractmethod
+    def match_clause(self, field: str, needle: str) -> ColumnElement:
+        pass
+
+    def contains_clause(self, field: str, needle: str, like_clause: ColumnElement) -> Optional[ColumnElement]:
+        if field not in FULLTEXT_FIELDS or len(needle) < self.MIN_NEEDLE_LENGTH:
+            return None
+        return and_(self.match_clause(field, needle), like_clause)
+
+
+class SqliteFts5Index(FullTextIndex):
+    TABLE = 'emails_fts'
+
+    def setup(self, engine: Engine) -> bool:
+        with engine.begin() as connection:
+            exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': self.TABLE}
+            ).first()
+            if exists:
+                return True
+            try:
+                # The trigram tokenizer makes MATCH behave like a case-insensitive substring search.
+                connection.execute(text(
+                    f"CREATE VIRTUAL TABLE {self.TABLE} USING fts5("
+                    "subject, body, content='emails', content_rowid='id', tokenize='trigram')"
+                ))
+            except OperationalError:
+                return False
+            connection.execute(text(f"INSERT INTO {self.TABLE}({self.TABLE}) VALUES ('rebuild')"))
+        return True
+
+    def index(self, session: Session, message_ids: Iterable[str]) -> None:
+        self._execute(session, "INSERT INTO {table}(rowid, subject, body) SELECT id, subject, body", message_ids)
+
+    def unindex(self, session: Session, message_ids: Iterable[str]) -> None:
+        self._execute(
+            session, "INSERT INTO {table}({table}, rowid, subject, body) SELECT 'delete', id, subject, body", message_ids
+        )
+
+    def _execute(self, session: Session, statement: str, message_ids: Iterable[str]) -> None:
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        query = text(
+            statement.format(table=self.TABLE) + " FROM emails WHERE message_id IN :message_ids"
+        ).bindparams(bindparam('message_ids', expanding=True))
+        for start in range(0, len(message_ids), 500):
+            session.execute(query, {'message_ids': message_ids[start:start + 500]})
+
+    def match_clause(self, field: str, needle: str) -> ColumnElement:
+        phrase = '"' + needle.replace('"', '""') + '"'
+        fts = table(self.TABLE)
+        matches = select(literal_column('rowid')).select_from(fts).where(
+            literal_column(self.TABLE).op('MATCH')(f'{field} : {phrase}')
+        )
+        return Email.id.in_(matches)
+
+
+class MySqlFullTextIndex(FullTextIndex):
+    # InnoDB keeps FULLTEXT indexes up to date itself; the ngram parser makes phrase
+    # searches match substrings rather than whole words.
+    MIN_NEEDLE_LENGTH = 2
+
+    def setup(self, engine: Engine) -> bool:
+        with engine.begin() as connection:
+            existing = {
+                row[0] for row in connection.execute(text(
+                    "SELECT index_name FROM information_schema.statistics "
+                    "WHERE table_schema = DATABASE() AND table_name = 'emails'"
+                ))
+            }
+            for field in FULLTEXT_FIELDS:
+                index_name = f'ix_emails_fulltext_{field}'
+                if index_name not in existing:
+                    connection.execute(text(f"ALTER TABLE emails ADD FULLTEXT INDEX {index_name} ({field}) WITH PARSER ngram"))
+        return True
+
+    def match_clause(self, field: str, needle: str) -> ColumnElement:
+        phrase = '"' + needle.replace('"', ' ') + '"'
+        return getattr(Email, field).match(phrase)
+
+
+FULLTEXT_BACKENDS = {
+    'sqlite': SqliteFts5Index,
+    'mysql': MySqlFullTextIndex,
+}
+
+
+def create_fulltext_index(engine: Engine, mode: str = 'auto') -> Optional[FullTextIndex]:
+    if mode == 'off':
+        return None
+    backend = FULLTEXT_BACKENDS.get(engine.dialect.name)
+    if backend is None:
+        return None
+    index = backend()
+    return index if index.setup(engine) else None
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone
 
@@ -9,11 +9,11 @@ class Email(Base):
 
     id = Column(Integer, primary_key=True)
     message_id = Column(String(255), unique=True, nullable=False)
-    sender = Column(String(255), nullable=False)
+    sender = Column(String(255), nullable=False, index=True)
     recipient = Column(String(255), nullable=False)
-    subject = Column(String(255))
+    subject = Column(String(255), index=True)
     body = Column(Text)
-    received_date = Column(DateTime(timezone=True), nullable=False)
+    received_date = Column(DateTime(timezone=True), nullable=False, index=True)
 
     @classmethod
     def create(cls, message_id, sender, recipient, subject, body, received_date):
@@ -23,7 +23,7 @@ class Email(Base):
             recipient=recipient,
             subject=subject,
             body=body,
-            received_date=cls.ensure_offset_aware(received_date)
+            received_date=cls.ensure_offset_aware(received_date).astimezone(timezone.utc)
         )
 
     @staticmethod
@@ -31,3 +31,59 @@ class Email(Base):
         if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
             return dt.replace(tzinfo=timezone.utc)
         return dt
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    id = Column(Integer, primary_key=True)
+    account = Column(String(255), unique=True, nullable=False)
+    history_id = Column(String(32), nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class AppliedAction(Base):
+    __tablename__ = 'applied_actions'
+    __table_args__ = (UniqueConstraint('message_id', 'rule_hash', 'action', name='uq_applied_action'),)
+
+    STATUS_PENDING = 'pending'
+    STATUS_APPLIED = 'applied'
+    STATUS_FAILED = 'failed'
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String(255), nullable=False)
+    rule_hash = Column(String(64), nullable=False)
+    action = Column(String(255), nullable=False)
+    status = Column(String(16), nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class ScheduledRule(Base):
+    # The moment a date rule (e.g. "older than 7 days") becomes true for a stored email.
+    __tablename__ = 'rule_schedule'
+    __table_args__ = (UniqueConstraint('message_id', 'rule_hash', name='uq_rule_schedule'),)
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String(255), nullable=False)
+    rule_hash = Column(String(64), nullable=False)
+    due_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class RuleScheduleState(Base):
+    # How far each date rule has been scheduled: emails up to last_email_id, as of scheduled_at.
+    __tablename__ = 'rule_schedule_state'
+
+    id = Column(Integer, primary_key=True)
+    rule_hash = Column(String(64), unique=True, nullable=False)
+    last_email_id = Column(Integer, nullable=False)
+    scheduled_at = Column(DateTime(timezone=True), nullable=False)
+
+
+def create_schema(engine):
+    # create_all skips tables that already exist, and with them any index added to
+    # those tables since, so indexes are created one by one when missing.
+    Base.metadata.create_all(engine)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from .models import Email
+
+# Attribute of an EmailRecord that rule conditions on each field are evaluated against.
+MATCH_ATTRIBUTES = {
+    'sender': 'sender_lower',
+    'recipient': 'recipient_lower',
+    'subject': 'subject_lower',
+    'body': 'body_lower',
+    'received_date': 'received_at',
+}
+
+
+def lowered(value: Optional[str]) -> str:
+    # Shares the original string when it is already lower case, as most addresses
+    # and many bodies are, instead of keeping a second copy.
+    if not value:
+        return ''
+    lower = value.lower()
+    return value if lower == value else lower
+
+
+class EmailRecord:
+    # A parsed message as the rule matcher sees it: plain slots instead of an ORM
+    # instance (no identity map, attribute instrumentation or session reference),
+    # with the lower-cased field values and epoch-seconds timestamp that conditions
+    # compare against computed once. Rows are built from records only when they are
+    # stored, in bulk. A body of None was never downloaded (FETCH_BODIES=lazy), which
+    # is not the same as an empty one: has_body tells them apart.
+    __slots__ = ('message_id', 'sender', 'recipient', 'subject', '_body', 'received_date',
+                 'sender_lower', 'recipient_lower', 'subject_lower', 'body_lower', 'has_body', 'received_at')
+
+    def __init__(self, message_id: str, sender: str, recipient: str, subject: Optional[str],
+                 body: Optional[str], received_date: datetime):
+        self.message_id = message_id
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.received_date = received_date
+        self.sender_lower = lowered(sender)
+        self.recipient_lower = lowered(recipient)
+        self.subject_lower = lowered(subject)
+        self.received_at = received_date.timestamp()
+
+    @classmethod
+    def create(cls, message_id, sender, recipient, subject, body, received_date):
+        return cls(message_id, sender, recipient, subject, body,
+                   Email.ensure_offset_aware(received_date).astimezone(timezone.utc))
+
+    @classmethod
+    def from_email(cls, email: Any) -> 'EmailRecord':
+        # Accepts ORM instances and query rows alike.
+        return cls.create(email.message_id, email.sender, email.recipient, email.subject, email.body,
+                          email.received_date)
+
+    @property
+    def body(self) -> Optional[str]:
+        return self._body
+
+    @body.setter
+    def body(self, body: Optional[str]) -> None:
+        # Bodies of metadata-only fetches are filled in later by load_bodies().
+        self._body = body
+        self.body_lower = lowered(body)
+        self.has_body = body is not None
+
+    def to_row(self) -> Dict[str, Any]:
+        return {
+            'message_id': self.message_id,
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'subject': self.subject,
+            'body': self._body,
+            'received_date': self.received_date,
+        }
+
+    def to_model(self) -> Email:
+        return Email(**self.to_row())
+
+    def __repr__(self) -> str:
+        return f"EmailRecord(message_id={self.message_id!r}, subject={self.subject!r})"
+
+
+def as_record(email: Any) -> EmailRecord:
+    return email if isinstance(email, EmailRecord) else EmailRecord.from_email(email)
@@ -1,25 +1,365 @@
+from sqlalchemy import bindparam, func, insert, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from .models import Email
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from datetime import datetime, timezone
+from .fulltext import FullTextIndex
+from .models import AppliedAction, Email, RuleScheduleState, ScheduledRule, SyncState
+from .record import EmailRecord
+from src.metrics import metrics
+
+MATCHABLE_COLUMNS = (Email.message_id, Email.sender, Email.recipient, Email.subject, Email.body, Email.received_date)
+EMAIL_FIELDS = tuple(column.key for column in MATCHABLE_COLUMNS)
+# Keeps IN lists below SQLite's default limit of 999 bound parameters.
+IN_CLAUSE_CHUNK_SIZE = 500
+
+ActionKey = Tuple[str, str, str]
 
 class EmailRepository:
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, fulltext: Optional[FullTextIndex] = None):
         self.session = session
+        self.fulltext = fulltext
 
     def add_email(self, email: Email) -> None:
         self.session.add(email)
+        if self.fulltext:
+            self.session.flush()
+            self.fulltext.index(self.session, [email.message_id])
         self.session.commit()
 
+    @metrics.timed('repository_seconds', operation='existing_message_ids')
+    def existing_message_ids(self, message_ids: Iterable[str]) -> Set[str]:
+        message_ids = list(message_ids)
+        existing: Set[str] = set()
+        for start in range(0, len(message_ids), IN_CLAUSE_CHUNK_SIZE):
+            chunk = message_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+            rows = self.session.query(Email.message_id).filter(Email.message_id.in_(chunk))
+            existing.update(row.message_id for row in rows)
+        return existing
+
+    @metrics.timed('repository_seconds', operation='add_new_emails')
+    def add_new_emails(self, emails: List[Any], commit: bool = True) -> List[Any]:
+        existing = self.existing_message_ids(email.message_id for email in emails)
+        new_emails = []
+        for email in emails:
+            if email.message_id not in existing:
+                existing.add(email.message_id)
+                new_emails.append(email)
+        self.bulk_insert(new_emails, commit)
+        return new_emails
+
+    @metrics.timed('repository_seconds', operation='bulk_insert')
+    def bulk_insert(self, emails: List[Any], commit: bool = True) -> None:
+        if emails:
+            self.session.execute(insert(Email.__table__), [self.to_row(email) for email in emails])
+            if self.fulltext:
+                self.fulltext.index(self.session, [email.message_id for email in emails])
+        if commit:
+            self.session.commit()
+
+    @metrics.timed('repository_seconds', operation='upsert_emails')
+    def upsert_emails(self, emails: List[Any]) -> None:
+        if not emails:
+            return
+        rows = [self.to_row(email) for email in emails]
+        table = Email.__table__
+        if self.fulltext:
+            self.fulltext.unindex(self.session, [row['message_id'] for row in rows])
+        dialect = self.session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            statement = sqlite_insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.message_id],
+                set_={field: statement.excluded[field] for field in EMAIL_FIELDS if field != 'message_id'}
+            )
+            self.session.execute(statement, rows)
+        elif dialect == 'mysql':
+            statement = mysql_insert(table)
+            statement = statement.on_duplicate_key_update(
+                {field: statement.inserted[field] for field in EMAIL_FIELDS if field != 'message_id'}
+            )
+            self.session.execute(statement, rows)
+        else:
+            existing = self.existing_message_ids(row['message_id'] for row in rows)
+            new_rows = [row for row in rows if row['message_id'] not in existing]
+            updated_rows = [dict(row, b_message_id=row['message_id']) for row in rows if row['message_id'] in existing]
+            if new_rows:
+                self.session.execute(insert(table), new_rows)
+            if updated_rows:
+                statement = update(table).where(table.c.message_id == bindparam('b_message_id'))
+                self.session.execute(statement, updated_rows)
+        if self.fulltext:
+            self.fulltext.index(self.session, [row['message_id'] for row in rows])
+        self.session.commit()
+
+    @staticmethod
+    def to_row(email: Any) -> Dict[str, Any]:
+        if isinstance(email, EmailRecord):
+            return email.to_row()
+        return {field: getattr(email, field) for field in EMAIL_FIELDS}
+
+    @metrics.timed('repository_seconds', operation='get_records')
+    def get_records(self, message_ids: Iterable[str]) -> Dict[str, EmailRecord]:
+        message_ids = list(message_ids)
+        records: Dict[str, EmailRecord] = {}
+        for start in range(0, len(message_ids), IN_CLAUSE_CHUNK_SIZE):
+            chunk = message_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+            for row in self.session.query(*MATCHABLE_COLUMNS).filter(Email.message_id.in_(chunk)):
+                records[row.message_id] = EmailRecord.from_email(row)
+        return records
+
     def get_email_by_message_id(self, message_id: str) -> Optional[Email]:
         return self.session.query(Email).filter(Email.message_id == message_id).first()
 
+    @metrics.timed('repository_seconds', operation='update_email')
     def update_email(self, email: Email) -> None:
+        if self.fulltext:
+            self.fulltext.unindex(self.session, [email.message_id])
         self.session.merge(email)
+        if self.fulltext:
+            self.session.flush()
+            self.fulltext.index(self.session, [email.message_id])
         self.session.commit()
 
     def get_all_emails(self) -> List[Email]:
         return self.session.query(Email).all()
 
+    def iter_email_rows(self, batch_size: int = 10000) -> Iterator[List[Row]]:
+        query = self.session.query(*MATCHABLE_COLUMNS).order_by(Email.received_date, Email.id)
+        return self._batched(query, batch_size)
+
+    def iter_matching_rows(self, criterion: Any, batch_size: int = 1000,
+                           columns: Tuple[Any, ...] = (Email.message_id,)) -> Iterator[List[Row]]:
+        # Keyset pages rather than one open cursor, so callers may commit between pages.
+        last_id = 0
+        while True:
+            rows = (self.session.query(Email.id, *columns)
+                    .filter(criterion, Email.id > last_id)
+                    .order_by(Email.id)
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].id
+
+    @staticmethod
+    def _batched(query: Any, batch_size: int) -> Iterator[List[Row]]:
+        batch = []
+        for row in query.yield_per(batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def delete_email(self, email: Email) -> None:
+        if self.fulltext:
+            self.fulltext.unindex(self.session, [email.message_id])
         self.session.delete(email)
-        self.session.commit()
\ No newline at end of file
+        self.session.commit()
+
+
+class SyncStateRepository:
+    DEFAULT_ACCOUNT = 'me'
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    def get_history_id(self, account: str = DEFAULT_ACCOUNT) -> Optional[str]:
+        state = self.session.query(SyncState).filter(SyncState.account == account).first()
+        return state.history_id if state else None
+
+    def save_history_id(self, history_id: str, account: str = DEFAULT_ACCOUNT) -> None:
+        state = self.session.query(SyncState).filter(SyncState.account == account).first()
+        if state is None:
+            state = SyncState(account=account)
+            self.session.add(state)
+        state.history_id = str(history_id)
+        state.updated_at = datetime.now(timezone.utc)
+        self.session.commit()
+
+
+class AppliedActionRepository:
+    UNFINISHED_STATUSES = (AppliedAction.STATUS_PENDING, AppliedAction.STATUS_FAILED)
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    @metrics.timed('repository_seconds', operation='applied_keys')
+    def applied_keys(self, message_ids: Iterable[str]) -> Set[ActionKey]:
+        return self._keys(message_ids, AppliedAction.status == AppliedAction.STATUS_APPLIED)
+
+    @metrics.timed('repository_seconds', operation='record_pending')
+    def record_pending(self, keys: List[ActionKey], commit: bool = True) -> None:
+        if not keys:
+            return
+        now = datetime.now(timezone.utc)
+        rows = [
+            {'message_id': message_id, 'rule_hash': rule_hash, 'action': action,
+             'status': AppliedAction.STATUS_PENDING, 'attempts': 1, 'updated_at': now}
+            for message_id, rule_hash, action in keys
+        ]
+        table = AppliedAction.__table__
+        dialect = self.session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            statement = sqlite_insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.message_id, table.c.rule_hash, table.c.action],
+                set_={'status': statement.excluded.status, 'updated_at': statement.excluded.updated_at,
+                      'attempts': table.c.attempts + 1}
+            )
+            self.session.execute(statement, rows)
+        elif dialect == 'mysql':
+            statement = mysql_insert(table)
+            statement = statement.on_duplicate_key_update(
+                status=statement.inserted.status, updated_at=statement.inserted.updated_at,
+                attempts=table.c.attempts + 1
+            )
+            self.session.execute(statement, rows)
+        else:
+            existing = self._keys({message_id for message_id, _, _ in keys})
+            new_rows = [row for row in rows if (row['message_id'], row['rule_hash'], row['action']) not in existing]
+            if new_rows:
+                self.session.execute(insert(table), new_rows)
+            retried = [key for key in keys if key in existing]
+            self._update_status(retried, AppliedAction.STATUS_PENDING, now, increment_attempts=True)
+        if commit:
+            self.session.commit()
+
+    @metrics.timed('repository_seconds', operation='mark')
+    def mark(self, keys: List[ActionKey], status: str) -> None:
+        if keys:
+            self._update_status(keys, status, datetime.now(timezone.utc))
+            self.session.commit()
+
+    def iter_unfinished(self, batch_size: int = 1000) -> Iterator[List[Row]]:
+        last_id = 0
+        while True:
+            rows = (self.session.query(AppliedAction.id, AppliedAction.message_id,
+                                       AppliedAction.rule_hash, AppliedAction.action)
+                    .filter(AppliedAction.status.in_(self.UNFINISHED_STATUSES), AppliedAction.id > last_id)
+                    .order_by(AppliedAction.id)
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].id
+
+    def status_counts(self) -> Dict[str, int]:
+        rows = self.session.query(AppliedAction.status, func.count()).group_by(AppliedAction.status)
+        return {status: count for status, count in rows}
+
+    def _keys(self, message_ids: Iterable[str], *criteria: Any) -> Set[ActionKey]:
+        message_ids = list(message_ids)
+        keys: Set[ActionKey] = set()
+        for start in range(0, len(message_ids), IN_CLAUSE_CHUNK_SIZE):
+            chunk = message_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+            rows = (self.session.query(AppliedAction.message_id, AppliedAction.rule_hash, AppliedAction.action)
+                    .filter(AppliedAction.message_id.in_(chunk), *criteria))
+            keys.update((row.message_id, row.rule_hash, row.action) for row in rows)
+        return keys
+
+    def _update_status(self, keys: List[ActionKey], status: str, now: datetime,
+                       increment_attempts: bool = False) -> None:
+        if not keys:
+            return
+        table = AppliedAction.__table__
+        values = {'status': status, 'updated_at': now}
+        if increment_attempts:
+            values['attempts'] = table.c.attempts + 1
+        statement = update(table).where(
+            table.c.message_id == bindparam('b_message_id'),
+            table.c.rule_hash == bindparam('b_rule_hash'),
+            table.c.action == bindparam('b_action'),
+        ).values(**values)
+        self.session.execute(statement, [
+            {'b_message_id': message_id, 'b_rule_hash': rule_hash, 'b_action': action}
+            for message_id, rule_hash, action in keys
+        ])
+
+
+class ScheduleRepository:
+    def __init__(self, session: Session):
+        self.session = session
+
+    def states(self) -> Dict[str, RuleScheduleState]:
+        return {state.rule_hash: state for state in self.session.query(RuleScheduleState)}
+
+    def save_state(self, rule_hash: str, last_email_id: int, scheduled_at: datetime) -> None:
+        state = self.session.query(RuleScheduleState).filter(RuleScheduleState.rule_hash == rule_hash).first()
+        if state is None:
+            state = RuleScheduleState(rule_hash=rule_hash)
+            self.session.add(state)
+        state.last_email_id = last_email_id
+        state.scheduled_at = scheduled_at
+        self.session.commit()
+
+    def max_email_id(self) -> int:
+        return self.session.query(func.max(Email.id)).scalar() or 0
+
+    @metrics.timed('repository_seconds', operation='schedule')
+    def schedule(self, rows: List[Dict[str, Any]]) -> None:
+        # Rows already scheduled (after an interrupted tick) are left as they are.
+        if not rows:
+            return
+        table = ScheduledRule.__table__
+        dialect = self.session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            self.session.execute(sqlite_insert(table).on_conflict_do_nothing(), rows)
+        elif dialect == 'mysql':
+            self.session.execute(mysql_insert(table).prefix_with('IGNORE'), rows)
+        else:
+            existing = set()
+            message_ids = list({row['message_id'] for row in rows})
+            for start in range(0, len(message_ids), IN_CLAUSE_CHUNK_SIZE):
+                query = (self.session.query(ScheduledRule.message_id, ScheduledRule.rule_hash)
+                         .filter(ScheduledRule.message_id.in_(message_ids[start:start + IN_CLAUSE_CHUNK_SIZE])))
+                existing.update((row.message_id, row.rule_hash) for row in query)
+            new_rows = [row for row in rows if (row['message_id'], row['rule_hash']) not in existing]
+            if new_rows:
+                self.session.execute(insert(table), new_rows)
+        self.session.commit()
+
+    def iter_due(self, now: datetime, batch_size: int = 1000) -> Iterator[List[Row]]:
+        # Entries due by `now` joined with their emails, in keyset pages.
+        last_id = 0
+        while True:
+            rows = (self.session.query(ScheduledRule.id.label('schedule_id'), ScheduledRule.rule_hash,
+                                       *MATCHABLE_COLUMNS)
+                    .join(Email, Email.message_id == ScheduledRule.message_id)
+                    .filter(ScheduledRule.due_at <= now, ScheduledRule.id > last_id)
+                    .order_by(ScheduledRule.id)
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].schedule_id
+
+    def delete(self, schedule_ids: List[int]) -> None:
+        for start in range(0, len(schedule_ids), IN_CLAUSE_CHUNK_SIZE):
+            (self.session.query(ScheduledRule)
+             .filter(ScheduledRule.id.in_(schedule_ids[start:start + IN_CLAUSE_CHUNK_SIZE]))
+             .delete(synchronize_session=False))
+        self.session.commit()
+
+    def purge(self, current_hashes: Set[str]) -> int:
+        # Drops entries and state of rules that were removed or changed, including
+        # entries whose email was deleted.
+        stale = (self.session.query(ScheduledRule).filter(ScheduledRule.rule_hash.notin_(current_hashes))
+                 .delete(synchronize_session=False))
+        orphaned = (self.session.query(ScheduledRule)
+                    .filter(ScheduledRule.message_id.notin_(self.session.query(Email.message_id).scalar_subquery()))
+                    .delete(synchronize_session=False))
+        (self.session.query(RuleScheduleState).filter(RuleScheduleState.rule_hash.notin_(current_hashes))
+         .delete(synchronize_session='fetch'))
+        self.session.commit()
+        return stale + orphaned
+
+    def pending_count(self) -> int:
+        return self.session.query(func.count(ScheduledRule.id)).scalar()
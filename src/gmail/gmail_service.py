@@ -1,67 +1,386 @@
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from src.data.models import Email
+from src.data.record import EmailRecord
+from src.gmail.http_pool import HttpPool
+from src.gmail.message_cache import MessageCache
+from src.gmail.mime import DEFAULT_MAX_BODY_BYTES, decode_data, decode_text, extract_body
+from src.gmail.rate_limiter import IDEMPOTENT_METHODS, TokenBucket, quota_units
+from src.metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import email.utils
-import base64
-from typing import List, Optional
+import json
+import random
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+class HistoryExpiredError(Exception):
+    pass
 
 class GmailService:
-    MIME_TYPE_PLAIN = 'text/plain'
     USER_ID = 'me'
+    MOVE_LABELS = ['INBOX', 'SPAM', 'TRASH']
+    BATCH_MODIFY_LIMIT = 1000
+    BATCH_REQUEST_LIMIT = 100
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+    THROTTLE_STATUSES = {429, 503}
+    RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+    MAX_BACKOFF_SECONDS = 32.0
+    FORMAT_FULL = 'full'
+    FORMAT_METADATA = 'metadata'
+    METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+    # messages.list leaves these out unless asked, so a history sync does too.
+    HISTORY_EXCLUDED_LABELS = {'SPAM', 'TRASH', 'DRAFT'}
 
-    def __init__(self, gmail_service: build):
+    def __init__(self, gmail_service: build, batch_size: int = BATCH_REQUEST_LIMIT, concurrency: int = 1,
+                 max_retries: int = 5, backoff_base: float = 1.0, http_factory: Optional[Callable[[], Any]] = None,
+                 max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES, html_fallback: bool = True,
+                 rate_limiter: Optional[TokenBucket] = None, cache: Optional[MessageCache] = None):
         self.service = gmail_service
+        self.batch_size = max(1, min(batch_size, self.BATCH_REQUEST_LIMIT))
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.http_factory = http_factory
+        self.http_pool = HttpPool(http_factory) if http_factory else None
+        self.max_body_bytes = max_body_bytes
+        self.html_fallback = html_fallback
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        # Messages that could not be fetched (other than deleted ones); a sync must not
+        # advance its history checkpoint past them.
+        self.unfetched_ids: Set[str] = set()
 
-    def fetch_emails(self, max_results: int = 100) -> List[Email]:
+    def fetch_emails(self, max_results: int = 100) -> List[EmailRecord]:
         try:
-            results = self.service.users().messages().list(userId=self.USER_ID, maxResults=max_results).execute()
+            results = self._execute(self.service.users().messages().list(userId=self.USER_ID, maxResults=max_results),
+                                    'messages.list')
             messages = results.get('messages', [])
-            return [self.get_email_details(message['id']) for message in messages]
+            return self.get_emails([message['id'] for message in messages])
         except HttpError as error:
             print(f'An error occurred: {error}')
             return []
 
-    def get_email_details(self, message_id: str) -> Optional[Email]:
-        try:
-            message = self.service.users().messages().get(userId=self.USER_ID, id=message_id).execute()
-            headers = {header['name'].lower(): header['value'] for header in message['payload']['headers']}
-            
-            subject = headers.get('subject', '')
-            sender = headers.get('from', '')
-            recipient = headers.get('to', '')
-            date_str = headers.get('date', '')
-
-            body = self.get_email_body(message)
-            received_date = email.utils.parsedate_to_datetime(date_str)
-
-            return Email.create(
-                message_id=message_id,
-                sender=sender,
-                recipient=recipient,
-                subject=subject,
-                body=body,
-                received_date=received_date
+    def iter_message_ids(self, query: Optional[str] = None, page_size: int = 100,
+                         max_results: Optional[int] = None) -> Iterator[List[str]]:
+        page_token = None
+        remaining = max_results
+        while remaining is None or remaining > 0:
+            params = {'userId': self.USER_ID, 'maxResults': page_size if remaining is None else min(page_size, remaining)}
+            if query:
+                params['q'] = query
+            if page_token:
+                params['pageToken'] = page_token
+            try:
+                results = self._execute(self.service.users().messages().list(**params), 'messages.list')
+            except HttpError as error:
+                print(f'An error occurred while listing messages: {error}')
+                return
+            message_ids = [message['id'] for message in results.get('messages', [])]
+            if message_ids:
+                yield message_ids
+            if remaining is not None:
+                remaining -= len(message_ids)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+
+    def get_history_id(self) -> str:
+        return self._execute(self.service.users().getProfile(userId=self.USER_ID), 'getProfile')['historyId']
+
+    def get_history_changes(self, start_history_id: str, page_size: int = 500,
+                            label_id: Optional[str] = None) -> Tuple[List[str], str]:
+        message_ids: Dict[str, None] = {}
+        history_id = start_history_id
+        page_token = None
+        while True:
+            params = {
+                'userId': self.USER_ID,
+                'startHistoryId': start_history_id,
+                'historyTypes': ['messageAdded'],
+                'maxResults': page_size,
+            }
+            if label_id:
+                params['labelId'] = label_id
+            if page_token:
+                params['pageToken'] = page_token
+            try:
+                results = self._execute(self.service.users().history().list(**params), 'history.list')
+            except HttpError as error:
+                if error.resp.status == 404:
+                    raise HistoryExpiredError(f"History {start_history_id} is no longer available") from error
+                raise
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    if self.HISTORY_EXCLUDED_LABELS & set(added['message'].get('labelIds', [])):
+                        continue
+                    message_ids[added['message']['id']] = None
+                    if self.cache is not None:
+                        self.cache.invalidate(added['message']['id'], record.get('id'))
+            history_id = results.get('historyId', history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return list(message_ids), history_id
+
+    def filter_by_query(self, message_ids: List[str], query: str, page_size: int = 500) -> List[str]:
+        # messages.list cannot be limited to given IDs, so the query's listing is read
+        # until every ID has turned up (newest first, so new messages come early).
+        # Errors are raised: dropping IDs here would lose them for good.
+        wanted = set(message_ids)
+        matching = set()
+        page_token = None
+        while wanted - matching:
+            params = {'userId': self.USER_ID, 'maxResults': page_size, 'q': query}
+            if page_token:
+                params['pageToken'] = page_token
+            results = self._execute(self.service.users().messages().list(**params), 'messages.list')
+            matching.update(message['id'] for message in results.get('messages', []) if message['id'] in wanted)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        return [message_id for message_id in message_ids if message_id in matching]
+
+    def iter_email_pages(self, query: Optional[str] = None, page_size: int = 100,
+                         max_results: Optional[int] = None) -> Iterator[List[EmailRecord]]:
+        for message_ids in self.iter_message_ids(query, page_size, max_results):
+            yield self.get_emails(message_ids)
+
+    def iter_emails(self, query: Optional[str] = None, page_size: int = 100,
+                    max_results: Optional[int] = None) -> Iterator[EmailRecord]:
+        for emails in self.iter_email_pages(query, page_size, max_results):
+            yield from emails
+
+    def get_emails(self, message_ids: List[str], message_format: str = FORMAT_FULL) -> List[EmailRecord]:
+        cached = self.cached_emails(message_ids, message_format)
+        missing = [message_id for message_id in message_ids if message_id not in cached]
+        messages = self.fetch_messages(missing, message_format) if missing else {}
+        emails = []
+        for message_id in message_ids:
+            if message_id in cached:
+                emails.append(cached[message_id])
+            elif message_id in messages:
+                emails.append(self.parse_message(message_id, messages[message_id], message_format))
+        return emails
+
+    def cached_emails(self, message_ids: List[str], message_format: str = FORMAT_FULL) -> Dict[str, EmailRecord]:
+        if self.cache is None:
+            return {}
+        return self.cache.lookup(message_ids, with_body=message_format == self.FORMAT_FULL)
+
+    def load_bodies(self, emails: List[EmailRecord]) -> None:
+        # Cached records may already carry their body.
+        emails = [email_obj for email_obj in emails if email_obj.body is None]
+        if not emails:
+            return
+        messages = self.fetch_messages([email.message_id for email in emails])
+        for email_obj in emails:
+            message = messages.get(email_obj.message_id)
+            if message is not None:
+                email_obj.body = self.get_email_body(message)
+                if self.cache is not None:
+                    self.cache.put(email_obj)
+
+    def fetch_messages(self, message_ids: List[str], message_format: str = FORMAT_FULL) -> Dict[str, dict]:
+        messages: Dict[str, dict] = {}
+        if self.cache is not None:
+            messages = self.cache.raw_messages(message_ids, message_format)
+            message_ids = [message_id for message_id in message_ids if message_id not in messages]
+        chunks = [message_ids[start:start + self.batch_size] for start in range(0, len(message_ids), self.batch_size)]
+        # httplib2 connections are not thread-safe, so concurrent batches need
+        # transports of their own from http_factory, borrowed from the HttpPool.
+        workers = min(self.concurrency if self.http_factory else 1, len(chunks))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                fetched_chunks = list(executor.map(self._fetch_batch, chunks, [message_format] * len(chunks)))
+        else:
+            fetched_chunks = [self._fetch_batch(chunk, message_format) for chunk in chunks]
+
+        for fetched in fetched_chunks:
+            messages.update(fetched)
+            if self.cache is not None:
+                self.cache.store_raw(fetched, message_format)
+        return messages
+
+    def _get_request(self, message_id: str, message_format: str = FORMAT_FULL) -> Any:
+        if message_format == self.FORMAT_METADATA:
+            return self.service.users().messages().get(
+                userId=self.USER_ID, id=message_id, format=message_format, metadataHeaders=self.METADATA_HEADERS
             )
+        return self.service.users().messages().get(userId=self.USER_ID, id=message_id)
+
+    def _fetch_batch(self, message_ids: List[str], message_format: str = FORMAT_FULL) -> Dict[str, dict]:
+        fetched: Dict[str, dict] = {}
+        pending = list(message_ids)
+        for attempt in range(self.max_retries + 1):
+            retry: List[str] = []
+            throttled: List[HttpError] = []
+
+            def callback(request_id: str, response: dict, exception: Optional[HttpError]) -> None:
+                if exception is not None and metrics.enabled:
+                    metrics.increment('gmail_api_errors_total', method='messages.get', status=exception.resp.status)
+                if exception is None:
+                    fetched[request_id] = response
+                elif self.is_retryable(exception):
+                    retry.append(request_id)
+                    if self.is_throttled(exception):
+                        throttled.append(exception)
+                else:
+                    if exception.resp.status != 404:
+                        self.unfetched_ids.add(request_id)
+                    print(f'An error occurred while fetching email details: {exception}')
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(self._get_request(message_id, message_format), request_id=message_id)
+            # A batch costs the sum of its parts; its retries happen per message below.
+            self._acquire('messages.get', len(pending))
+            try:
+                self._send(batch, 'batch')
+            except HttpError as error:
+                if not self.is_retryable(error):
+                    print(f'An error occurred while fetching email details: {error}')
+                    self.unfetched_ids.update(message_id for message_id in pending if message_id not in fetched)
+                    return fetched
+                retry = [message_id for message_id in pending if message_id not in fetched]
+                if self.is_throttled(error):
+                    throttled.append(error)
+
+            if self.rate_limiter is not None:
+                if throttled:
+                    self.rate_limiter.throttle()
+                else:
+                    self.rate_limiter.relax()
+            if not retry:
+                return fetched
+            pending = retry
+            if attempt < self.max_retries:
+                time.sleep(self.retry_delay(throttled[0] if throttled else None, attempt))
+        print(f'Giving up on {len(pending)} messages after {self.max_retries} retries')
+        self.unfetched_ids.update(pending)
+        return fetched
+
+    def _execute(self, request: Any, method: str) -> Any:
+        retries = self.max_retries if method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            self._acquire(method)
+            try:
+                response = self._send(request, method)
+            except HttpError as error:
+                throttled = self.is_throttled(error)
+                if throttled and self.rate_limiter is not None:
+                    self.rate_limiter.throttle()
+                if attempt == retries or not self.is_retryable(error):
+                    raise
+                time.sleep(self.retry_delay(error if throttled else None, attempt))
+                continue
+            if self.rate_limiter is not None:
+                self.rate_limiter.relax()
+            return response
+
+    def _acquire(self, method: str, count: int = 1) -> None:
+        units = quota_units(method, count)
+        if metrics.enabled:
+            metrics.increment('gmail_api_calls_total', count, method=method)
+            metrics.increment('gmail_quota_units_total', units, method=method)
+        if self.rate_limiter is not None:
+            waited = self.rate_limiter.acquire(units)
+            if waited and metrics.enabled:
+                metrics.observe('gmail_quota_wait_seconds', waited)
+
+    def _send(self, request: Any, method: str) -> Any:
+        if not metrics.enabled:
+            return self._send_request(request)
+        start = time.perf_counter()
+        try:
+            return self._send_request(request)
+        except HttpError as error:
+            metrics.increment('gmail_api_errors_total', method=method, status=error.resp.status)
+            raise
+        finally:
+            metrics.observe('gmail_request_seconds', time.perf_counter() - start, method=method)
+
+    def _send_request(self, request: Any) -> Any:
+        if self.http_factory is None:
+            return request.execute()
+        with self.http_pool.connection() as http:
+            return request.execute(http=http)
+
+    @staticmethod
+    def error_reasons(error: HttpError) -> set:
+        try:
+            details = json.loads(error.content.decode('utf-8'))['error'].get('errors', [])
+            return {detail.get('reason') for detail in details}
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return set()
+
+    def is_retryable(self, error: Exception) -> bool:
+        if not isinstance(error, HttpError):
+            return False
+        return error.resp.status in self.RETRYABLE_STATUSES or self.is_throttled(error)
+
+    def is_throttled(self, error: HttpError) -> bool:
+        if error.resp.status in self.THROTTLE_STATUSES:
+            return True
+        return error.resp.status == 403 and bool(self.error_reasons(error) & self.RATE_LIMIT_REASONS)
+
+    def backoff_delay(self, attempt: int) -> float:
+        delay = min(self.backoff_base * (2 ** attempt), self.MAX_BACKOFF_SECONDS)
+        return delay + random.uniform(0, self.backoff_base)
+
+    def retry_delay(self, error: Optional[HttpError], attempt: int) -> float:
+        delay = self.backoff_delay(attempt)
+        retry_after = error.resp.get('retry-after') if error is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), self.MAX_BACKOFF_SECONDS))
+        return delay
+
+    def get_email_details(self, message_id: str) -> Optional[EmailRecord]:
+        cached = self.cached_emails([message_id])
+        if message_id in cached:
+            return cached[message_id]
+        try:
+            message = self.cache.raw_messages([message_id]).get(message_id) if self.cache is not None else None
+            if message is None:
+                message = self._execute(self._get_request(message_id), 'messages.get')
+                if self.cache is not None:
+                    self.cache.store_raw({message_id: message})
+            return self.parse_message(message_id, message)
         except HttpError as error:
             print(f'An error occurred while fetching email details: {error}')
             return None
 
+    def parse_message(self, message_id: str, message: dict, message_format: str = FORMAT_FULL) -> EmailRecord:
+        headers = {header['name'].lower(): header['value'] for header in message['payload']['headers']}
+
+        subject = headers.get('subject', '')
+        sender = headers.get('from', '')
+        recipient = headers.get('to', '')
+        date_str = headers.get('date', '')
+
+        body = self.get_email_body(message) if message_format == self.FORMAT_FULL else None
+        received_date = email.utils.parsedate_to_datetime(date_str)
+
+        record = EmailRecord.create(
+            message_id=message_id,
+            sender=sender,
+            recipient=recipient,
+            subject=subject,
+            body=body,
+            received_date=received_date
+        )
+        if self.cache is not None:
+            self.cache.put(record, message.get('historyId'))
+        return record
+
+    @metrics.timed('mime_decode_seconds')
     def get_email_body(self, message: dict) -> str:
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] == self.MIME_TYPE_PLAIN:
-                    return self.decode_body(part['body'].get('data', ''))
-        elif 'body' in message['payload']:
-            return self.decode_body(message['payload']['body'].get('data', ''))
-        return ""
+        return extract_body(message['payload'], self.max_body_bytes, self.html_fallback)
 
     @staticmethod
     def decode_body(encoded_body: str) -> str:
         if not encoded_body:
             return ""
-        decoded_bytes = base64.urlsafe_b64decode(encoded_body)
-        return decoded_bytes.decode('utf-8')
+        return decode_text(decode_data(encoded_body))
 
 
     def mark_as_read(self, message_id: str) -> None:
@@ -77,14 +396,36 @@ class GmailService:
                 body['addLabelIds'] = add_labels
             if remove_labels:
                 body['removeLabelIds'] = remove_labels
-            self.service.users().messages().modify(userId=self.USER_ID, id=message_id, body=body).execute()
+            self._execute(self.service.users().messages().modify(userId=self.USER_ID, id=message_id, body=body),
+                          'messages.modify')
         except HttpError as error:
             print(f'An error occurred while modifying the message: {error}')
 
+    def batch_modify_messages(self, message_ids: List[str], add_labels: List[str] = None, remove_labels: List[str] = None) -> List[str]:
+        failed: List[str] = []
+        for start in range(0, len(message_ids), self.BATCH_MODIFY_LIMIT):
+            chunk = message_ids[start:start + self.BATCH_MODIFY_LIMIT]
+            try:
+                body = {'ids': chunk}
+                if add_labels:
+                    body['addLabelIds'] = add_labels
+                if remove_labels:
+                    body['removeLabelIds'] = remove_labels
+                self._execute(self.service.users().messages().batchModify(userId=self.USER_ID, body=body),
+                              'messages.batchModify')
+            except HttpError as error:
+                print(f'An error occurred while batch modifying messages: {error}')
+                failed.extend(chunk)
+        return failed
+
     def move_message(self, message_id: str, label_id: str) -> None:
+        add_labels, remove_labels = self.move_labels(label_id)
+        self.modify_message(message_id, add_labels=add_labels, remove_labels=remove_labels)
+
+    @classmethod
+    def move_labels(cls, label_id: str) -> Tuple[List[str], List[str]]:
         label_id = label_id.upper()
-        if label_id in ['INBOX', 'SPAM', 'TRASH']:
-            remove_labels = set(['INBOX', 'SPAM', 'TRASH']) - {label_id}
-            self.modify_message(message_id, add_labels=[label_id], remove_labels=list(remove_labels))
-        else:
-            raise ValueError(f"Unsupported label: {label_id}. Only INBOX, SPAM, and TRASH are supported.")
+        if label_id in cls.MOVE_LABELS:
+            remove_labels = [label for label in cls.MOVE_LABELS if label != label_id]
+            return [label_id], remove_labels
+        raise ValueError(f"Unsupported label: {label_id}. Only INBOX, SPAM, and TRASH are supported.")
@@ -0,0 +1,35 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List
+
+
+class HttpPool:
+    # Authorized HTTP transports shared by every thread of a GmailService. An httplib2
+    # transport must not be used by two threads at once, so each request borrows one,
+    # but it goes back to the pool with its connections still open: later requests,
+    # including those from the short-lived threads of the next fetch, reuse them
+    # instead of paying for a new TCP and TLS handshake. The pool grows to the
+    # highest number of concurrent requests and no further.
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self.created = 0
+        self._idle: List[Any] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        with self._lock:
+            # Most recently used first, as its connections are the least likely to have timed out.
+            http = self._idle.pop() if self._idle else None
+            if http is None:
+                self.created += 1
+        if http is None:
+            http = self.factory()
+        try:
+            yield http
+        finally:
+            with self._lock:
+                self._idle.append(http)
+
+    def idle_count(self) -> int:
+        return len(self._idle)
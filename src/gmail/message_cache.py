@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from src.data.record import EmailRecord
+from src.data.repository import EmailRepository
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FORMAT_FULL = 'full'
+
+
+def history_order(history_id: Optional[str]) -> int:
+    return int(history_id) if history_id else 0
+
+
+class RawMessageStore:
+    # messages.get payloads, zlib-compressed, one file per message and format. A full
+    # payload also answers metadata requests. Files are replaced atomically, so a run
+    # that crashes mid-write leaves the previous payload or none. With max_bytes set,
+    # the least recently written files are removed once the directory outgrows it.
+    def __init__(self, directory: str, level: int = 6, max_bytes: Optional[int] = None):
+        self.directory = directory
+        self.level = level
+        self.max_bytes = max_bytes
+        self._bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _path(self, message_id: str, message_format: str) -> Optional[str]:
+        # Gmail IDs are hex; anything else could escape the directory.
+        if not message_id.isalnum():
+            return None
+        return os.path.join(self.directory, message_id[-2:], f'{message_id}.{message_format}.json.z')
+
+    def get(self, message_id: str, message_format: str = FORMAT_FULL) -> Optional[dict]:
+        formats = (FORMAT_FULL,) if message_format == FORMAT_FULL else (FORMAT_FULL, message_format)
+        for stored_format in formats:
+            path = self._path(message_id, stored_format)
+            if path is None:
+                return None
+            try:
+                with open(path, 'rb') as f:
+                    return json.loads(zlib.decompress(f.read()))
+            except FileNotFoundError:
+                continue
+            except (OSError, zlib.error, ValueError) as e:
+                logger.warning(f"Ignoring unreadable cached message {path}: {e}")
+        return None
+
+    def put(self, message_id: str, message: dict, message_format: str = FORMAT_FULL) -> None:
+        path = self._path(message_id, message_format)
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        data = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'), self.level)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        if self.max_bytes is not None:
+            self._grow(len(data))
+
+    def _grow(self, size: int) -> None:
+        with self._lock:
+            # The directory is measured once, on the first write of the run.
+            if self._bytes is None:
+                self._bytes = sum(file_size for _, file_size, _ in self._files())
+            else:
+                self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._prune()
+
+    def _files(self) -> List[Tuple[float, int, str]]:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json.z'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _prune(self) -> None:
+        # Down to 90% of the limit, so that a full store is not rescanned on every write.
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+
+    def delete(self, message_id: str, older_than: Optional[int] = None) -> None:
+        for message_format in (FORMAT_FULL, 'metadata'):
+            path = self._path(message_id, message_format)
+            if path is None or not os.path.exists(path):
+                continue
+            if older_than is not None:
+                message = self.get(message_id, message_format) or {}
+                if history_order(message.get('historyId')) >= older_than:
+                    continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class MessageCache:
+    # Parsed messages in front of messages.get, keyed by Gmail message ID and tagged
+    # with the historyId they were fetched at. Lookups try an in-memory LRU, then the
+    # emails table; raw payloads missing from both come from the optional disk store
+    # before the network. Repeat passes over known messages therefore skip the
+    # download and the base64/MIME decode, and a run that crashed before storing what
+    # it fetched re-reads the payloads from disk. Gmail never changes a message's
+    # content, so stored rows stay valid; a newer historyId reported by history.list
+    # (see invalidate) drops the memory and disk entries of that message and bypasses
+    # its stored row until the message is fetched again. The LRU is bounded both by
+    # entries and by the total length of the bodies it holds.
+    def __init__(self, capacity: int = 1000, session_factory: Optional[Callable[[], Any]] = None,
+                 raw_store: Optional[RawMessageStore] = None, max_body_bytes: int = 64 * 1024 * 1024):
+        self.capacity = capacity
+        self.session_factory = session_factory
+        self.raw_store = raw_store
+        self.max_body_bytes = max_body_bytes
+        self._entries: 'OrderedDict[str, Tuple[int, EmailRecord, int]]' = OrderedDict()
+        self._body_bytes = 0
+        self._stale: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, message_ids: Iterable[str], with_body: bool = True) -> Dict[str, EmailRecord]:
+        # Records for the IDs that are known, with their bodies when with_body is set.
+        found: Dict[str, EmailRecord] = {}
+        missing: List[str] = []
+        with self._lock:
+            for message_id in message_ids:
+                entry = self._entries.get(message_id)
+                if entry is not None and (entry[1].body is not None or not with_body):
+                    self._entries.move_to_end(message_id)
+                    found[message_id] = entry[1]
+                elif message_id not in self._stale:
+                    missing.append(message_id)
+        self._count('memory', len(found))
+        if missing and self.session_factory is not None:
+            stored = self._load(missing, with_body)
+            for record in stored.values():
+                self.put(record)
+            found.update(stored)
+            self._count('database', len(stored))
+        return found
+
+    def _load(self, message_ids: List[str], with_body: bool) -> Dict[str, EmailRecord]:
+        # A session of its own, as fetches may run on several threads.
+        session = self.session_factory()
+        try:
+            records = EmailRepository(session).get_records(message_ids)
+        finally:
+            session.close()
+        return {message_id: record for message_id, record in records.items()
+                if record.body is not None or not with_body}
+
+    def put(self, record: EmailRecord, history_id: Optional[str] = None) -> None:
+        # Without a history_id the entry keeps the one it was cached with, e.g. when
+        # load_bodies fills in the body of a metadata record.
+        order = history_order(history_id)
+        size = len(record.body) if record.body else 0
+        with self._lock:
+            if order >= self._stale.get(record.message_id, order + 1):
+                del self._stale[record.message_id]
+            previous = self._entries.pop(record.message_id, None)
+            if previous is not None:
+                self._body_bytes -= previous[2]
+                if history_id is None:
+                    order = previous[0]
+            if self.capacity <= 0 or size > self.max_body_bytes:
+                return
+            self._entries[record.message_id] = (order, record, size)
+            self._body_bytes += size
+            while len(self._entries) > self.capacity or self._body_bytes > self.max_body_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._body_bytes -= evicted
+
+    def raw_messages(self, message_ids: Iterable[str], message_format: str = FORMAT_FULL) -> Dict[str, dict]:
+        if self.raw_store is None:
+            return {}
+        messages = {}
+        for message_id in message_ids:
+            message = self.raw_store.get(message_id, message_format)
+            if message is not None:
+                messages[message_id] = message
+        self._count('disk', len(messages))
+        return messages
+
+    def store_raw(self, messages: Dict[str, dict], message_format: str = FORMAT_FULL) -> None:
+        if self.raw_store is None:
+            return
+        for message_id, message in messages.items():
+            self.raw_store.put(message_id, message, message_format)
+
+    def invalidate(self, message_id: str, history_id: Optional[str]) -> None:
+        newer = history_order(history_id)
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is not None and entry[0] < newer:
+                del self._entries[message_id]
+                self._body_bytes -= entry[2]
+            if entry is None or entry[0] < newer:
+                self._stale[message_id] = max(newer, self._stale.get(message_id, 0))
+        if self.raw_store is not None:
+            self.raw_store.delete(message_id, older_than=newer)
+
+    @staticmethod
+    def _count(layer: str, hits: int) -> None:
+        if hits and metrics.enabled:
+            metrics.increment('message_cache_hits_total', hits, layer=layer)
@@ -0,0 +1,126 @@
+import base64
+import codecs
+from html.parser import HTMLParser
+from typing import Iterator, List, Optional, Union
+
+MIME_TYPE_PLAIN = 'text/plain'
+MIME_TYPE_HTML = 'text/html'
+DEFAULT_CHARSET = 'utf-8'
+DEFAULT_MAX_BODY_BYTES = 1024 * 1024
+
+Buffer = Union[bytes, memoryview]
+
+
+def iter_parts(payload: dict) -> Iterator[dict]:
+    # Depth-first, in document order, without recursion so deeply nested
+    # multipart/mixed -> alternative -> related trees cannot blow the stack.
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+
+def is_attachment(part: dict) -> bool:
+    if part.get('filename'):
+        return True
+    disposition = header_value(part, 'content-disposition') or ''
+    return disposition.lower().startswith('attachment')
+
+
+def header_value(part: dict, name: str) -> Optional[str]:
+    for header in part.get('headers', []):
+        if header['name'].lower() == name:
+            return header['value']
+    return None
+
+
+def part_charset(part: dict) -> str:
+    content_type = header_value(part, 'content-type') or ''
+    for parameter in content_type.split(';')[1:]:
+        key, _, value = parameter.partition('=')
+        if key.strip().lower() == 'charset':
+            return value.strip().strip('"\'') or DEFAULT_CHARSET
+    return DEFAULT_CHARSET
+
+
+def find_body_part(payload: dict, mime_type: str) -> Optional[dict]:
+    for part in iter_parts(payload):
+        if part.get('mimeType') == mime_type and not is_attachment(part) and part.get('body', {}).get('data'):
+            return part
+    return None
+
+
+def decode_data(data: str, max_bytes: Optional[int] = None) -> memoryview:
+    # Only the base64 needed for max_bytes is decoded; the result is sliced as a view.
+    if max_bytes is not None:
+        data = data[:-(-max_bytes // 3) * 4]
+    decoded = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    view = memoryview(decoded)
+    return view if max_bytes is None else view[:max_bytes]
+
+
+def decode_text(raw: Buffer, charset: str = DEFAULT_CHARSET, truncated: bool = False) -> str:
+    try:
+        decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder(DEFAULT_CHARSET)(errors='replace')
+    # A truncated body may end inside a multi-byte sequence; drop it instead of
+    # emitting a replacement character.
+    return decoder.decode(raw, final=not truncated)
+
+
+class _HtmlTextExtractor(HTMLParser):
+    SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+    BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'blockquote'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: List[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.chunks.append(data)
+
+
+def html_to_text(html: str) -> str:
+    extractor = _HtmlTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = (' '.join(line.split()) for line in ''.join(extractor.chunks).splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def extract_body(payload: dict, max_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES, html_fallback: bool = True) -> str:
+    part = find_body_part(payload, MIME_TYPE_PLAIN)
+    is_html = False
+    if part is None and html_fallback:
+        part = find_body_part(payload, MIME_TYPE_HTML)
+        is_html = part is not None
+    if part is None and not payload.get('parts') and payload.get('body', {}).get('data'):
+        # A single-part message is its own body whatever its type (text/calendar,
+        # or no mimeType at all).
+        part = payload
+    if part is None:
+        return ''
+    data = part['body']['data']
+    raw = decode_data(data, max_bytes)
+    truncated = max_bytes is not None and len(data) * 3 // 4 > max_bytes
+    text = decode_text(raw, part_charset(part), truncated)
+    return html_to_text(text) if is_html else text
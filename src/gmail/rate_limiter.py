@@ -0,0 +1,78 @@
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# Per-method cost in Gmail API quota units.
+QUOTA_UNITS: Dict[str, int] = {
+    'getProfile': 1,
+    'history.list': 2,
+    'labels.list': 1,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'messages.trash': 5,
+    'messages.untrash': 5,
+    'messages.delete': 10,
+    'messages.send': 100,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+# Re-running these leaves the mailbox in the same state, so they are safe to retry.
+IDEMPOTENT_METHODS = frozenset({
+    'getProfile', 'history.list', 'labels.list', 'messages.list', 'messages.get',
+    'messages.modify', 'messages.batchModify', 'messages.trash', 'messages.untrash',
+})
+
+
+def quota_units(method: str, count: int = 1) -> int:
+    return QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) * count
+
+
+class TokenBucket:
+    # Callers reserve units up front and sleep off any debt outside the lock, so
+    # concurrent workers queue fairly and the long-run rate never exceeds `rate`.
+    # throttle() halves the rate after the server pushes back; every success
+    # relaxes it additively towards the configured budget again.
+    RECOVERY_STEPS = 20
+    MIN_RATE_DIVISOR = 16
+
+    def __init__(self, rate: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        if rate <= 0:
+            raise ValueError(f"Invalid quota rate: {rate}")
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = self.max_rate / self.MIN_RATE_DIVISOR
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.units_consumed = 0
+        self.waited_seconds = 0.0
+        self.throttle_count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, units: int) -> float:
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            self.units_consumed += units
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited_seconds += delay
+        if delay:
+            self.sleep(delay)
+        return delay
+
+    def throttle(self) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.throttle_count += 1
+
+    def relax(self) -> None:
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / self.RECOVERY_STEPS)
@@ -1,57 +1,373 @@
+import argparse
 import logging
+import os
+import sys
+import time
 from contextlib import contextmanager
+from datetime import datetime, timezone
 from src.auth.gmail_authenticator import GmailAuthenticator, GmailServiceFactory
-from src.data.models import Base
-from src.data.repository import EmailRepository
-from src.gmail.gmail_service import GmailService
+from src.data.fulltext import create_fulltext_index
+from src.data.models import create_schema
+from src.data.repository import (MATCHABLE_COLUMNS, AppliedActionRepository, EmailRepository, ScheduleRepository,
+                                 SyncStateRepository)
+from src.gmail.gmail_service import GmailService, HistoryExpiredError
+from src.gmail.message_cache import MessageCache, RawMessageStore
+from src.gmail.rate_limiter import TokenBucket
+from src.metrics import metrics
+from src.pipeline import Pipeline, parse_workers
+from src.rules.action_planner import ActionPlanner
+from src.rules.dry_run import DryRun, default_workers
+from src.rules.rule_cache import RuleSetCache, RuleSetWatcher
 from src.rules.rule_processor import RuleProcessor, RuleMatcher
+from src.rules.scheduler import RuleScheduler
+from src.rules.sql_translator import UnsupportedConditionError, rule_to_sql
 from config.config import config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, true
 from sqlalchemy.orm import sessionmaker
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch Gmail messages and apply rules to them.")
+    parser.add_argument('--all', action='store_true',
+                        help="stream every message matching --query page by page instead of only the newest MAX_EMAILS")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only fetch messages added since the last saved history checkpoint (full sync if none or expired)")
+    parser.add_argument('--reprocess-archive', action='store_true',
+                        help="apply the rules to every stored email, letting the database select the matches")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="evaluate the rules over the stored emails and report what they would do, without calling Gmail")
+    parser.add_argument('--explain', help="with --dry-run, write one JSON line per matched email naming the deciding "
+                                          "condition of each matching rule to this file ('-' for stdout)")
+    parser.add_argument('--dry-run-workers', type=int, default=default_workers(),
+                        help="processes evaluating --dry-run pages (default: one per CPU)")
+    parser.add_argument('--rules', default=config['RULES_FILE'], help="rules file to use instead of RULES_FILE")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="replay only actions recorded as failed or left pending by an interrupted run")
+    parser.add_argument('--scheduled-only', action='store_true',
+                        help="only apply date rules to stored emails that crossed their thresholds, without syncing")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="run fetch, parse, persist and act as concurrent stages connected by bounded queues")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running: sync incrementally every DAEMON_INTERVAL seconds, reloading RULES_FILE when it changes")
+    parser.add_argument('--metrics', choices=['json', 'prometheus'], default=config['METRICS_FORMAT'] or None,
+                        help="record timing metrics and write them in this format at the end of the run")
+    parser.add_argument('--metrics-file', default=config['METRICS_FILE'] or None,
+                        help="file the metrics are written to (default: the log)")
+    parser.add_argument('--query', default=config['GMAIL_QUERY'], help="Gmail search query limiting the synced messages")
+    return parser.parse_args(argv)
+
+def create_session_factory(database_uri):
     engine = create_engine(
-        config['DATABASE_URI'],
+        database_uri,
         pool_size=10,
         max_overflow=20,
         pool_recycle=3600,
     )
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    create_schema(engine)
+    fulltext = create_fulltext_index(engine, config['FULLTEXT_INDEX'])
+    return sessionmaker(bind=engine), fulltext
+
+def create_rule_cache():
+    return RuleSetCache(config['RULES_CACHE_DIR'] or None)
+
+def create_rate_limiter():
+    if config['QUOTA_UNITS_PER_SECOND'] <= 0:
+        return None
+    return TokenBucket(config['QUOTA_UNITS_PER_SECOND'], config['QUOTA_BURST_UNITS'] or None)
+
+def create_message_cache(Session, account=None):
+    raw_store = None
+    if config['MESSAGE_CACHE_DIR']:
+        # Message IDs are only unique within a mailbox.
+        raw_store = RawMessageStore(os.path.join(config['MESSAGE_CACHE_DIR'], account or ''),
+                                    max_bytes=config['MESSAGE_CACHE_DIR_BYTES'] or None)
+    return MessageCache(config['MESSAGE_CACHE_SIZE'], session_factory=Session, raw_store=raw_store,
+                        max_body_bytes=config['MESSAGE_CACHE_BODY_BYTES'])
+
+def create_gmail_service(authenticator, message_cache=None):
+    gmail_api_service = GmailServiceFactory.create_service(authenticator)
+    return GmailService(
+        gmail_api_service,
+        batch_size=config['FETCH_BATCH_SIZE'],
+        concurrency=config['FETCH_CONCURRENCY'],
+        max_retries=config['FETCH_MAX_RETRIES'],
+        max_body_bytes=config['MAX_BODY_BYTES'] or None,
+        html_fallback=config['HTML_BODY_FALLBACK'],
+        rate_limiter=create_rate_limiter(),
+        http_factory=GmailServiceFactory.create_http_factory(authenticator),
+        cache=message_cache,
+    )
+
+def main(argv=None):
+    args = parse_args(argv)
+    Session, fulltext = create_session_factory(config['DATABASE_URI'])
+    if args.metrics:
+        metrics.enable()
 
     try:
+        if args.dry_run:
+            run_dry_run(args, Session, fulltext)
+            return
+
         logger.info("Authenticating...")
         authenticator = GmailAuthenticator(config)
-        gmail_api_service = GmailServiceFactory.create_service(authenticator)
+        gmail_service = create_gmail_service(authenticator, create_message_cache(Session))
 
-        gmail_service = GmailService(gmail_api_service)
+        action_planner = ActionPlanner(gmail_service)
+        rule_cache = create_rule_cache()
+        rule_processor = RuleProcessor.from_file(args.rules, action_planner, rule_cache)
 
-        rule_processor = RuleProcessor.from_file(config['RULES_FILE'], gmail_service)
+        if args.reprocess_archive:
+            with session_scope(Session) as session:
+                reprocess_archive(EmailRepository(session, fulltext),
+                                  rule_processor.with_action_log(AppliedActionRepository(session)))
+            logger.info("Rules Applied Successfully!")
+            return
 
-        logger.info("Fetching Emails...")
-        emails = gmail_service.fetch_emails(max_results=config['MAX_EMAILS'])
+        if args.retry_failed:
+            with session_scope(Session) as session:
+                retry_failed_actions(rule_processor.with_action_log(AppliedActionRepository(session)))
+            return
 
-        logger.info(f"Fetched {len(emails)} Emails")
+        if args.scheduled_only:
+            apply_date_rules(Session, fulltext, rule_processor)
+            return
 
-        logger.info("Initiating Rules Processor...")
-        with session_scope(Session) as session:
-            email_repo = EmailRepository(session)
-            for email in emails:
-                logger.info(f"Processing Email Subject: {email.subject}")
-                existing_email = email_repo.get_email_by_message_id(email.message_id)
-                if not existing_email:
-                    email_repo.add_email(email)
-                    rule_processor.process_email(email)
-        
+        if args.daemon:
+            run_daemon(args, Session, fulltext, gmail_service, RuleSetWatcher(args.rules, rule_cache),
+                       action_planner)
+        elif args.pipeline:
+            run_pipeline(args, Session, fulltext, gmail_service, rule_processor)
+        else:
+            run_sync(args, Session, fulltext, gmail_service, rule_processor)
+        if not args.daemon:
+            apply_date_rules(Session, fulltext, rule_processor)
+
+        limiter = gmail_service.rate_limiter
+        if limiter is not None:
+            logger.info(f"Used {limiter.units_consumed} quota units, waited {limiter.waited_seconds:.1f}s "
+                        f"for quota, throttled {limiter.throttle_count} times")
         logger.info("Rules Applied Successfully!")
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
     finally:
+        write_metrics(args)
         logger.info("All resources released. Terminated Successfully")
 
+def write_metrics(args):
+    if not args.metrics:
+        return
+    rendered = metrics.render(args.metrics)
+    if args.metrics_file:
+        # Replaced atomically so a Prometheus textfile collector never reads a partial file.
+        temporary = f"{args.metrics_file}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(rendered)
+        os.replace(temporary, args.metrics_file)
+        logger.info(f"Wrote {args.metrics} metrics to {args.metrics_file}")
+    else:
+        logger.info(f"Metrics:\n{rendered}")
+    for rule in metrics.top_rules(10):
+        logger.info(f"Rule '{rule['rule']}': {rule['seconds']:.4f}s over {rule['evaluations']} evaluations, "
+                    f"hit rate {rule['hit_rate']:.1%}")
+
+def run_daemon(args, Session, fulltext, gmail_service, watcher, action_planner, max_cycles=None):
+    args = argparse.Namespace(**dict(vars(args), incremental=True))
+    logger.info(f"Running as a daemon, syncing every {config['DAEMON_INTERVAL']}s and watching {watcher.rules_file}")
+    cycles = 0
+    try:
+        while max_cycles is None or cycles < max_cycles:
+            watcher.poll()
+            # Each cycle keeps the matcher it started with; a reload applies from the next one.
+            rule_processor = RuleProcessor(watcher.matcher, action_planner)
+            try:
+                if args.pipeline:
+                    run_pipeline(args, Session, fulltext, gmail_service, rule_processor)
+                else:
+                    run_sync(args, Session, fulltext, gmail_service, rule_processor)
+                apply_date_rules(Session, fulltext, rule_processor)
+            except Exception as e:
+                logger.error(f"Sync cycle failed: {str(e)}")
+            cycles += 1
+            write_metrics(args)
+            if max_cycles is None or cycles < max_cycles:
+                wait_for_next_cycle(watcher)
+    except KeyboardInterrupt:
+        logger.info("Daemon stopped")
+
+def wait_for_next_cycle(watcher):
+    deadline = time.monotonic() + config['DAEMON_INTERVAL']
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(config['RULES_POLL_SECONDS'], remaining))
+        watcher.poll()
+
+def run_sync(args, Session, fulltext, gmail_service, rule_processor, account=SyncStateRepository.DEFAULT_ACCOUNT):
+    logger.info("Initiating Rules Processor...")
+    total = 0
+    with session_scope(Session) as session:
+        email_repo = EmailRepository(session, fulltext)
+        sync_repo = SyncStateRepository(session)
+        rule_processor = rule_processor.with_action_log(AppliedActionRepository(session))
+
+        logger.info("Fetching Emails...")
+        id_pages, checkpoint = sync_message_ids(args, gmail_service, sync_repo, account)
+        for message_ids in id_pages:
+            emails = fetch_new_emails(message_ids, email_repo, gmail_service, rule_processor.rule_matcher)
+            logger.info(f"Fetched {len(emails)} new of {len(message_ids)} listed Emails")
+            total += len(emails)
+            process_emails(emails, email_repo, rule_processor)
+
+        save_checkpoint(sync_repo, checkpoint, gmail_service, account)
+    logger.info(f"Processed {total} Emails")
+    return total
+
+def run_pipeline(args, Session, fulltext, gmail_service, rule_processor):
+    logger.info("Initiating Pipeline...")
+    with session_scope(Session) as session:
+        sync_repo = SyncStateRepository(session)
+        id_pages, checkpoint = sync_message_ids(args, gmail_service, sync_repo)
+        pipeline = Pipeline(
+            gmail_service,
+            Session,
+            rule_processor.rule_matcher,
+            workers=parse_workers(config['PIPELINE_WORKERS']),
+            queue_size=config['PIPELINE_QUEUE_SIZE'],
+            fulltext=fulltext,
+            lazy_bodies=config['FETCH_BODIES'] != 'always',
+            action_log=True,
+        )
+        report = pipeline.run(id_pages)
+        save_checkpoint(sync_repo, checkpoint, gmail_service)
+    logger.info(f"Pipeline finished in {pipeline.elapsed:.2f}s")
+    for stats in report.values():
+        logger.info(
+            f"Stage {stats['stage']}: {stats['items']} items in {stats['batches']} batches, "
+            f"{stats['items_per_second']}/s overall, {stats['items_per_busy_second']}/s busy, "
+            f"queue depth max {stats['max_queue_depth']} avg {stats['avg_queue_depth']}"
+        )
+
+def save_checkpoint(sync_repo, checkpoint, gmail_service, account=SyncStateRepository.DEFAULT_ACCOUNT):
+    if checkpoint and gmail_service.unfetched_ids:
+        # The next incremental run starts from the old checkpoint and lists them again.
+        logger.warning(f"Keeping the history checkpoint: {len(gmail_service.unfetched_ids)} messages could not be fetched")
+    elif checkpoint:
+        sync_repo.save_history_id(checkpoint, account)
+        logger.info(f"Saved history checkpoint {checkpoint}")
+
+def sync_message_ids(args, gmail_service, sync_repo, account=SyncStateRepository.DEFAULT_ACCOUNT):
+    page_size = config['PAGE_SIZE']
+    gmail_service.unfetched_ids.clear()
+    max_results = None if args.all else config['MAX_EMAILS']
+    if args.incremental:
+        start_history_id = sync_repo.get_history_id(account)
+        if start_history_id:
+            try:
+                message_ids, checkpoint = gmail_service.get_history_changes(
+                    start_history_id, label_id=config['HISTORY_LABEL'] or None)
+                if args.query and message_ids:
+                    # history.list knows nothing of the query the full sync lists with.
+                    message_ids = gmail_service.filter_by_query(message_ids, args.query)
+                logger.info(f"Incremental sync: {len(message_ids)} messages added since history {start_history_id}")
+                pages = (message_ids[start:start + page_size] for start in range(0, len(message_ids), page_size))
+                return pages, checkpoint
+            except HistoryExpiredError:
+                logger.warning(f"History {start_history_id} expired, falling back to a full sync")
+        # Capture the checkpoint before listing so nothing added during the full
+        # sync is missed by the next incremental run.
+        checkpoint = gmail_service.get_history_id()
+        # Messages beyond MAX_EMAILS would otherwise be skipped by every later incremental run.
+        max_results = None
+    else:
+        checkpoint = None
+    return gmail_service.iter_message_ids(query=args.query, page_size=page_size, max_results=max_results), checkpoint
+
+def fetch_new_emails(message_ids, email_repo, gmail_service, rule_matcher):
+    existing = email_repo.existing_message_ids(message_ids)
+    new_ids = [message_id for message_id in message_ids if message_id not in existing]
+    if config['FETCH_BODIES'] == 'always':
+        return gmail_service.get_emails(new_ids)
+    # Headers are enough for most rules; bodies are only downloaded for emails whose
+    # outcome still depends on a body condition.
+    emails = gmail_service.get_emails(new_ids, GmailService.FORMAT_METADATA)
+    if 'body' in rule_matcher.referenced_fields:
+        gmail_service.load_bodies([email for email in emails if rule_matcher.needs_body(email)])
+    return emails
+
+def process_emails(emails, email_repo, rule_processor):
+    new_emails = email_repo.add_new_emails(emails, commit=False)
+    for email in new_emails:
+        logger.info(f"Processing Email Subject: {email.subject}")
+    rule_processor.process_emails(new_emails)
+    # The emails and their pending actions are committed together: once an email is
+    # stored (and so skipped by later syncs) its actions can always be replayed.
+    rule_processor.record_pending(commit=False)
+    email_repo.session.commit()
+    logger.info(f"Stored {len(new_emails)} new Emails")
+    logger.info(f"Applying label changes to {rule_processor.action_planner.pending_count()} Emails...")
+    rule_processor.flush()
+
+def reprocess_archive(email_repo, rule_processor):
+    now = datetime.now(timezone.utc)
+    for rule in rule_processor.rule_matcher.rules:
+        matched = 0
+        for rows in archive_matches(email_repo, rule_processor.rule_matcher, rule, now):
+            rule_processor.apply_rule(rule, rows)
+            matched += len(rows)
+            rule_processor.flush()
+        logger.info(f"Rule '{rule.get('name')}' matched {matched} archived Emails")
+
+def archive_matches(email_repo, rule_matcher, rule, now):
+    try:
+        criterion = rule_to_sql(rule, now, email_repo.fulltext)
+    except UnsupportedConditionError:
+        # Regex and list predicates have no SQL form, so such rules are matched in
+        # Python over every stored email, a page at a time.
+        for rows in email_repo.iter_matching_rows(true(), columns=MATCHABLE_COLUMNS):
+            matches = rule_matcher.select(rule, rows, now)
+            if matches:
+                yield matches
+        return
+    yield from email_repo.iter_matching_rows(criterion)
+
+def run_dry_run(args, Session, fulltext):
+    rule_matcher = create_rule_cache().load_matcher(args.rules)
+    explain = None
+    if args.explain:
+        explain = sys.stdout if args.explain == '-' else open(args.explain, 'w')
+    try:
+        dry_run = DryRun(rule_matcher, args.dry_run_workers, explain)
+        with session_scope(Session) as session:
+            report = dry_run.run(EmailRepository(session, fulltext).iter_email_rows(1000))
+    finally:
+        if explain is not None and explain is not sys.stdout:
+            explain.close()
+    for line in dry_run.summary(report):
+        logger.info(line)
+    return report
+
+def apply_date_rules(Session, fulltext, rule_processor):
+    scheduler = RuleScheduler(rule_processor.rule_matcher)
+    if not scheduler.date_rules:
+        return 0
+    with session_scope(Session) as session:
+        schedule_repo = ScheduleRepository(session)
+        scheduled, applied = scheduler.tick(EmailRepository(session, fulltext), schedule_repo,
+                                            rule_processor.with_action_log(AppliedActionRepository(session)))
+        logger.info(f"Date rules: scheduled {scheduled} new due times, applied {applied} that came due, "
+                    f"{schedule_repo.pending_count()} pending")
+    return applied
+
+def retry_failed_actions(rule_processor):
+    replayed = rule_processor.retry_failed()
+    counts = rule_processor.action_log.status_counts()
+    logger.info(f"Replayed {replayed} actions; action log now has "
+                + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+
 @contextmanager
 def session_scope(Session):
     session = Session()
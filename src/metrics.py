@@ -0,0 +1,196 @@
+import functools
+import json
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Seconds; wide enough for microsecond rule evaluations and multi-second API retries.
+DEFAULT_BUCKETS = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the q-th observation, None past the last bucket.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index]
+        return None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class MetricsRegistry:
+    # Disabled by default. Instrumented code checks `metrics.enabled` (or goes
+    # through timed()/observe()/increment(), which return immediately) so a run
+    # without metrics pays one attribute lookup per call site.
+    def __init__(self):
+        self.enabled = False
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._by_token: Dict[Tuple, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+            self._by_token = {}
+
+    def histogram(self, name: str, **labels: Any) -> Histogram:
+        key = label_key(labels)
+        series = self._histograms.get(name)
+        histogram = series.get(key) if series is not None else None
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, {}).setdefault(key, Histogram())
+        return histogram
+
+    def lookup(self, token: Tuple, name: str, labels: Callable[[], Dict[str, Any]]) -> Histogram:
+        # For hot loops: a cheap caller-chosen token finds the series without
+        # building and sorting its labels on every observation.
+        histogram = self._by_token.get(token)
+        if histogram is None:
+            histogram = self._by_token[token] = self.histogram(name, **labels())
+        return histogram
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels: Any) -> None:
+        if self.enabled:
+            key = label_key(labels)
+            with self._lock:
+                series = self._counters.setdefault(name, {})
+                series[key] = series.get(key, 0) + amount
+
+    def timed(self, name: str, **labels: Any) -> Callable[[Callable], Callable]:
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.histogram(name, **labels).observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def counter_value(self, name: str, **labels: Any) -> float:
+        return self._counters.get(name, {}).get(label_key(labels), 0)
+
+    def top_rules(self, limit: int = 10) -> List[Dict[str, Any]]:
+        hits = self._counters.get('rule_hits_total', {})
+        rules = []
+        for key, histogram in self._histograms.get('rule_evaluation_seconds', {}).items():
+            labels = dict(key)
+            rules.append({
+                'rule': labels.get('rule'),
+                'index': int(labels.get('index', -1)),
+                'evaluations': histogram.count,
+                'seconds': round(histogram.sum, 6),
+                'avg_seconds': round(histogram.sum / histogram.count, 9) if histogram.count else 0.0,
+                'hit_rate': round(hits.get(key, 0) / histogram.count, 4) if histogram.count else 0.0,
+            })
+        return sorted(rules, key=lambda rule: rule['seconds'], reverse=True)[:limit]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'histograms': {
+                name: [dict(labels=dict(key), **histogram.as_dict()) for key, histogram in series.items()]
+                for name, series in sorted(self._histograms.items())
+            },
+            'counters': {
+                name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                for name, series in sorted(self._counters.items())
+            },
+            'top_rules': self.top_rules(),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(series.items()):
+                lines.append(f'{name}{format_labels(key)} {value}')
+        for name, series in sorted(self._histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(key, ("le", repr(bound)))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(key, ("le", "+Inf"))} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(key)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def render(self, output_format: str) -> str:
+        if output_format == 'json':
+            return self.to_json()
+        if output_format == 'prometheus':
+            return self.to_prometheus()
+        raise ValueError(f"Invalid metrics format: {output_format}")
+
+
+metrics = MetricsRegistry()
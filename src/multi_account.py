@@ -0,0 +1,116 @@
+import argparse
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, List, NamedTuple, Optional
+from config.config import config
+from src.auth.gmail_authenticator import GmailAuthenticator
+from src.main import (apply_date_rules, create_gmail_service, create_message_cache, create_rule_cache,
+                      create_session_factory, parse_args, run_sync)
+from src.rules.action_planner import ActionPlanner
+from src.rules.rule_processor import RuleProcessor
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_PLACEHOLDER = '{account}'
+# Single-account flags the workers honour; any other is rejected rather than ignored.
+SUPPORTED_FLAGS = ('all', 'incremental', 'query', 'rules')
+
+
+class AccountResult(NamedTuple):
+    account: str
+    processed: int
+    seconds: float
+    error: Optional[str] = None
+
+
+def read_account_list(path: str) -> List[str]:
+    with open(path, 'r') as f:
+        lines = (line.strip() for line in f)
+        token_files = [line for line in lines if line and not line.startswith('#')]
+    names = [account_name(token_file) for token_file in token_files]
+    duplicates = sorted({token_file for token_file, name in zip(token_files, names) if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Accounts listed more than once in {path}: {', '.join(duplicates)}")
+    return token_files
+
+
+def account_name(token_file: str) -> str:
+    # The token file name plus a hash of its full path, since accounts are often kept
+    # as dir/token.json: the name keys the account's database, sync checkpoint and caches.
+    path = os.path.realpath(token_file)
+    digest = hashlib.sha256(path.encode('utf-8')).hexdigest()[:8]
+    return f"{os.path.splitext(os.path.basename(path))[0]}-{digest}"
+
+
+def unsupported_flags(args: argparse.Namespace) -> List[str]:
+    defaults = vars(parse_args([]))
+    return ['--' + name.replace('_', '-') for name, value in vars(args).items()
+            if name not in SUPPORTED_FLAGS and value != defaults.get(name)]
+
+
+def process_account(token_file: str, argv: List[str]) -> AccountResult:
+    # Runs in a worker process: every account gets its own credentials, Gmail client,
+    # DB engine/session and compiled rules, and failures are reported, not raised.
+    account = account_name(token_file)
+    started = time.monotonic()
+    try:
+        args = parse_args(argv)
+        Session, fulltext = create_session_factory(config['DATABASE_URI'].replace(ACCOUNT_PLACEHOLDER, account))
+        authenticator = GmailAuthenticator(config, token_file=token_file, interactive=False)
+        gmail_service = create_gmail_service(authenticator, create_message_cache(Session, account))
+        action_planner = ActionPlanner(gmail_service)
+        rule_processor = RuleProcessor.from_file(args.rules, action_planner, create_rule_cache())
+        processed = run_sync(args, Session, fulltext, gmail_service, rule_processor, account=account)
+        apply_date_rules(Session, fulltext, rule_processor)
+        return AccountResult(account, processed, time.monotonic() - started)
+    except Exception as e:
+        logger.error(f"Account {account} failed: {str(e)}")
+        return AccountResult(account, 0, time.monotonic() - started, f"{type(e).__name__}: {e}")
+
+
+def run_accounts(token_files: List[str], argv: List[str], workers: Optional[int] = None,
+                 worker: Callable[[str, List[str]], AccountResult] = process_account) -> List[AccountResult]:
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(worker, token_file, argv): token_file for token_file in token_files}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # Only reached when the worker process itself died.
+                result = AccountResult(account_name(futures[future]), 0, 0.0, f"{type(e).__name__}: {e}")
+            logger.info(f"Account {result.account}: {result.processed} Emails in {result.seconds:.1f}s"
+                        + (f" FAILED ({result.error})" if result.error else ""))
+            results.append(result)
+    return sorted(results, key=lambda result: result.account)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process many Gmail accounts in parallel worker processes.")
+    parser.add_argument('accounts_file', help="file listing one token.json path per account")
+    parser.add_argument('--workers', type=int, default=config['ACCOUNT_WORKERS'] or None,
+                        help="number of worker processes (default: number of CPUs)")
+    args, sync_argv = parser.parse_known_args(argv)
+    unsupported = unsupported_flags(parse_args(sync_argv))
+    if unsupported:
+        parser.error(f"not supported with multiple accounts: {', '.join(unsupported)}")
+
+    token_files = read_account_list(args.accounts_file)
+    if ACCOUNT_PLACEHOLDER not in config['DATABASE_URI']:
+        logger.warning(f"DATABASE_URI has no {ACCOUNT_PLACEHOLDER} placeholder, all accounts share one database")
+    logger.info(f"Processing {len(token_files)} accounts...")
+    started = time.monotonic()
+    results = run_accounts(token_files, sync_argv, args.workers)
+    failed = [result for result in results if result.error]
+    logger.info(f"Processed {sum(result.processed for result in results)} Emails across {len(results)} accounts "
+                f"in {time.monotonic() - started:.1f}s, {len(failed)} failed")
+    for result in failed:
+        logger.error(f"Account {result.account} failed: {result.error}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+from src.data.record import EmailRecord
+from src.data.repository import AppliedActionRepository, EmailRepository
+from src.gmail.gmail_service import GmailService
+from src.metrics import metrics
+from src.rules.action_planner import ActionPlanner
+from src.rules.rule_processor import RuleMatcher, RuleProcessor
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('list', 'fetch', 'parse', 'persist', 'act')
+DEFAULT_WORKERS = {'list': 1, 'fetch': 4, 'parse': 2, 'persist': 1, 'act': 2}
+
+_DONE = object()
+
+
+def parse_workers(spec: Optional[str]) -> Dict[str, int]:
+    workers = dict(DEFAULT_WORKERS)
+    for item in filter(None, (spec or '').split(',')):
+        stage, _, count = item.partition('=')
+        stage = stage.strip()
+        if stage not in STAGES or stage == 'list':
+            raise ValueError(f"Invalid pipeline stage: {stage}")
+        workers[stage] = max(1, int(count))
+    return workers
+
+
+class StageStats:
+    __slots__ = ('name', 'batches', 'items', 'busy_seconds', 'max_queue_depth', 'queue_depth_total', 'queue_samples')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.queue_depth_total = 0
+        self.queue_samples = 0
+
+    def sample_queue(self, depth: int) -> None:
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self.queue_depth_total += depth
+        self.queue_samples += 1
+
+    def record(self, items: int, seconds: float) -> None:
+        self.batches += 1
+        self.items += items
+        self.busy_seconds += seconds
+        metrics.observe('pipeline_stage_seconds', seconds, stage=self.name)
+
+    def as_dict(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            'stage': self.name,
+            'batches': self.batches,
+            'items': self.items,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'items_per_second': round(self.items / elapsed, 1) if elapsed else 0.0,
+            'items_per_busy_second': round(self.items / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+            'max_queue_depth': self.max_queue_depth,
+            'avg_queue_depth': round(self.queue_depth_total / self.queue_samples, 2) if self.queue_samples else 0.0,
+        }
+
+
+class PlannedEmails(list):
+    # The new emails of a persisted batch, with the RuleProcessor holding their queued actions.
+    def __init__(self, emails: List[Any], rule_processor: RuleProcessor):
+        super().__init__(emails)
+        self.rule_processor = rule_processor
+
+
+class Pipeline:
+    # Bounded asyncio queues connect the stages, so a slow stage back-pressures the
+    # ones before it. Blocking Gmail/DB calls run on threads (the GmailService needs an
+    # http_factory to be used concurrently); persister workers each get a dedicated
+    # thread and session because DB connections are thread-bound.
+    def __init__(self, gmail_service: Any, session_factory: Callable[[], Any], rule_matcher: RuleMatcher,
+                 workers: Optional[Dict[str, int]] = None, queue_size: int = 8, fulltext: Any = None,
+                 lazy_bodies: bool = False, action_log: bool = False):
+        self.gmail_service = gmail_service
+        self.session_factory = session_factory
+        self.rule_matcher = rule_matcher
+        self.workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        self.queue_size = queue_size
+        self.fulltext = fulltext
+        self.message_format = GmailService.FORMAT_METADATA if lazy_bodies else GmailService.FORMAT_FULL
+        self.action_log = action_log
+        self.stats = {stage: StageStats(stage) for stage in STAGES}
+        self.elapsed = 0.0
+        self._cleanups: List[Callable[[], None]] = []
+
+    def run(self, id_pages: Iterator[List[str]]) -> Dict[str, Dict[str, Any]]:
+        return asyncio.run(self.run_async(id_pages))
+
+    async def run_async(self, id_pages: Iterator[List[str]]) -> Dict[str, Dict[str, Any]]:
+        started = time.monotonic()
+        queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in STAGES[1:]}
+        io_executor = ThreadPoolExecutor(max_workers=self.workers['fetch'] + self.workers['act'] + 1)
+        cpu_executor = ThreadPoolExecutor(max_workers=self.workers['parse'])
+        try:
+            await asyncio.gather(
+                self._list(id_pages, queues['fetch'], io_executor),
+                self._stage('fetch', queues['fetch'], queues['parse'],
+                            lambda: self._in_executor(io_executor, self._fetch)),
+                self._stage('parse', queues['parse'], queues['persist'],
+                            lambda: self._in_executor(cpu_executor, self._parse)),
+                self._stage('persist', queues['persist'], queues['act'], self._persister),
+                self._stage('act', queues['act'], None, lambda: self._actor(io_executor)),
+            )
+        finally:
+            for cleanup in self._cleanups:
+                cleanup()
+            io_executor.shutdown(wait=True)
+            cpu_executor.shutdown(wait=True)
+        self.elapsed = time.monotonic() - started
+        return self.report()
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        return {stage: stats.as_dict(self.elapsed) for stage, stats in self.stats.items()}
+
+    async def _list(self, id_pages: Iterator[List[str]], outbox: asyncio.Queue, executor: ThreadPoolExecutor) -> None:
+        loop = asyncio.get_running_loop()
+        stats = self.stats['list']
+        iterator = iter(id_pages)
+        while True:
+            start = time.monotonic()
+            message_ids = await loop.run_in_executor(executor, next, iterator, None)
+            if message_ids is None:
+                break
+            stats.record(len(message_ids), time.monotonic() - start)
+            await outbox.put(message_ids)
+        await outbox.put(_DONE)
+
+    async def _stage(self, name: str, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue],
+                     make_handler: Callable[[], Awaitable[Callable[[Any], Awaitable[List[Any]]]]]) -> None:
+        stats = self.stats[name]
+
+        async def worker() -> None:
+            handler = await make_handler()
+            while True:
+                stats.sample_queue(inbox.qsize())
+                batch = await inbox.get()
+                if batch is _DONE:
+                    await inbox.put(_DONE)
+                    return
+                start = time.monotonic()
+                result = await handler(batch)
+                stats.record(len(batch), time.monotonic() - start)
+                if outbox is not None and result:
+                    await outbox.put(result)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers[name])))
+        if outbox is not None:
+            await outbox.put(_DONE)
+
+    async def _in_executor(self, executor: ThreadPoolExecutor, func: Callable[[Any], Any]):
+        loop = asyncio.get_running_loop()
+
+        async def handler(batch: Any) -> Any:
+            return await loop.run_in_executor(executor, func, batch)
+        return handler
+
+    def _fetch(self, message_ids: List[str]) -> List[tuple]:
+        # Messages in the service's cache pass through already parsed.
+        cached = self.gmail_service.cached_emails(message_ids, self.message_format)
+        missing = [message_id for message_id in message_ids if message_id not in cached]
+        messages = self.gmail_service.fetch_messages(missing, self.message_format) if missing else {}
+        messages.update(cached)
+        return [(message_id, messages[message_id]) for message_id in message_ids if message_id in messages]
+
+    def _parse(self, messages: List[tuple]) -> List[Any]:
+        emails = [
+            message if isinstance(message, EmailRecord)
+            else self.gmail_service.parse_message(message_id, message, self.message_format)
+            for message_id, message in messages
+        ]
+        if self.message_format == GmailService.FORMAT_METADATA and 'body' in self.rule_matcher.referenced_fields:
+            self.gmail_service.load_bodies([email for email in emails if self.rule_matcher.needs_body(email)])
+        return emails
+
+    async def _session_thread(self):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        session = await loop.run_in_executor(executor, self.session_factory)
+
+        def cleanup() -> None:
+            executor.submit(session.close).result()
+            executor.shutdown(wait=True)
+        self._cleanups.append(cleanup)
+        return executor, session
+
+    async def _persister(self):
+        loop = asyncio.get_running_loop()
+        executor, session = await self._session_thread()
+        email_repo = EmailRepository(session, self.fulltext)
+        action_log = AppliedActionRepository(session) if self.action_log else None
+
+        def persist(emails: List[Any]) -> Optional[PlannedEmails]:
+            # Rules run here so that new emails and their pending actions are committed
+            # together; the act stage only sends the label changes.
+            new_emails = email_repo.add_new_emails(emails, commit=False)
+            rule_processor = RuleProcessor(self.rule_matcher, ActionPlanner(self.gmail_service), action_log)
+            rule_processor.process_emails(new_emails)
+            rule_processor.record_pending(commit=False)
+            session.commit()
+            return PlannedEmails(new_emails, rule_processor) if new_emails else None
+
+        async def handler(emails: List[Any]) -> Optional[PlannedEmails]:
+            return await loop.run_in_executor(executor, persist, emails)
+        return handler
+
+    async def _actor(self, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        action_log = None
+        if self.action_log:
+            # Outcomes are written next to the flush, on the actor's own session thread.
+            executor, session = await self._session_thread()
+            action_log = AppliedActionRepository(session)
+
+        def flush(planned: PlannedEmails) -> None:
+            rule_processor = planned.rule_processor
+            if action_log is not None:
+                rule_processor = rule_processor.with_action_log(action_log)
+            rule_processor.flush()
+
+        async def handler(planned: PlannedEmails) -> None:
+            await loop.run_in_executor(executor, flush, planned)
+        return handler
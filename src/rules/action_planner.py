@@ -0,0 +1,57 @@
+from typing import Any, Dict, FrozenSet, List, Set, Tuple
+from src.gmail.gmail_service import GmailService
+from src.metrics import metrics
+
+LabelDelta = Tuple[FrozenSet[str], FrozenSet[str]]
+
+class ActionPlanner:
+    # Stands in for GmailService while rules run: label changes are collected per
+    # message (last change to a label wins) and flushed as batchModify calls, one
+    # per distinct label delta and chunk of message IDs.
+    def __init__(self, gmail_service: Any):
+        self.gmail_service = gmail_service
+        self._changes: Dict[str, Dict[str, bool]] = {}
+        self.failed_message_ids: Set[str] = set()
+
+    def mark_as_read(self, message_id: str) -> None:
+        self.modify_message(message_id, remove_labels=['UNREAD'])
+
+    def mark_as_unread(self, message_id: str) -> None:
+        self.modify_message(message_id, add_labels=['UNREAD'])
+
+    def move_message(self, message_id: str, label_id: str) -> None:
+        add_labels, remove_labels = GmailService.move_labels(label_id)
+        self.modify_message(message_id, add_labels=add_labels, remove_labels=remove_labels)
+
+    def modify_message(self, message_id: str, add_labels: List[str] = None, remove_labels: List[str] = None) -> None:
+        changes = self._changes.setdefault(message_id, {})
+        for label in remove_labels or []:
+            changes[label] = False
+        for label in add_labels or []:
+            changes[label] = True
+
+    def plan(self) -> Dict[LabelDelta, List[str]]:
+        groups: Dict[LabelDelta, List[str]] = {}
+        for message_id, changes in self._changes.items():
+            add_labels = frozenset(label for label, add in changes.items() if add)
+            remove_labels = frozenset(label for label, add in changes.items() if not add)
+            if add_labels or remove_labels:
+                groups.setdefault((add_labels, remove_labels), []).append(message_id)
+        return groups
+
+    def pending_count(self) -> int:
+        return len(self._changes)
+
+    @metrics.timed('action_flush_seconds')
+    def flush(self) -> int:
+        groups = self.plan()
+        self._changes = {}
+        self.failed_message_ids = set()
+        for (add_labels, remove_labels), message_ids in groups.items():
+            failed = self.gmail_service.batch_modify_messages(
+                message_ids,
+                add_labels=sorted(add_labels),
+                remove_labels=sorted(remove_labels)
+            )
+            self.failed_message_ids.update(failed or [])
+        return len(groups)
@@ -1,5 +1,7 @@
+import time
 from enum import Enum, auto
 from src.data.models import Email
+from src.metrics import metrics
 from typing import Any, Dict
 
 class Action(Enum):
@@ -33,4 +35,9 @@ def apply_action(action: Action, email: Email, gmail_service: Any, parameters: D
     action_func = ACTION_FUNCTIONS.get(action)
     if not action_func:
         raise ValueError(f"Invalid action: {action}")
-    action_func(email, gmail_service, parameters)
\ No newline at end of file
+    if not metrics.enabled:
+        action_func(email, gmail_service, parameters)
+        return
+    start = time.perf_counter()
+    action_func(email, gmail_service, parameters)
+    metrics.observe('apply_action_seconds', time.perf_counter() - start, action=action.name)
\ No newline at end of file
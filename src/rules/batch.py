@@ -0,0 +1,178 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from src.data.record import MATCH_ATTRIBUTES, as_record
+from src.rules.predicates import Predicate
+
+COLUMN_SEPARATOR = '\x00'
+_BIT_CHARS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def rows_to_mask(rows: Sequence[int], size: int) -> int:
+    if len(rows) < 64:
+        mask = 0
+        for row in rows:
+            mask |= 1 << row
+        return mask
+    bits = bytearray(size)
+    for row in rows:
+        bits[row] = 1
+    return flags_to_mask(bits)
+
+
+def flags_to_mask(flags: bytearray) -> int:
+    if not flags:
+        return 0
+    return int(bytes(flags).translate(_BIT_CHARS)[::-1], 2)
+
+
+def mask_to_flags(mask: int, size: int) -> List[bool]:
+    if not size:
+        return []
+    return [bit == '1' for bit in format(mask, f'0{size}b')[::-1]]
+
+
+class EmailBatch:
+    # Columnar view over a batch of emails. Every condition is evaluated once across
+    # the whole batch and the result is kept as an int bitmask (bit i = email i).
+    def __init__(self, emails: Sequence[Any], now: Optional[datetime] = None):
+        self.emails = [as_record(email) for email in emails]
+        self.size = len(emails)
+        self.full_mask = (1 << self.size) - 1
+        self.now = now or datetime.now(timezone.utc)
+        self._joined: Dict[str, Optional[Tuple[str, List[int]]]] = {}
+        self._values: Dict[str, Dict[str, List[int]]] = {}
+        self._timestamps: Dict[str, Tuple[List[float], Optional[List[float]], bool]] = {}
+        self._masks: Dict[Tuple[str, str, str], int] = {}
+
+    def _lowered_column(self, field: str) -> List[str]:
+        return [getattr(record, MATCH_ATTRIBUTES[field]) for record in self.emails]
+
+    def _joined_column(self, field: str) -> Optional[Tuple[str, List[int]]]:
+        # None when a value contains the separator itself (decoded bodies can).
+        if field not in self._joined:
+            values = self._lowered_column(field)
+            starts = []
+            offset = 0
+            for value in values:
+                starts.append(offset)
+                offset += len(value) + 1
+            text = COLUMN_SEPARATOR.join(values)
+            self._joined[field] = (text, starts) if text.count(COLUMN_SEPARATOR) == len(values) - 1 else None
+        return self._joined[field]
+
+    def contains_mask(self, field: str, needle: str) -> int:
+        needle = needle.lower()
+        if not needle:
+            return self.full_mask
+        joined = self._joined_column(field) if COLUMN_SEPARATOR not in needle else None
+        if joined is None:
+            return flags_to_mask(bytearray(needle in value for value in self._lowered_column(field)))
+        text, starts = joined
+        rows = []
+        position = text.find(needle)
+        while position != -1:
+            row = bisect_right(starts, position) - 1
+            rows.append(row)
+            if row + 1 >= self.size:
+                break
+            position = text.find(needle, starts[row + 1])
+        return rows_to_mask(rows, self.size)
+
+    def equals_mask(self, field: str, value: str) -> int:
+        values = self._values.get(field)
+        if values is None:
+            values = self._values[field] = {}
+            for row, lowered in enumerate(self._lowered_column(field)):
+                values.setdefault(lowered, []).append(row)
+        return rows_to_mask(values.get(value.lower(), ()), self.size)
+
+    def _timestamp_column(self, field: str) -> Tuple[List[float], Optional[List[float]], bool]:
+        column = self._timestamps.get(field)
+        if column is None:
+            timestamps = [getattr(record, MATCH_ATTRIBUTES[field]) for record in self.emails]
+            # Archives are read in date order and Gmail lists newest first, so the
+            # column is usually sorted and age cutoffs reduce to a bisect.
+            if all(a <= b for a, b in zip(timestamps, timestamps[1:])):
+                column = (timestamps, timestamps, False)
+            elif all(a >= b for a, b in zip(timestamps, timestamps[1:])):
+                column = (timestamps, timestamps[::-1], True)
+            else:
+                column = (timestamps, None, False)
+            self._timestamps[field] = column
+        return column
+
+    def _prefix_mask(self, count: int, from_end: bool) -> int:
+        if from_end:
+            return self.full_mask ^ ((1 << (self.size - count)) - 1)
+        return (1 << count) - 1
+
+    def age_mask(self, field: str, condition_value: str, older: bool) -> int:
+        timestamps, ascending, descending = self._timestamp_column(field)
+        cutoff = (self.now - Predicate.parse_time_value(condition_value)).timestamp()
+        if ascending is not None:
+            if older:
+                return self._prefix_mask(bisect_left(ascending, cutoff), from_end=descending)
+            return self._prefix_mask(self.size - bisect_right(ascending, cutoff), from_end=not descending)
+        if older:
+            return flags_to_mask(bytearray(map(cutoff.__gt__, timestamps)))
+        return flags_to_mask(bytearray(map(cutoff.__lt__, timestamps)))
+
+    def loaded_body_mask(self) -> int:
+        # Rows whose body was downloaded; the others match no body condition.
+        mask = self._masks.get(('body', 'loaded', ''))
+        if mask is None:
+            mask = self._masks[('body', 'loaded', '')] = flags_to_mask(
+                bytearray(record.has_body for record in self.emails))
+        return mask
+
+    def test_mask(self, test: Callable[[Any], bool]) -> int:
+        return flags_to_mask(bytearray(map(test, self.emails)))
+
+    def condition_mask(self, field: str, predicate: str, value: Any,
+                       test: Optional[Callable[[Any], bool]] = None) -> int:
+        # Predicates without a columnar implementation (regex and list predicates)
+        # evaluate the condition's compiled record test row by row.
+        key = (field, predicate, value if isinstance(value, str) else id(test))
+        mask = self._masks.get(key)
+        if mask is None:
+            if predicate == 'contains':
+                mask = self.contains_mask(field, value)
+            elif predicate == 'does_not_contain':
+                mask = self.full_mask ^ self.condition_mask(field, 'contains', value)
+            elif predicate == 'equals':
+                mask = self.equals_mask(field, value)
+            elif predicate == 'does_not_equal':
+                mask = self.full_mask ^ self.condition_mask(field, 'equals', value)
+            elif predicate == 'greater_than':
+                mask = self.age_mask(field, value, older=True)
+            elif predicate == 'less_than':
+                mask = self.age_mask(field, value, older=False)
+            elif test is not None:
+                mask = self.test_mask(test)
+            else:
+                raise ValueError(f"Invalid predicate: {predicate}")
+            if field == 'body':
+                mask &= self.loaded_body_mask()
+            self._masks[key] = mask
+        return mask
+
+
+class MatchMatrix:
+    def __init__(self, rules: List[Dict[str, Any]], masks: List[int], size: int):
+        self.rules = rules
+        self.masks = masks
+        self.size = size
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def __getitem__(self, rule_index: int) -> List[bool]:
+        return mask_to_flags(self.masks[rule_index], self.size)
+
+    def match_count(self, rule_index: int) -> int:
+        return bin(self.masks[rule_index]).count('1')
+
+    def matching_rules(self, email_index: int) -> List[Dict[str, Any]]:
+        bit = 1 << email_index
+        return [rule for rule, mask in zip(self.rules, self.masks) if mask & bit]
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Dict, IO, Iterable, List, Optional, Tuple
+from src.data.record import EmailRecord
+from src.rules.action_planner import ActionPlanner
+from src.rules.actions import Action, apply_action
+from src.rules.rule_processor import CompiledCondition, CompiledRule, RuleMatcher
+
+logger = logging.getLogger(__name__)
+
+LabelChanges = Dict[str, bool]
+PageResult = Tuple['DryRunReport', List[str]]
+
+
+def describe(condition: CompiledCondition) -> str:
+    if isinstance(condition.value, str):
+        return f"{condition.field} {condition.predicate} {condition.value!r}"
+    return f"{condition.field} {condition.predicate} [{len(condition.value)} entries]"
+
+
+def deciding_condition(compiled: CompiledRule, record: EmailRecord) -> str:
+    # The condition that settled the outcome: the first passing one of an ANY rule or
+    # the first failing one of an ALL rule; otherwise every condition counted.
+    for condition in compiled.conditions:
+        if condition.test(record) != compiled.match_all:
+            return describe(condition)
+    return 'all conditions' if compiled.match_all else 'no condition'
+
+
+def rule_label_changes(rule: Dict[str, Any]) -> LabelChanges:
+    # What a rule's actions do to a message's labels, found by running them against
+    # an ActionPlanner that is never flushed.
+    planner = ActionPlanner(None)
+    message = SimpleNamespace(message_id='dry-run')
+    for action in rule['actions']:
+        apply_action(Action[action['type'].upper()], message, planner, action.get('parameters', {}))
+    changes: LabelChanges = {}
+    for add_labels, remove_labels in planner.plan():
+        changes.update(dict.fromkeys(remove_labels, False))
+        changes.update(dict.fromkeys(add_labels, True))
+    return changes
+
+
+class DryRunReport:
+    # Aggregates only, so its size depends on the rule set and not on the archive.
+    # Partial reports from separate pages or processes are combined with merge().
+    def __init__(self, rule_count: int):
+        self.emails = 0
+        self.matched_emails = 0
+        self.matches = [0] * rule_count
+        self.overlaps: Counter = Counter()
+        # (earlier rule, later rule, label) -> emails where the later rule undoes the
+        # earlier one's change to the label (the later one wins, as in a real run).
+        self.conflicts: Counter = Counter()
+
+    def add(self, positions: List[int], label_changes: List[LabelChanges]) -> None:
+        self.emails += 1
+        if not positions:
+            return
+        self.matched_emails += 1
+        for index, position in enumerate(positions):
+            self.matches[position] += 1
+            for other in positions[index + 1:]:
+                self.overlaps[(position, other)] += 1
+                earlier, later = label_changes[position], label_changes[other]
+                for label, add in earlier.items():
+                    if later.get(label, add) != add:
+                        self.conflicts[(position, other, label)] += 1
+
+    def merge(self, other: 'DryRunReport') -> None:
+        self.emails += other.emails
+        self.matched_emails += other.matched_emails
+        self.matches = [a + b for a, b in zip(self.matches, other.matches)]
+        self.overlaps.update(other.overlaps)
+        self.conflicts.update(other.conflicts)
+
+    def as_dict(self, rule_names: List[str]) -> Dict[str, Any]:
+        return {
+            'emails': self.emails,
+            'matched_emails': self.matched_emails,
+            'rules': [{'rule': name, 'matches': count} for name, count in zip(rule_names, self.matches)],
+            'overlaps': [{'rules': [rule_names[a], rule_names[b]], 'emails': count}
+                         for (a, b), count in self.overlaps.most_common()],
+            'conflicts': [{'rules': [rule_names[a], rule_names[b]], 'label': label, 'emails': count}
+                          for (a, b, label), count in self.conflicts.most_common()],
+        }
+
+
+class DryRun:
+    # Evaluates a rule set over stored emails without touching Gmail. Pages of rows
+    # are evaluated in worker processes (each gets the compiled matcher once), at most
+    # two pages per worker are in flight, and per-email explanations are written as
+    # each page completes, so memory stays bounded for any archive size.
+    def __init__(self, rule_matcher: RuleMatcher, workers: int = 1, explain: Optional[IO[str]] = None):
+        self.rule_matcher = rule_matcher
+        self.workers = max(1, workers)
+        self.explain = explain
+        self.rule_names = [compiled.name or f'rule {position}'
+                           for position, compiled in enumerate(rule_matcher.compiled_rules)]
+
+    def run(self, pages: Iterable[List[Any]]) -> DryRunReport:
+        report = DryRunReport(len(self.rule_names))
+        explain = self.explain is not None
+        pages = ([tuple(row) for row in rows] for rows in pages)
+        if self.workers == 1:
+            _init_worker(self.rule_matcher)
+            for page in pages:
+                self._collect(report, evaluate_page(page, explain))
+            return report
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.rule_matcher,)) as executor:
+            in_flight = deque()
+            for page in pages:
+                in_flight.append(executor.submit(evaluate_page, page, explain))
+                if len(in_flight) >= self.workers * 2:
+                    self._collect(report, in_flight.popleft().result())
+            while in_flight:
+                self._collect(report, in_flight.popleft().result())
+        return report
+
+    def _collect(self, report: DryRunReport, result: PageResult) -> None:
+        partial, lines = result
+        report.merge(partial)
+        if self.explain is not None:
+            for line in lines:
+                self.explain.write(line + '\n')
+
+    def summary(self, report: DryRunReport) -> List[str]:
+        lines = [f"Dry run over {report.emails} stored emails: {report.matched_emails} matched at least one rule"]
+        for name, count in zip(self.rule_names, report.matches):
+            lines.append(f"Rule '{name}': {count} matches")
+        for (a, b), count in report.overlaps.most_common(10):
+            lines.append(f"Overlap: '{self.rule_names[a]}' and '{self.rule_names[b]}' both match {count} emails")
+        for (a, b, label), count in report.conflicts.most_common():
+            lines.append(f"Conflict: '{self.rule_names[b]}' overrides '{self.rule_names[a]}' on label {label} "
+                         f"for {count} emails")
+        return lines
+
+
+_matcher: Optional[RuleMatcher] = None
+_label_changes: List[LabelChanges] = []
+
+
+def _init_worker(rule_matcher: RuleMatcher) -> None:
+    global _matcher, _label_changes
+    _matcher = rule_matcher
+    _label_changes = [rule_label_changes(compiled.rule) for compiled in rule_matcher.compiled_rules]
+
+
+def evaluate_page(page: List[Tuple[Any, ...]], explain: bool) -> PageResult:
+    # Rows hold the values of repository.MATCHABLE_COLUMNS, in EmailRecord.create order.
+    compiled_rules = _matcher.compiled_rules
+    positions_of = {id(compiled.rule): position for position, compiled in enumerate(compiled_rules)}
+    report = DryRunReport(len(compiled_rules))
+    lines = []
+    for values in page:
+        record = EmailRecord.create(*values)
+        positions = [positions_of[id(rule)] for rule in _matcher.match(record)]
+        report.add(positions, _label_changes)
+        if explain and positions:
+            lines.append(json.dumps({
+                'message_id': record.message_id,
+                'subject': record.subject,
+                'rules': [{'rule': compiled_rules[position].name or f'rule {position}',
+                           'decided_by': deciding_condition(compiled_rules[position], record)}
+                          for position in positions],
+            }))
+    return report, lines
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
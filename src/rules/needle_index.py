@@ -0,0 +1,169 @@
+import re
+from collections import deque
+from typing import Any, Dict, FrozenSet, Iterable, List, Set, Tuple
+from src.data.record import MATCH_ATTRIBUTES
+from src.rules.predicates import address_domains, compile_regex, domain_set, list_keys, member_set
+
+# Below this many needles per field, per-needle `in` checks (which run in C) beat
+# walking an automaton character by character in Python. Measured with
+# `python -m benchmarks.run --only needles`: on a 50 KB body the automaton is ~9x
+# slower at 16 needles and breaks even at about 200, on short fields at about 150.
+AUTOMATON_MIN_NEEDLES = 200
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+INDEXED_PREDICATES = {
+    'contains': ('contains', False),
+    'does_not_contain': ('contains', True),
+    'equals': ('equals', False),
+    'does_not_equal': ('equals', True),
+    'matches_regex': ('regex', False),
+    'domain_in': ('domain', False),
+    'in_list': ('member', False),
+}
+
+
+class AhoCorasick:
+    def __init__(self, needles: Iterable[Tuple[str, int]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[int, ...]] = [()]
+        for needle, needle_id in needles:
+            self._add(needle, needle_id)
+        self._build_failure_links()
+
+    def _add(self, needle: str, needle_id: int) -> None:
+        state = 0
+        for char in needle:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] += (needle_id,)
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Set[int]:
+        goto, fail, output = self._goto, self._fail, self._output
+        found: Set[int] = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class RegexSet:
+    # All matches_regex patterns on one field. Most values match none of them, so a
+    # single search with their alternation rules that out in one scan; only when it
+    # finds something are the patterns tried one by one to tell which matched.
+    def __init__(self, patterns: List[Tuple[str, int]]):
+        self.patterns = [(compile_regex(pattern), atom) for pattern, atom in patterns]
+        self.gate = None
+        # Backreferences would point at the wrong group once patterns are combined.
+        if len(patterns) > 1 and not any(BACKREFERENCE.search(pattern) for pattern, _ in patterns):
+            try:
+                self.gate = compile_regex('|'.join(f'(?:{pattern})' for pattern, _ in patterns))
+            except re.error:
+                self.gate = None
+
+    def search(self, text: str) -> List[int]:
+        if self.gate is not None and self.gate.search(text) is None:
+            return []
+        return [atom for pattern, atom in self.patterns if pattern.search(text)]
+
+
+class NeedleIndex:
+    def __init__(self):
+        self._atoms: Dict[Tuple[str, str, Any], int] = {}
+        self._contains: Dict[str, Dict[str, int]] = {}
+        self._equals: Dict[str, Dict[str, int]] = {}
+        self._automata: Dict[str, AhoCorasick] = {}
+        self._patterns: Dict[str, List[Tuple[str, int]]] = {}
+        self._regexes: Dict[str, RegexSet] = {}
+        # List entry -> atoms of the domain_in / in_list conditions listing it.
+        self._domains: Dict[str, Dict[str, List[int]]] = {}
+        self._members: Dict[str, Dict[str, List[int]]] = {}
+        self._fields: Tuple[Tuple[str, str], ...] = ()
+        self._always: FrozenSet[int] = frozenset()
+
+    def add(self, field: str, kind: str, value: Any) -> int:
+        if kind in ('domain', 'member'):
+            entries = domain_set(value) if kind == 'domain' else member_set(value)
+            key = (field, kind, frozenset(entries))
+        else:
+            entries = None
+            key = (field, kind, value if kind == 'regex' else value.lower())
+        atom = self._atoms.get(key)
+        if atom is not None:
+            return atom
+        atom = self._atoms[key] = len(self._atoms)
+        if kind == 'regex':
+            self._patterns.setdefault(field, []).append((value, atom))
+        elif entries is not None:
+            table = (self._domains if kind == 'domain' else self._members).setdefault(field, {})
+            for entry in entries:
+                table.setdefault(entry, []).append(atom)
+        else:
+            table = self._contains if kind == 'contains' else self._equals
+            table.setdefault(field, {})[key[2]] = atom
+        return atom
+
+    def build(self) -> None:
+        self._automata = {}
+        always = set()
+        for field, needles in self._contains.items():
+            if '' in needles:
+                always.add(needles[''])
+            if len(needles) >= AUTOMATON_MIN_NEEDLES:
+                self._automata[field] = AhoCorasick(
+                    (needle, atom) for needle, atom in needles.items() if needle
+                )
+        self._regexes = {field: RegexSet(patterns) for field, patterns in self._patterns.items()}
+        self._always = frozenset(always)
+        fields = set(self._contains) | set(self._equals) | set(self._patterns) | set(self._domains) | set(self._members)
+        self._fields = tuple((field, MATCH_ATTRIBUTES[field]) for field in sorted(fields))
+
+    def search(self, record: Any) -> Set[int]:
+        # Takes an EmailRecord, whose matching values are already lower-cased.
+        hits = set(self._always)
+        for field, attribute in self._fields:
+            value = getattr(record, attribute)
+            equals_atom = self._equals.get(field, {}).get(value)
+            if equals_atom is not None:
+                hits.add(equals_atom)
+            automaton = self._automata.get(field)
+            if automaton is not None:
+                hits.update(automaton.search(value))
+            else:
+                for needle, atom in self._contains.get(field, {}).items():
+                    if needle in value:
+                        hits.add(atom)
+            regexes = self._regexes.get(field)
+            if regexes is not None:
+                hits.update(regexes.search(value))
+            domains = self._domains.get(field)
+            if domains:
+                for domain in address_domains(value):
+                    hits.update(domains.get(domain, ()))
+            members = self._members.get(field)
+            if members:
+                for key in list_keys(value):
+                    hits.update(members.get(key, ()))
+        return hits
@@ -1,5 +1,11 @@
+import re
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Any, Callable, Dict
+from email.utils import getaddresses
+from typing import Any, Callable, Dict, Iterable, List, Set, Union
+
+# Predicates whose value is a list of entries, or the path of a file with one entry per line.
+LIST_PREDICATES = ('domain_in', 'in_list')
 
 class Predicate:
     @staticmethod
@@ -64,4 +70,110 @@ def get_predicate(predicate_name: str) -> Callable:
     predicate = PREDICATES.get(predicate_name)
     if not predicate:
         raise ValueError(f"Invalid predicate: {predicate_name}")
-    return predicate
\ No newline at end of file
+    return predicate
+
+# Record predicates do the per-condition work (lowercasing the condition value,
+# parsing relative times) once and test the values an EmailRecord precomputes for
+# matching: the lower-cased field (so no per-email case folding) or epoch seconds for dates.
+def _record_contains(condition_value: str) -> Callable[[str], bool]:
+    needle = condition_value.lower()
+    return lambda field_value: needle in field_value
+
+def _record_does_not_contain(condition_value: str) -> Callable[[str], bool]:
+    needle = condition_value.lower()
+    return lambda field_value: needle not in field_value
+
+def _record_equals(condition_value: str) -> Callable[[str], bool]:
+    expected = condition_value.lower()
+    return lambda field_value: field_value == expected
+
+def _record_does_not_equal(condition_value: str) -> Callable[[str], bool]:
+    expected = condition_value.lower()
+    return lambda field_value: field_value != expected
+
+def _record_greater_than(condition_value: str) -> Callable[[float], bool]:
+    seconds = Predicate.parse_time_value(condition_value).total_seconds()
+    return lambda received_at: time.time() - received_at > seconds
+
+def _record_less_than(condition_value: str) -> Callable[[float], bool]:
+    seconds = Predicate.parse_time_value(condition_value).total_seconds()
+    return lambda received_at: time.time() - received_at < seconds
+
+def read_list_file(path: str) -> List[str]:
+    # One entry per line; blank lines and lines starting with # are skipped.
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+def list_entries(condition_value: Union[str, Iterable[str]]) -> List[str]:
+    if isinstance(condition_value, str):
+        return read_list_file(condition_value)
+    return list(condition_value)
+
+def email_addresses(field_value: str) -> List[str]:
+    if ',' not in field_value and '"' not in field_value and '(' not in field_value:
+        # A bare address or "Name <address>", the common case, without the full parser.
+        address = field_value.rpartition('<')[2].partition('>')[0] if '<' in field_value else field_value.strip()
+        return [address] if '@' in address else []
+    return [address for _, address in getaddresses([field_value]) if '@' in address]
+
+def address_domains(field_value: str) -> List[str]:
+    # Domains of every address in a lower-cased header together with their parent
+    # domains, so a listed "spam.com" also matches mail from "news.spam.com".
+    domains = []
+    for address in email_addresses(field_value):
+        domain = address.rpartition('@')[2].strip('.')
+        while domain:
+            domains.append(domain)
+            domain = domain.partition('.')[2]
+    return domains
+
+def list_keys(field_value: str) -> List[str]:
+    # A field is in a list when its whole value is, or for address headers when any
+    # of its addresses is ("Name <a@b.com>" matches a listed "a@b.com").
+    keys = [field_value.strip()]
+    if '@' in field_value:
+        keys.extend(email_addresses(field_value))
+    return keys
+
+def normalize_domain(entry: str) -> str:
+    return entry.strip().lower().lstrip('@').strip('.')
+
+def domain_set(condition_value: Union[str, Iterable[str]]) -> Set[str]:
+    return {normalize_domain(entry) for entry in list_entries(condition_value)} - {''}
+
+def member_set(condition_value: Union[str, Iterable[str]]) -> Set[str]:
+    return {entry.strip().lower() for entry in list_entries(condition_value)}
+
+def compile_regex(condition_value: str) -> 're.Pattern[str]':
+    # Case-insensitive like the other text predicates; fields are matched lower-cased.
+    return re.compile(condition_value, re.IGNORECASE)
+
+def _record_matches_regex(condition_value: str) -> Callable[[str], bool]:
+    search = compile_regex(condition_value).search
+    return lambda field_value: search(field_value) is not None
+
+def _record_domain_in(condition_value: Union[str, Iterable[str]]) -> Callable[[str], bool]:
+    domains = domain_set(condition_value)
+    return lambda field_value: not domains.isdisjoint(address_domains(field_value))
+
+def _record_in_list(condition_value: Union[str, Iterable[str]]) -> Callable[[str], bool]:
+    members = member_set(condition_value)
+    return lambda field_value: not members.isdisjoint(list_keys(field_value))
+
+RECORD_PREDICATE_COMPILERS: Dict[str, Callable[[Any], Callable[[Any], bool]]] = {
+    'contains': _record_contains,
+    'does_not_contain': _record_does_not_contain,
+    'equals': _record_equals,
+    'does_not_equal': _record_does_not_equal,
+    'greater_than': _record_greater_than,
+    'less_than': _record_less_than,
+    'matches_regex': _record_matches_regex,
+    'domain_in': _record_domain_in,
+    'in_list': _record_in_list,
+}
+
+def compile_record_predicate(predicate_name: str, condition_value: Any) -> Callable[[Any], bool]:
+    compiler = RECORD_PREDICATE_COMPILERS.get(predicate_name)
+    if not compiler:
+        raise ValueError(f"Invalid predicate: {predicate_name}")
+    return compiler(condition_value)
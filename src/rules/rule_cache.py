@@ -0,0 +1,150 @@
+import functools
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+from src.rules.rule_processor import RuleMatcher
+from src.rules.schema import list_file_paths, resolve_list_files, validate_rules
+
+logger = logging.getLogger(__name__)
+
+# Modules whose classes end up in a pickled RuleMatcher.
+_SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+_COMPILED_SOURCES = (os.path.join(_SOURCE_DIR, '*.py'), os.path.join(_SOURCE_DIR, '..', 'data', 'record.py'))
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    # A hash of the rule compiler's source, part of every digest, so a cache written by
+    # any other version of the code is never unpickled into this one.
+    digest = hashlib.sha256()
+    for path in sorted(path for pattern in _COMPILED_SOURCES for path in glob.glob(pattern)):
+        with open(path, 'rb') as f:
+            digest.update(os.path.basename(path).encode('utf-8') + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def content_hash(content: bytes, list_files: List[str] = ()) -> str:
+    digest = hashlib.sha256(f"{code_version()}:".encode('ascii') + content)
+    for path in list_files:
+        with open(path, 'rb') as f:
+            digest.update(b'\0' + path.encode('utf-8') + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def read_rule_set(rules_file: str) -> Tuple[bytes, str, List[str]]:
+    # The rules file content, a digest over it and every list file it references,
+    # and the paths of those list files.
+    with open(rules_file, 'rb') as f:
+        content = f.read()
+    list_files = list_file_paths(json.loads(content), os.path.dirname(rules_file))
+    return content, content_hash(content, list_files), list_files
+
+
+class RuleSetCache:
+    # Compiled rule sets keyed by the hash of the rules and list file content: kept in memory
+    # for the life of the process and, with a directory, pickled to disk so restarts
+    # with unchanged rules skip validation and compilation. Unpickling runs code, so
+    # only files owned by the current user and writable by no one else are loaded.
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._matchers: Dict[str, RuleMatcher] = {}
+
+    def load_matcher(self, rules_file: str) -> RuleMatcher:
+        return self.load(rules_file)[0]
+
+    def load(self, rules_file: str) -> Tuple[RuleMatcher, str]:
+        content, digest, _ = read_rule_set(rules_file)
+        return self.compile(content, digest, os.path.dirname(rules_file)), digest
+
+    def compile(self, content: bytes, digest: str, base_dir: str = '') -> RuleMatcher:
+        matcher = self._matchers.get(digest) or self._read(digest)
+        if matcher is None:
+            matcher = RuleMatcher(validate_rules(resolve_list_files(json.loads(content), base_dir)))
+            self._write(digest, matcher)
+        self._matchers[digest] = matcher
+        return matcher
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.pickle")
+
+    def _read(self, digest: str) -> Optional[RuleMatcher]:
+        if not self.directory or not os.path.exists(self.path(digest)):
+            return None
+        if not self._trusted(self.path(digest)):
+            logger.warning(f"Ignoring compiled rules cache {self.path(digest)}: not private to this user")
+            return None
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable compiled rules cache {self.path(digest)}: {str(e)}")
+            return None
+
+    @staticmethod
+    def _trusted(path: str) -> bool:
+        if not hasattr(os, 'getuid'):
+            return True
+        stat = os.stat(path)
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+    def _write(self, digest: str, matcher: RuleMatcher) -> None:
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            # Written under a temporary name and renamed, so concurrent processes
+            # never read a half-written file.
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+                pickle.dump(matcher, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, self.path(digest))
+        except OSError as e:
+            logger.warning(f"Could not cache compiled rules in {self.directory}: {str(e)}")
+
+
+class RuleSetWatcher:
+    # Reloads the rules when the mtime or size of the rules file or of a list file it
+    # references changes. A new version replaces
+    # `matcher` in a single assignment only after it validated and compiled, so
+    # callers holding the previous matcher finish their work with it and an invalid
+    # edit leaves the current rules in place.
+    def __init__(self, rules_file: str, cache: Optional[RuleSetCache] = None):
+        self.rules_file = rules_file
+        self.cache = cache or RuleSetCache()
+        content, self.digest, self.list_files = read_rule_set(rules_file)
+        self._stat = self._file_stat()
+        self.matcher = self.cache.compile(content, self.digest, os.path.dirname(rules_file))
+        self._lock = threading.Lock()
+
+    def _file_stat(self) -> Optional[Tuple[Tuple[int, int], ...]]:
+        try:
+            stats = [os.stat(path) for path in [self.rules_file] + self.list_files]
+        except OSError:
+            return None
+        return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+
+    def poll(self) -> bool:
+        with self._lock:
+            stat = self._file_stat()
+            if stat is None or stat == self._stat:
+                return False
+            self._stat = stat
+            try:
+                content, digest, list_files = read_rule_set(self.rules_file)
+                if list_files != self.list_files:
+                    self.list_files = list_files
+                    self._stat = self._file_stat()
+                if digest == self.digest:
+                    return False
+                matcher = self.cache.compile(content, digest, os.path.dirname(self.rules_file))
+            except (OSError, ValueError) as e:
+                logger.error(f"Keeping the current rules, {self.rules_file} could not be loaded: {str(e)}")
+                return False
+            self.matcher, self.digest = matcher, digest
+            logger.info(f"Reloaded {len(matcher.rules)} rules from {self.rules_file} ({digest[:12]})")
+            return True
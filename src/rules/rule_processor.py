@@ -1,64 +1,380 @@
+import hashlib
 import json
-from typing import List, Dict, Any
-from src.data.models import Email
-from src.rules.predicates import get_predicate
+import os
+import time
+from operator import attrgetter
+from datetime import datetime
+from typing import List, Dict, Any, Callable, Optional, Sequence, Set
+from src.data.models import AppliedAction, Email
+from src.data.record import MATCH_ATTRIBUTES, EmailRecord, as_record
+from src.data.repository import ActionKey
+from src.metrics import metrics
+from src.rules.batch import EmailBatch, MatchMatrix, mask_to_flags
+from src.rules.needle_index import INDEXED_PREDICATES, NeedleIndex
+from src.rules.predicates import LIST_PREDICATES, compile_record_predicate, list_entries
+from src.rules.action_planner import ActionPlanner
 from src.rules.actions import Action, apply_action
+from src.rules.schema import EMAIL_FIELDS, RULE_PREDICATES, resolve_list_files, validate_rules
+
+
+class CompiledCondition:
+    __slots__ = ('field', 'predicate', 'value', 'test', 'atom', 'negate', 'check')
+
+    def __init__(self, condition: Dict[str, str]):
+        self.field = condition['field']
+        self.predicate = condition['predicate']
+        self.value = condition['value']
+        if self.field not in EMAIL_FIELDS:
+            raise ValueError(f"Invalid condition field: {self.field}")
+        if self.predicate in LIST_PREDICATES:
+            # A list file is read once, here, rather than by every matcher that uses it.
+            self.value = list_entries(self.value)
+        self.atom = None
+        self.negate = False
+        self._link()
+
+    def bind(self, needle_index: NeedleIndex) -> None:
+        indexed = INDEXED_PREDICATES.get(self.predicate)
+        if indexed is None:
+            return
+        kind, self.negate = indexed
+        self.atom = needle_index.add(self.field, kind, self.value)
+        self._link()
+
+    def _link(self) -> None:
+        # test and check take an EmailRecord.
+        get_field = attrgetter(MATCH_ATTRIBUTES[self.field])
+        test = compile_record_predicate(self.predicate, self.value)
+        evaluate = lambda email: test(get_field(email))
+        atom = self.atom
+        if atom is None:
+            check = lambda email, hits: evaluate(email)
+        elif self.negate:
+            check = lambda email, hits: atom not in hits
+        else:
+            check = lambda email, hits: atom in hits
+        if self.field == 'body':
+            # A body that was never downloaded matches no body condition, negated ones
+            # included, as a NULL body does in SQL.
+            plain_evaluate, plain_check = evaluate, check
+            evaluate = lambda email: email.has_body and plain_evaluate(email)
+            check = lambda email, hits: email.has_body and plain_check(email, hits)
+        self.test: Callable[[EmailRecord], bool] = evaluate
+        self.check: Callable[[EmailRecord, Set[int]], bool] = check
+
+    def __getstate__(self):
+        # The predicate closures are rebuilt on load, everything else pickles as is.
+        return self.field, self.predicate, self.value, self.atom, self.negate
+
+    def __setstate__(self, state) -> None:
+        self.field, self.predicate, self.value, self.atom, self.negate = state
+        self._link()
+
+    def evaluate(self, email: Any) -> bool:
+        return self.test(as_record(email))
+
+
+class CompiledRule:
+    __slots__ = ('rule', 'name', 'match_all', 'conditions', 'digest')
+
+    def __init__(self, rule: Dict[str, Any]):
+        predicate = rule['predicate'].upper()
+        if predicate not in RULE_PREDICATES:
+            raise ValueError(f"Invalid rule predicate: {predicate}")
+        self.rule = rule
+        self.name = rule.get('name')
+        self.match_all = predicate == 'ALL'
+        self.conditions = [CompiledCondition(condition) for condition in rule['conditions']]
+        self.digest = rule_hash(rule)
+
+    def trigger_atoms(self) -> Optional[Set[int]]:
+        # Needles of which at least one must hit for the rule to possibly match,
+        # or None when the rule has to be evaluated for every email.
+        positive = [c.atom for c in self.conditions if c.atom is not None and not c.negate]
+        if self.match_all:
+            return {positive[0]} if positive else None
+        if positive and len(positive) == len(self.conditions):
+            return set(positive)
+        return None
+
+    def matches(self, email: EmailRecord, hits: Optional[Set[int]] = None) -> bool:
+        if hits is None:
+            checks = (condition.test(email) for condition in self.conditions)
+        else:
+            checks = (condition.check(email, hits) for condition in self.conditions)
+        return all(checks) if self.match_all else any(checks)
+
+    def batch_mask(self, batch: EmailBatch) -> int:
+        if self.match_all:
+            mask = batch.full_mask
+            for condition in self.conditions:
+                mask &= batch.condition_mask(condition.field, condition.predicate, condition.value, condition.test)
+                if not mask:
+                    break
+        else:
+            mask = 0
+            for condition in self.conditions:
+                mask |= batch.condition_mask(condition.field, condition.predicate, condition.value, condition.test)
+                if mask == batch.full_mask:
+                    break
+        return mask
+
 
 class RuleMatcher:
     def __init__(self, rules: List[Dict[str, Any]]):
         self.rules = rules
+        self.compiled_rules = [CompiledRule(rule) for rule in rules]
+        self.rule_hashes = self._rule_hashes()
+        self.needle_index = NeedleIndex()
+        for compiled in self.compiled_rules:
+            for condition in compiled.conditions:
+                condition.bind(self.needle_index)
+        self.needle_index.build()
+        self.referenced_fields = frozenset(
+            condition.field for compiled in self.compiled_rules for condition in compiled.conditions
+        )
+        self._body_rules = [
+            compiled for compiled in self.compiled_rules
+            if any(condition.field == 'body' for condition in compiled.conditions)
+        ]
 
-    def match(self, email: Email) -> List[Dict[str, Any]]:
-        return [rule for rule in self.rules if self.rule_matches(rule, email)]
+        self._unconditional: Set[int] = set()
+        self._triggers: Dict[int, List[int]] = {}
+        for position, compiled in enumerate(self.compiled_rules):
+            atoms = compiled.trigger_atoms()
+            if atoms is None:
+                self._unconditional.add(position)
+            else:
+                for atom in atoms:
+                    self._triggers.setdefault(atom, []).append(position)
 
-    def rule_matches(self, rule: Dict[str, Any], email: Email) -> bool:
-        conditions = rule['conditions']
-        predicate = rule['predicate'].upper()
-        
-        results = [self.condition_matches(condition, email) for condition in conditions]
-        
-        if predicate == 'ALL':
-            return all(results)
-        elif predicate == 'ANY':
-            return any(results)
-        else:
-            raise ValueError(f"Invalid rule predicate: {predicate}")
+    def _rule_hashes(self) -> Dict[int, str]:
+        return {id(compiled.rule): compiled.digest for compiled in self.compiled_rules}
 
-    def condition_matches(self, condition: Dict[str, str], email: Email) -> bool:
-        field = condition['field']
-        predicate = condition['predicate']
-        value = condition['value']
+    def __getstate__(self):
+        # rule_hashes is keyed by id(), so it is rebuilt on load.
+        state = self.__dict__.copy()
+        del state['rule_hashes']
+        return state
 
-        email_value = getattr(email, field)
-        predicate_func = get_predicate(predicate)
-        
-        return predicate_func(email_value, value)
+    def __setstate__(self, state) -> None:
+        self.__dict__.update(state)
+        self.rule_hashes = self._rule_hashes()
 
+    def candidates(self, hits: Set[int]) -> List[int]:
+        positions = set(self._unconditional)
+        triggers = self._triggers
+        for atom in hits:
+            positions.update(triggers.get(atom, ()))
+        return sorted(positions)
 
+    def match(self, email: Any) -> List[Dict[str, Any]]:
+        email = as_record(email)
+        if metrics.enabled:
+            return self._match_profiled(email)
+        hits = self.needle_index.search(email)
+        compiled_rules = self.compiled_rules
+        return [
+            compiled_rules[position].rule
+            for position in self.candidates(hits)
+            if compiled_rules[position].matches(email, hits)
+        ]
+
+    def rule_labels(self, position: int) -> Dict[str, Any]:
+        return {'rule': self.compiled_rules[position].name or f'rule {position}', 'index': position}
+
+    def _match_profiled(self, email: EmailRecord) -> List[Dict[str, Any]]:
+        # Same result as match(), evaluating conditions one by one so every rule's and
+        # predicate's cost is recorded.
+        start = time.perf_counter()
+        hits = self.needle_index.search(email)
+        metrics.observe('rule_prefilter_seconds', time.perf_counter() - start)
+        matched = []
+        for position in self.candidates(hits):
+            compiled = self.compiled_rules[position]
+            rule_start = time.perf_counter()
+            is_match = compiled.match_all
+            for condition in compiled.conditions:
+                condition_start = time.perf_counter()
+                passed = condition.check(email, hits)
+                metrics.lookup(
+                    ('predicate_seconds', condition.predicate, condition.field), 'predicate_seconds',
+                    lambda: {'predicate': condition.predicate, 'field': condition.field}
+                ).observe(time.perf_counter() - condition_start)
+                if passed != compiled.match_all:
+                    is_match = passed
+                    break
+            labels = self.rule_labels(position)
+            metrics.lookup(
+                ('rule_evaluation_seconds', labels['rule'], position), 'rule_evaluation_seconds', lambda: labels
+            ).observe(time.perf_counter() - rule_start)
+            if is_match:
+                metrics.increment('rule_hits_total', **labels)
+                matched.append(compiled.rule)
+        return matched
+
+    def needs_body(self, email: Any) -> bool:
+        # True when some rule's outcome still depends on the body after evaluating
+        # its other conditions (an ALL rule with no failing header condition, or an
+        # ANY rule with no passing one).
+        email = as_record(email)
+        for compiled in self._body_rules:
+            header_results = (
+                condition.test(email) for condition in compiled.conditions if condition.field != 'body'
+            )
+            if compiled.match_all:
+                if all(header_results):
+                    return True
+            elif not any(header_results):
+                return True
+        return False
+
+    def match_batch(self, emails: Sequence[Any], now: Optional[datetime] = None) -> MatchMatrix:
+        batch = EmailBatch(emails, now)
+        if not metrics.enabled:
+            masks = [compiled.batch_mask(batch) for compiled in self.compiled_rules]
+            return MatchMatrix(self.rules, masks, batch.size)
+        masks = []
+        for position, compiled in enumerate(self.compiled_rules):
+            start = time.perf_counter()
+            masks.append(compiled.batch_mask(batch))
+            metrics.observe('rule_batch_seconds', time.perf_counter() - start, **self.rule_labels(position))
+        return MatchMatrix(self.rules, masks, batch.size)
+
+    def select(self, rule: Dict[str, Any], emails: Sequence[Any], now: Optional[datetime] = None) -> List[EmailRecord]:
+        # The emails one of this matcher's rules matches, evaluated as a batch.
+        compiled = next((compiled for compiled in self.compiled_rules if compiled.rule is rule), None) \
+            or CompiledRule(rule)
+        batch = EmailBatch(emails, now)
+        flags = mask_to_flags(compiled.batch_mask(batch), batch.size)
+        return [record for record, flag in zip(batch.emails, flags) if flag]
+
+    def rule_matches(self, rule: Dict[str, Any], email: Any) -> bool:
+        return CompiledRule(rule).matches(as_record(email))
+
+    def condition_matches(self, condition: Dict[str, str], email: Any) -> bool:
+        return CompiledCondition(condition).evaluate(email)
+
+
+def rule_hash(rule: Dict[str, Any]) -> str:
+    # Identifies what a rule selects, so renaming it does not replay its actions. A
+    # list file counts by its path: editing the list keeps the hash, so the actions
+    # are not re-applied to messages the rule already handled.
+    conditions = [
+        dict({key: value for key, value in condition.items() if key != 'list_file'}, value=condition['list_file'])
+        if 'list_file' in condition else condition
+        for condition in rule['conditions']
+    ]
+    canonical = json.dumps({'predicate': rule['predicate'].upper(), 'conditions': conditions},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def action_key(action: Dict[str, Any]) -> str:
+    return json.dumps({'type': action['type'].upper(), 'parameters': action.get('parameters', {})},
+                      sort_keys=True, separators=(',', ':'))
 
 
 class RuleProcessor:
-    def __init__(self, rule_matcher: RuleMatcher, gmail_service: Any):
+    # Actions go to an ActionPlanner, which sends them as batched label changes on
+    # flush(). With an action_log, actions already applied to a message by an
+    # identical rule are skipped, queued ones are recorded as pending before they are
+    # sent (see record_pending) and marked applied or failed afterwards, so reruns and
+    # crash recovery only replay what is still missing.
+    def __init__(self, rule_matcher: RuleMatcher, action_planner: ActionPlanner, action_log: Any = None):
         self.rule_matcher = rule_matcher
-        self.gmail_service = gmail_service
+        self.action_planner = action_planner
+        self.action_log = action_log
+        self._unrecorded: List[ActionKey] = []
+        self._pending: List[ActionKey] = []
 
     @classmethod
-    def from_file(cls, rules_file: str, gmail_service: Any):
+    def from_file(cls, rules_file: str, action_planner: ActionPlanner, cache: Any = None):
+        if cache is not None:
+            return cls(cache.load_matcher(rules_file), action_planner)
         with open(rules_file, 'r') as f:
             rules_data = json.load(f)
-        rule_matcher = RuleMatcher(rules_data['rules'])
-        return cls(rule_matcher, gmail_service)
+        rule_matcher = RuleMatcher(validate_rules(resolve_list_files(rules_data, os.path.dirname(rules_file))))
+        return cls(rule_matcher, action_planner)
+
+    def with_action_log(self, action_log: Any) -> 'RuleProcessor':
+        # Queued actions move along, so another thread's session can record their outcome.
+        processor = type(self)(self.rule_matcher, self.action_planner, action_log)
+        processor._unrecorded, processor._pending = self._unrecorded, self._pending
+        self._unrecorded, self._pending = [], []
+        return processor
 
     def process_email(self, email: Email) -> None:
-        matching_rules = self.rule_matcher.match(email)
-        for rule in matching_rules:
-            self.apply_actions(rule, email)
+        self.process_emails([email])
+
+    def process_emails(self, emails: Sequence[Any]) -> None:
+        applied = self._applied_keys(emails)
+        for email in emails:
+            for rule in self.rule_matcher.match(email):
+                self._queue_actions(rule, email, applied)
+
+    def apply_rule(self, rule: Dict[str, Any], emails: Sequence[Any]) -> None:
+        applied = self._applied_keys(emails)
+        for email in emails:
+            self._queue_actions(rule, email, applied)
 
     def apply_actions(self, rule: Dict[str, Any], email: Email) -> None:
         for action in rule['actions']:
-            try:
-                action_enum = Action[action['type'].upper()]
-                parameters = action.get('parameters', {})
-                apply_action(action_enum, email, self.gmail_service, parameters)
-            except KeyError:
-                raise ValueError(f"Invalid action type: {action['type']}")
+            self.apply_action(action, email)
+
+    def apply_action(self, action: Dict[str, Any], email: Any) -> None:
+        try:
+            action_enum = Action[action['type'].upper()]
+            parameters = action.get('parameters', {})
+            apply_action(action_enum, email, self.action_planner, parameters)
+        except KeyError:
+            raise ValueError(f"Invalid action type: {action['type']}")
+
+    def retry_failed(self, batch_size: int = 1000) -> int:
+        # Replays pending or failed actions whose rule is still part of the rule set.
+        current = set(self.rule_matcher.rule_hashes.values())
+        replayed = 0
+        for rows in self.action_log.iter_unfinished(batch_size):
+            for row in rows:
+                if row.rule_hash in current:
+                    self.apply_action(json.loads(row.action), row)
+                    self._unrecorded.append((row.message_id, row.rule_hash, row.action))
+                    replayed += 1
+            self.flush()
+        return replayed
+
+    def record_pending(self, commit: bool = True) -> None:
+        # Logs the queued actions as pending. Callers storing the emails the actions
+        # belong to pass commit=False and commit both together, so a crash before
+        # flush() leaves the actions for --retry-failed instead of losing them.
+        keys, self._unrecorded = self._unrecorded, []
+        if self.action_log is not None:
+            self.action_log.record_pending(keys, commit=commit)
+        self._pending.extend(keys)
+
+    def flush(self) -> int:
+        self.record_pending()
+        pending, self._pending = self._pending, []
+        groups = self.action_planner.flush()
+        if self.action_log is not None and pending:
+            failed_ids = self.action_planner.failed_message_ids
+            self.action_log.mark([key for key in pending if key[0] not in failed_ids], AppliedAction.STATUS_APPLIED)
+            self.action_log.mark([key for key in pending if key[0] in failed_ids], AppliedAction.STATUS_FAILED)
+        return groups
+
+    def _applied_keys(self, emails: Sequence[Any]) -> Set[ActionKey]:
+        if self.action_log is None:
+            return set()
+        return self.action_log.applied_keys({email.message_id for email in emails})
+
+    def _queue_actions(self, rule: Dict[str, Any], email: Any, applied: Set[ActionKey]) -> None:
+        if self.action_log is None:
+            self.apply_actions(rule, email)
+            return
+        digest = self.rule_matcher.rule_hashes.get(id(rule)) or rule_hash(rule)
+        for action in rule['actions']:
+            key = (email.message_id, digest, action_key(action))
+            if key not in applied:
+                applied.add(key)
+                self.apply_action(action, email)
+                self._unrecorded.append(key)
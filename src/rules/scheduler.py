@@ -0,0 +1,131 @@
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import and_
+from src.data.models import Email
+from src.data.record import EmailRecord, as_record
+from src.data.repository import MATCHABLE_COLUMNS
+from src.rules.predicates import Predicate
+from src.rules.rule_processor import CompiledRule, RuleMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class DateRule:
+    # A rule with an "older than" (greater_than) condition, which can start matching an
+    # email long after the email was stored and evaluated.
+    def __init__(self, compiled: CompiledRule):
+        self.compiled = compiled
+        self.rule = compiled.rule
+        self.digest = compiled.digest
+        self.match_all = compiled.match_all
+        older = [self._seconds(c) for c in compiled.conditions if c.predicate == 'greater_than']
+        newer = [self._seconds(c) for c in compiled.conditions if c.predicate == 'less_than']
+        self.others = [c for c in compiled.conditions if c.predicate not in ('greater_than', 'less_than')]
+        # Seconds after receipt at which time alone can make the rule match, and for
+        # ALL rules the age after which a "newer than" condition rules it out again.
+        self.delay = max(older) if self.match_all else min(older)
+        self.expiry = min(newer) if self.match_all and newer else None
+
+    @staticmethod
+    def _seconds(condition: Any) -> float:
+        return Predicate.parse_time_value(condition.value).total_seconds()
+
+    @classmethod
+    def applies_to(cls, compiled: CompiledRule) -> bool:
+        return any(condition.predicate == 'greater_than' for condition in compiled.conditions)
+
+    def due_at(self, record: EmailRecord) -> Optional[float]:
+        # Epoch seconds at which the rule starts matching the email, or None when the
+        # passing of time never changes the outcome.
+        if self.match_all:
+            if self.expiry is not None and self.delay >= self.expiry:
+                return None
+            if not all(condition.test(record) for condition in self.others):
+                return None
+        elif any(condition.test(record) for condition in self.others):
+            return None
+        return record.received_at + self.delay
+
+
+class RuleScheduler:
+    # Keeps date rules such as "older than 7 days -> trash" firing after emails were
+    # stored. Each tick computes when the emails stored since the previous tick will
+    # satisfy each date rule, keeps those due times in the indexed rule_schedule
+    # table, and applies the rules whose due time has passed. Only emails that just
+    # crossed a threshold are evaluated; the archive is never rescanned. A new or
+    # changed rule is scheduled once for every stored email, and the emails already
+    # past its threshold fall due at once.
+    def __init__(self, rule_matcher: RuleMatcher, batch_size: int = 1000):
+        self.date_rules = [DateRule(compiled) for compiled in rule_matcher.compiled_rules
+                           if DateRule.applies_to(compiled)]
+        self.batch_size = batch_size
+
+    def tick(self, email_repo: Any, schedule_repo: Any, rule_processor: Any,
+             now: Optional[datetime] = None) -> Tuple[int, int]:
+        now = now or datetime.now(timezone.utc)
+        scheduled = self.schedule(email_repo, schedule_repo, now)
+        return scheduled, self.apply_due(schedule_repo, rule_processor, now)
+
+    def schedule(self, email_repo: Any, schedule_repo: Any, now: datetime) -> int:
+        states = schedule_repo.states()
+        current = {date_rule.digest for date_rule in self.date_rules}
+        if set(states) - current:
+            schedule_repo.purge(current)
+        max_email_id = schedule_repo.max_email_id()
+        # Rules scheduled up to the same email in the same tick share one pass.
+        groups: Dict[Tuple[int, datetime], List[DateRule]] = {}
+        scheduled = 0
+        for date_rule in self.date_rules:
+            state = states.get(date_rule.digest)
+            if state is None:
+                criterion = Email.id <= max_email_id
+                scheduled += self._schedule_rows(email_repo, schedule_repo, [date_rule], criterion, now,
+                                                 catch_up=True)
+            else:
+                groups.setdefault((state.last_email_id, state.scheduled_at), []).append(date_rule)
+        for (last_email_id, scheduled_at), date_rules in groups.items():
+            criterion = and_(Email.id > last_email_id, Email.id <= max_email_id)
+            # Emails stored since the previous tick were evaluated when they were stored,
+            # so only thresholds they crossed after that tick are still to be applied.
+            since = Email.ensure_offset_aware(scheduled_at)
+            scheduled += self._schedule_rows(email_repo, schedule_repo, date_rules, criterion, since)
+        for date_rule in self.date_rules:
+            schedule_repo.save_state(date_rule.digest, max_email_id, now)
+        return scheduled
+
+    def _schedule_rows(self, email_repo: Any, schedule_repo: Any, date_rules: List[DateRule],
+                       criterion: Any, since: datetime, catch_up: bool = False) -> int:
+        # With catch_up, emails whose due time already passed are due at since.
+        since_epoch = since.timestamp()
+        scheduled = 0
+        for rows in email_repo.iter_matching_rows(criterion, self.batch_size, columns=MATCHABLE_COLUMNS):
+            entries = []
+            for row in rows:
+                record = as_record(row)
+                for date_rule in date_rules:
+                    due = date_rule.due_at(record)
+                    if due is not None and (catch_up or due > since_epoch):
+                        entries.append({'message_id': record.message_id, 'rule_hash': date_rule.digest,
+                                        'due_at': datetime.fromtimestamp(max(due, since_epoch), timezone.utc)})
+            schedule_repo.schedule(entries)
+            scheduled += len(entries)
+        return scheduled
+
+    def apply_due(self, schedule_repo: Any, rule_processor: Any, now: datetime) -> int:
+        date_rules = {date_rule.digest: date_rule for date_rule in self.date_rules}
+        applied = 0
+        for rows in schedule_repo.iter_due(now, self.batch_size):
+            matches: Dict[str, List[EmailRecord]] = {}
+            for row in rows:
+                date_rule = date_rules.get(row.rule_hash)
+                record = as_record(row)
+                # Re-checked, since a "newer than" condition may have expired meanwhile.
+                if date_rule is not None and date_rule.compiled.matches(record):
+                    matches.setdefault(row.rule_hash, []).append(record)
+            for digest, records in matches.items():
+                rule_processor.apply_rule(date_rules[digest].rule, records)
+                applied += len(records)
+            rule_processor.flush()
+            schedule_repo.delete([row.schedule_id for row in rows])
+        return applied
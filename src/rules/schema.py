@@ -0,0 +1,127 @@
+import os
+import re
+from typing import Any, Dict, Iterator, List
+from src.rules.actions import Action
+from src.rules.predicates import LIST_PREDICATES, RECORD_PREDICATE_COMPILERS, Predicate, compile_regex, read_list_file
+
+EMAIL_FIELDS = ('sender', 'recipient', 'subject', 'body', 'received_date')
+RULE_PREDICATES = ('ALL', 'ANY')
+DATE_FIELDS = ('received_date',)
+DATE_PREDICATES = ('greater_than', 'less_than')
+ADDRESS_FIELDS = ('sender', 'recipient')
+ADDRESS_PREDICATES = ('domain_in',)
+
+
+class RuleValidationError(ValueError):
+    def __init__(self, errors: List[str]):
+        super().__init__("Invalid rules: " + "; ".join(errors))
+        self.errors = errors
+
+
+def validate_rules(data: Any) -> List[Dict[str, Any]]:
+    # Checks a whole rules document and reports every problem at once, so a bad
+    # edit to a watched rules file is rejected before anything is compiled.
+    errors: List[str] = []
+    if not isinstance(data, dict) or not isinstance(data.get('rules'), list):
+        raise RuleValidationError(["document must be an object with a 'rules' list"])
+    for index, rule in enumerate(data['rules']):
+        _validate_rule(rule, f"rules[{index}]", errors)
+    if errors:
+        raise RuleValidationError(errors)
+    return data['rules']
+
+
+def _validate_rule(rule: Any, path: str, errors: List[str]) -> None:
+    if not isinstance(rule, dict):
+        errors.append(f"{path}: must be an object")
+        return
+    if not isinstance(rule.get('name', ''), str):
+        errors.append(f"{path}.name: must be a string")
+    predicate = rule.get('predicate')
+    if not isinstance(predicate, str) or predicate.upper() not in RULE_PREDICATES:
+        errors.append(f"{path}.predicate: must be one of {', '.join(RULE_PREDICATES)}")
+
+    conditions = rule.get('conditions')
+    if not isinstance(conditions, list) or not conditions:
+        errors.append(f"{path}.conditions: must be a non-empty list")
+    else:
+        for index, condition in enumerate(conditions):
+            _validate_condition(condition, f"{path}.conditions[{index}]", errors)
+
+    actions = rule.get('actions')
+    if not isinstance(actions, list):
+        errors.append(f"{path}.actions: must be a list")
+    else:
+        for index, action in enumerate(actions):
+            _validate_action(action, f"{path}.actions[{index}]", errors)
+
+
+def _validate_condition(condition: Any, path: str, errors: List[str]) -> None:
+    if not isinstance(condition, dict):
+        errors.append(f"{path}: must be an object")
+        return
+    field = condition.get('field')
+    predicate = condition.get('predicate')
+    value = condition.get('value')
+    if field not in EMAIL_FIELDS:
+        errors.append(f"{path}.field: must be one of {', '.join(EMAIL_FIELDS)}")
+    if predicate not in RECORD_PREDICATE_COMPILERS:
+        errors.append(f"{path}.predicate: must be one of {', '.join(RECORD_PREDICATE_COMPILERS)}")
+    if predicate in LIST_PREDICATES:
+        if not isinstance(value, str) and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            errors.append(f"{path}.value: must be a list of strings or the path of a list file")
+            return
+    elif not isinstance(value, str):
+        errors.append(f"{path}.value: must be a string")
+        return
+    known = field in EMAIL_FIELDS and predicate in RECORD_PREDICATE_COMPILERS
+    if known and (field in DATE_FIELDS) != (predicate in DATE_PREDICATES):
+        errors.append(f"{path}: predicate {predicate} cannot be used with field {field}")
+    elif known and predicate in ADDRESS_PREDICATES and field not in ADDRESS_FIELDS:
+        errors.append(f"{path}: predicate {predicate} cannot be used with field {field}")
+    elif predicate in DATE_PREDICATES:
+        try:
+            Predicate.parse_time_value(value)
+        except ValueError as e:
+            errors.append(f"{path}.value: {e}")
+    elif predicate == 'matches_regex':
+        try:
+            compile_regex(value)
+        except re.error as e:
+            errors.append(f"{path}.value: invalid regular expression: {e}")
+
+
+def _validate_action(action: Any, path: str, errors: List[str]) -> None:
+    if not isinstance(action, dict):
+        errors.append(f"{path}: must be an object")
+        return
+    action_type = action.get('type')
+    if not isinstance(action_type, str) or action_type.upper() not in Action.__members__:
+        errors.append(f"{path}.type: must be one of {', '.join(Action.__members__)}")
+    if not isinstance(action.get('parameters', {}), dict):
+        errors.append(f"{path}.parameters: must be an object")
+
+
+def _list_file_conditions(data: Any) -> Iterator[Dict[str, Any]]:
+    # List conditions whose value names a file, in a document that has not been validated yet.
+    rules = data.get('rules') if isinstance(data, dict) else None
+    for rule in rules if isinstance(rules, list) else ():
+        conditions = rule.get('conditions') if isinstance(rule, dict) else None
+        for condition in conditions if isinstance(conditions, list) else ():
+            if isinstance(condition, dict) and condition.get('predicate') in LIST_PREDICATES \
+                    and isinstance(condition.get('value'), str):
+                yield condition
+
+
+def list_file_paths(data: Any, base_dir: str) -> List[str]:
+    # List files are resolved relative to the directory of the rules file.
+    return sorted({os.path.join(base_dir, condition['value']) for condition in _list_file_conditions(data)})
+
+
+def resolve_list_files(data: Any, base_dir: str) -> Any:
+    # Replaces list file paths with the files' entries, so the compiled (and cached)
+    # rules do not depend on the files any more. The path is kept as list_file.
+    for condition in _list_file_conditions(data):
+        condition['list_file'] = condition['value']
+        condition['value'] = read_list_file(os.path.join(base_dir, condition['value']))
+    return data
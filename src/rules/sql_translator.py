@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from sqlalchemy import and_, false, func, not_, or_, true
+from sqlalchemy.sql.elements import ColumnElement
+from src.data.fulltext import FullTextIndex
+from src.data.models import Email
+from src.rules.predicates import Predicate
+from src.rules.rule_processor import EMAIL_FIELDS
+
+LIKE_ESCAPE = '\\'
+
+
+class UnsupportedConditionError(ValueError):
+    pass
+
+
+def escape_like(value: str) -> str:
+    return value.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2).replace('%', LIKE_ESCAPE + '%').replace('_', LIKE_ESCAPE + '_')
+
+
+def condition_to_sql(condition: Dict[str, str], now: datetime, fulltext: Optional[FullTextIndex] = None) -> ColumnElement:
+    field = condition['field']
+    predicate = condition['predicate']
+    value = condition['value']
+    if field not in EMAIL_FIELDS:
+        raise UnsupportedConditionError(f"Invalid condition field: {field}")
+    column = getattr(Email, field)
+
+    if predicate in ('contains', 'does_not_contain', 'equals', 'does_not_equal'):
+        text = func.coalesce(column, '')
+        if predicate in ('contains', 'does_not_contain'):
+            clause = text.ilike(f'%{escape_like(value)}%', escape=LIKE_ESCAPE)
+            indexed = fulltext.contains_clause(field, value, clause) if fulltext and predicate == 'contains' else None
+            if indexed is not None:
+                clause = indexed
+        else:
+            clause = func.lower(text) == value.lower()
+        if predicate.startswith('does_not'):
+            clause = not_(clause)
+        # A NULL body was never downloaded, so no body condition can be decided on it.
+        return and_(column.isnot(None), clause) if field == 'body' else clause
+
+    if predicate in ('greater_than', 'less_than'):
+        cutoff = now - Predicate.parse_time_value(value)
+        return column < cutoff if predicate == 'greater_than' else column > cutoff
+
+    raise UnsupportedConditionError(f"Predicate {predicate} cannot be evaluated in SQL")
+
+
+def rule_to_sql(rule: Dict[str, Any], now: Optional[datetime] = None,
+                fulltext: Optional[FullTextIndex] = None) -> ColumnElement:
+    now = now or datetime.now(timezone.utc)
+    clauses = [condition_to_sql(condition, now, fulltext) for condition in rule['conditions']]
+    predicate = rule['predicate'].upper()
+    if predicate == 'ALL':
+        return and_(true(), *clauses)
+    elif predicate == 'ANY':
+        return or_(false(), *clauses)
+    raise ValueError(f"Invalid rule predicate: {predicate}")
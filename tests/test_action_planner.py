@@ -0,0 +1,34 @@
+import pytest
+from unittest.mock import MagicMock
+from src.rules.action_planner import ActionPlanner
+
+@pytest.fixture
+def mock_gmail_service():
+    return MagicMock()
+
+@pytest.fixture
+def action_planner(mock_gmail_service):
+    return ActionPlanner(mock_gmail_service)
+
+def test_last_action_wins_per_label(action_planner, mock_gmail_service):
+    action_planner.mark_as_read('1')
+    action_planner.mark_as_unread('1')
+    action_planner.move_message('1', 'SPAM')
+    action_planner.move_message('1', 'TRASH')
+    action_planner.flush()
+    mock_gmail_service.batch_modify_messages.assert_called_once_with(
+        ['1'], add_labels=['TRASH', 'UNREAD'], remove_labels=['INBOX', 'SPAM']
+    )
+
+def test_messages_with_same_delta_are_grouped(action_planner, mock_gmail_service):
+    for message_id in ['1', '2', '3']:
+        action_planner.mark_as_read(message_id)
+    action_planner.move_message('4', 'INBOX')
+    assert action_planner.flush() == 2
+    assert mock_gmail_service.batch_modify_messages.call_count == 2
+    mock_gmail_service.batch_modify_messages.assert_any_call(['1', '2', '3'], add_labels=[], remove_labels=['UNREAD'])
+    assert action_planner.pending_count() == 0
+
+def test_unsupported_move_label_is_rejected(action_planner):
+    with pytest.raises(ValueError):
+        action_planner.move_message('1', 'ARCHIVE')
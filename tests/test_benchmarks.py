@@ -0,0 +1,41 @@
+import pytest
+from benchmarks.fake_gmail import QuotaGmailApi
+from benchmarks.run import main as run_benchmarks
+from benchmarks.synthetic import MailboxGenerator, generate_rules
+from googleapiclient.errors import HttpError
+from src.gmail.gmail_service import GmailService
+from src.rules.schema import validate_rules
+
+def test_generator_is_deterministic_and_parseable():
+    first = list(MailboxGenerator(seed=7).messages(50))
+    assert first == list(MailboxGenerator(seed=7).messages(50))
+    assert first != list(MailboxGenerator(seed=8).messages(50))
+    emails = [GmailService(None).parse_message(message['id'], message) for message in first]
+    assert all(email.body for email in emails)
+    assert any(message['payload']['mimeType'].startswith('multipart/') for message in first)
+
+def test_generated_rules_are_valid():
+    rules = generate_rules(200, seed=3, senders=MailboxGenerator().senders)
+    assert validate_rules({'rules': rules}) == rules
+
+def test_quota_fake_rejects_requests_over_budget():
+    clock = [0.0]
+    api = QuotaGmailApi([], units_per_second=10, clock=lambda: clock[0])
+    api.getProfile(userId='me').execute()
+    api.list(userId='me').execute()
+    with pytest.raises(HttpError):
+        api.list(userId='me').execute()
+    clock[0] = 1.5
+    api.list(userId='me').execute()
+    assert (api.units_charged, api.rejected) == (11, 1)
+
+def test_benchmark_run_reports_every_stage(tmp_path):
+    results = run_benchmarks(['--emails', '40', '--match-emails', '20', '--rules', '5', '--e2e-emails', '20',
+                              '--e2e-rules', '5', '--record-emails', '30', '--needles', '4', '--needle-text', '500', '--latency', '0', '--json', str(tmp_path / 'results.json')])
+    assert {entry['benchmark'] for entry in results} == {
+        'match[5 rules]', 'match_batch[5 rules]', 'parse[full]', 'parse[metadata]',
+        'persist[fulltext=off]', 'persist[fulltext=auto]', 'match_orm[30 emails]', 'match_record[30 emails]',
+        'needles_automaton[4]', 'needles_in[4]',
+        'end_to_end[sync]', 'end_to_end[pipeline]',
+    }
+    assert all(entry['items'] > 0 for entry in results)
@@ -0,0 +1,59 @@
+import io
+import json
+from datetime import datetime, timedelta, timezone
+from src.rules.dry_run import DryRun, rule_label_changes
+from src.rules.rule_processor import RuleMatcher
+
+RULES = [
+    {"name": "Read newsletters", "predicate": "ANY",
+     "conditions": [{"field": "sender", "predicate": "contains", "value": "news"},
+                    {"field": "subject", "predicate": "contains", "value": "digest"}],
+     "actions": [{"type": "MARK_AS_READ"}]},
+    {"name": "Flag invoices", "predicate": "ALL",
+     "conditions": [{"field": "subject", "predicate": "contains", "value": "invoice"}],
+     "actions": [{"type": "MARK_AS_UNREAD"}]},
+    {"name": "Old mail", "predicate": "ALL",
+     "conditions": [{"field": "received_date", "predicate": "greater_than", "value": "30 days"}],
+     "actions": [{"type": "MOVE_TO_TRASH"}]},
+]
+
+def make_rows():
+    now = datetime.now(timezone.utc)
+    return [
+        ('1', 'news@shop.com', 'me@example.com', 'Weekly deals', '', now),
+        ('2', 'billing@news.com', 'me@example.com', 'Your invoice', '', now),
+        ('3', 'friend@example.com', 'me@example.com', 'Invoice digest', '', now - timedelta(days=40)),
+        ('4', 'friend@example.com', 'me@example.com', 'Lunch?', '', now),
+    ]
+
+def test_label_changes_follow_the_actions():
+    assert rule_label_changes(RULES[0]) == {'UNREAD': False}
+    assert rule_label_changes(RULES[2]) == {'TRASH': True, 'INBOX': False, 'SPAM': False}
+
+def test_dry_run_reports_counts_overlaps_conflicts_and_explanations():
+    explain = io.StringIO()
+    dry_run = DryRun(RuleMatcher(RULES), explain=explain)
+    rows = make_rows()
+    report = dry_run.run([rows[:2], rows[2:]])
+
+    assert (report.emails, report.matched_emails) == (4, 3)
+    assert report.matches == [3, 2, 1]
+    assert report.overlaps == {(0, 1): 2, (0, 2): 1, (1, 2): 1}
+    assert report.conflicts == {(0, 1, 'UNREAD'): 2}
+    assert "Conflict: 'Flag invoices' overrides 'Read newsletters' on label UNREAD for 2 emails" in \
+        dry_run.summary(report)
+
+    lines = [json.loads(line) for line in explain.getvalue().splitlines()]
+    assert [line['message_id'] for line in lines] == ['1', '2', '3']
+    assert lines[2]['rules'] == [
+        {'rule': 'Read newsletters', 'decided_by': "subject contains 'digest'"},
+        {'rule': 'Flag invoices', 'decided_by': 'all conditions'},
+        {'rule': 'Old mail', 'decided_by': 'all conditions'},
+    ]
+
+def test_worker_processes_give_the_same_report():
+    rows = make_rows()
+    pages = [rows[:1], rows[1:3], rows[3:]]
+    single = DryRun(RuleMatcher(RULES)).run(pages)
+    parallel = DryRun(RuleMatcher(RULES), workers=2).run(pages)
+    assert parallel.as_dict(['a', 'b', 'c']) == single.as_dict(['a', 'b', 'c'])
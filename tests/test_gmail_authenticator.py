@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from google.oauth2.credentials import Credentials
+from src.auth.gmail_authenticator import CredentialStore, GmailAuthenticator, GmailServiceFactory
+from src.gmail.gmail_service import GmailService
+from benchmarks.fake_gmail import FakeGmailApi, make_message
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+def write_token(path, token, expiry):
+    path.write_text(json.dumps({
+        'token': token, 'refresh_token': 'refresh', 'client_id': 'id', 'client_secret': 'secret',
+        'scopes': SCOPES, 'expiry': expiry.strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }))
+
+def test_refresh_adopts_a_token_another_process_already_refreshed(tmp_path, monkeypatch):
+    token_file = tmp_path / 'token.json'
+    write_token(token_file, 'stale', datetime.utcnow() - timedelta(hours=1))
+    creds = CredentialStore(str(token_file), SCOPES).load()
+    assert not creds.valid
+    write_token(token_file, 'fresh', datetime.utcnow() + timedelta(hours=1))
+    def refresh(self, request):
+        raise AssertionError("refreshed although the token file had a valid token")
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+
+    creds.refresh(None)
+    assert (creds.token, creds.valid) == ('fresh', True)
+
+def test_concurrent_refreshes_hit_the_token_endpoint_once(tmp_path, monkeypatch):
+    token_file = tmp_path / 'token.json'
+    write_token(token_file, 'stale', datetime.utcnow() - timedelta(hours=1))
+    refreshes = []
+
+    def refresh(self, request):
+        time.sleep(0.05)
+        refreshes.append(self.token)
+        self.token = 'fresh'
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+
+    authenticator = GmailAuthenticator({'SCOPES': SCOPES}, token_file=str(token_file), interactive=False)
+    creds = authenticator.store.load()
+    threads = [threading.Thread(target=creds.refresh, args=(None,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert refreshes == ['stale']
+    assert json.loads(token_file.read_text())['token'] == 'fresh'
+    authenticator.authenticate()
+    assert authenticator.creds.token == 'fresh'
+
+def test_service_is_built_from_the_bundled_discovery_document(tmp_path):
+    token_file = tmp_path / 'token.json'
+    write_token(token_file, 'token', datetime.utcnow() + timedelta(hours=1))
+    authenticator = GmailAuthenticator({'SCOPES': SCOPES}, token_file=str(token_file), interactive=False)
+
+    service = GmailServiceFactory.create_service(authenticator)
+    assert service.users().messages().get(userId='me', id='abc').uri.startswith(
+        'https://gmail.googleapis.com/gmail/v1/users/me/messages/abc')
+
+def test_concurrent_fetches_reuse_pooled_transports():
+    fake_api = FakeGmailApi([make_message(f'id{i}') for i in range(400)], latency=0.01)
+    gmail_service = GmailService(fake_api, batch_size=100, concurrency=4, http_factory=object)
+
+    for _ in range(3):
+        assert len(gmail_service.get_emails([f'id{i}' for i in range(400)])) == 400
+    assert gmail_service.http_pool.created <= 4
+    assert gmail_service.http_pool.idle_count() == gmail_service.http_pool.created
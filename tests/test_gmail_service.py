@@ -1,8 +1,143 @@
 import pytest
-from src.gmail.gmail_service import GmailService
+from src.gmail.gmail_service import GmailService, HistoryExpiredError
 from unittest.mock import MagicMock
+from src.gmail.rate_limiter import TokenBucket
+from src.main import parse_args, sync_message_ids
+from benchmarks.fake_gmail import FakeGmailApi, http_error, make_message
 
 def test_gmail_service_initialization():
     mock_service = MagicMock()
     gmail_service = GmailService(mock_service)
-    assert gmail_service.service == mock_service
\ No newline at end of file
+    assert gmail_service.service == mock_service
+
+def test_batch_modify_messages_chunks_ids():
+    mock_service = MagicMock()
+    gmail_service = GmailService(mock_service)
+    gmail_service.batch_modify_messages([str(i) for i in range(2500)], remove_labels=['UNREAD'])
+    calls = mock_service.users().messages().batchModify.call_args_list
+    assert [len(call.kwargs['body']['ids']) for call in calls] == [1000, 1000, 500]
+    assert calls[0].kwargs['body']['removeLabelIds'] == ['UNREAD']
+
+def test_fetch_emails_batches_gets_and_preserves_output():
+    messages = [make_message(f'id{i}', subject=f'Subject {i}', body=f'Body {i}') for i in range(250)]
+    fake_api = FakeGmailApi(messages)
+    gmail_service = GmailService(fake_api, batch_size=100)
+
+    emails = gmail_service.fetch_emails(max_results=250)
+
+    # One list call, then the gets in batches of at most batch_size.
+    assert fake_api.http_calls == 4
+    assert fake_api.batch_sizes == [100, 100, 50]
+    assert [email.message_id for email in emails] == [f'id{i}' for i in range(250)]
+    expected = GmailService(FakeGmailApi(messages)).get_email_details('id7')
+    assert (emails[7].subject, emails[7].sender, emails[7].body, emails[7].received_date) == \
+        (expected.subject, expected.sender, expected.body, expected.received_date)
+
+def test_fetch_emails_runs_batches_concurrently():
+    messages = [make_message(f'id{i}') for i in range(400)]
+    fake_api = FakeGmailApi(messages, latency=0.1)
+    gmail_service = GmailService(fake_api, batch_size=100, concurrency=4, http_factory=object)
+
+    emails = gmail_service.fetch_emails(max_results=400)
+
+    assert len(emails) == 400
+    assert sorted(fake_api.batch_sizes) == [100] * 4
+    assert fake_api.max_in_flight > 1
+
+def test_fetch_emails_retries_rate_limited_messages():
+    messages = [make_message(f'id{i}') for i in range(3)]
+    fake_api = FakeGmailApi(messages, failures={'id1': [429, 503], 'id2': [404]})
+    gmail_service = GmailService(fake_api, backoff_base=0.001)
+
+    emails = gmail_service.fetch_emails(max_results=10)
+
+    assert [email.message_id for email in emails] == ['id0', 'id1']
+    # A deleted message is not worth holding the sync checkpoint back for.
+    assert gmail_service.unfetched_ids == set()
+
+def test_messages_given_up_on_are_recorded_as_unfetched():
+    messages = [make_message(f'id{i}') for i in range(3)]
+    fake_api = FakeGmailApi(messages, failures={'id1': [503, 503], 'id2': [500]})
+    gmail_service = GmailService(fake_api, max_retries=1, backoff_base=0.001)
+
+    assert [email.message_id for email in gmail_service.get_emails(['id0', 'id1', 'id2'])] == ['id0', 'id2']
+    assert gmail_service.unfetched_ids == {'id1'}
+
+def test_iter_email_pages_follows_page_tokens_lazily():
+    fake_api = FakeGmailApi([make_message(f'id{i}') for i in range(250)])
+    gmail_service = GmailService(fake_api)
+
+    pages = gmail_service.iter_email_pages(page_size=100)
+    first_page = next(pages)
+    assert len(first_page) == 100
+    assert fake_api.http_calls == 2
+
+    assert [len(page) for page in pages] == [100, 50]
+    assert [email.message_id for email in gmail_service.iter_emails(page_size=100, max_results=120)][-1] == 'id119'
+
+def test_get_history_changes_returns_added_messages_and_checkpoint():
+    fake_api = FakeGmailApi([make_message('old')], history_id=100)
+    gmail_service = GmailService(fake_api)
+    checkpoint = gmail_service.get_history_id()
+    for index in range(3):
+        fake_api.add_message(make_message(f'new{index}'))
+
+    message_ids, new_checkpoint = gmail_service.get_history_changes(checkpoint, page_size=2)
+
+    assert message_ids == ['new0', 'new1', 'new2']
+    assert new_checkpoint == '103'
+    assert gmail_service.get_history_changes(new_checkpoint) == ([], '103')
+
+def test_incremental_sync_skips_what_a_full_sync_would_not_list():
+    fake_api = FakeGmailApi([make_message('old', subject='Invoice 1')])
+    gmail_service = GmailService(fake_api)
+    sync_repo = MagicMock()
+    sync_repo.get_history_id.return_value = gmail_service.get_history_id()
+    fake_api.add_message(make_message('wanted', subject='Invoice 2'))
+    fake_api.add_message(make_message('spam', subject='Invoice 3'), label_ids=['SPAM', 'INBOX'])
+    fake_api.add_message(make_message('sent', subject='Invoice 4'), label_ids=['SENT'])
+    fake_api.add_message(make_message('off_query', subject='Lunch?'))
+
+    pages, checkpoint = sync_message_ids(parse_args(['--incremental', '--query', 'invoice']), gmail_service, sync_repo)
+    assert [message_id for page in pages for message_id in page] == ['wanted']
+    assert checkpoint == '104'
+
+def test_get_history_changes_raises_when_history_expired():
+    gmail_service = GmailService(FakeGmailApi([], oldest_history_id=50))
+    with pytest.raises(HistoryExpiredError):
+        gmail_service.get_history_changes('10')
+
+def test_metadata_fetch_leaves_body_unloaded_until_requested():
+    fake_api = FakeGmailApi([make_message(f'id{i}', body=f'Body {i}') for i in range(3)])
+    gmail_service = GmailService(fake_api)
+
+    emails = gmail_service.get_emails(['id0', 'id1', 'id2'], GmailService.FORMAT_METADATA)
+    assert [email.body for email in emails] == [None, None, None]
+    assert emails[1].subject == 'Subject'
+
+    gmail_service.load_bodies([emails[1]])
+    assert [email.body for email in emails] == [None, 'Body 1', None]
+    assert [get for get in fake_api.gets if get[1] == 'full'] == [('id1', 'full')]
+
+def test_batch_modify_retries_rate_limited_calls_and_throttles():
+    fake_api = FakeGmailApi([], modify_failures=[429, http_error(403, reason='userRateLimitExceeded', retry_after=0)])
+    limiter = TokenBucket(1000)
+    gmail_service = GmailService(fake_api, backoff_base=0.001, rate_limiter=limiter)
+    gmail_service.batch_modify_messages(['id1', 'id2'], add_labels=['TRASH'])
+    assert fake_api.modifications == [{'ids': ['id1', 'id2'], 'addLabelIds': ['TRASH']}]
+    assert limiter.throttle_count == 2
+    assert limiter.units_consumed == 150
+
+def test_forbidden_errors_are_not_retried(capsys):
+    fake_api = FakeGmailApi([], modify_failures=[http_error(403, reason='insufficientPermissions')])
+    gmail_service = GmailService(fake_api, backoff_base=0.001)
+    gmail_service.batch_modify_messages(['id1'], add_labels=['TRASH'])
+    assert fake_api.modifications == []
+    assert 'batch modifying' in capsys.readouterr().out
+
+def test_batched_fetch_charges_quota_per_message():
+    messages = [make_message(f'id{i}') for i in range(150)]
+    limiter = TokenBucket(10000)
+    gmail_service = GmailService(FakeGmailApi(messages), rate_limiter=limiter)
+    gmail_service.get_emails([f'id{i}' for i in range(150)])
+    assert limiter.units_consumed == 750
@@ -0,0 +1,125 @@
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.data.models import Base
+from src.data.repository import EmailRepository
+from src.gmail.gmail_service import GmailService
+from src.gmail.message_cache import MessageCache, RawMessageStore
+from src.pipeline import Pipeline
+from src.rules.rule_processor import RuleMatcher
+from benchmarks.fake_gmail import FakeGmailApi, make_message
+
+def make_messages(count):
+    return [dict(make_message(f'id{i}', subject=f'Subject {i}', body=f'Body {i}'), historyId='100')
+            for i in range(count)]
+
+def make_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'emails.db'}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+def test_memory_cache_serves_repeat_fetches_and_evicts_least_recent():
+    fake_api = FakeGmailApi(make_messages(4))
+    gmail_service = GmailService(fake_api, cache=MessageCache(capacity=3))
+
+    first = gmail_service.get_emails(['id0', 'id1', 'id2'])
+    assert gmail_service.get_emails(['id0', 'id1', 'id2']) == first
+    assert len(fake_api.gets) == 3
+
+    gmail_service.get_emails(['id3'])
+    assert len(gmail_service.cache) == 3
+    gmail_service.get_emails(['id0', 'id3'])
+    assert [get[0] for get in fake_api.gets] == ['id0', 'id1', 'id2', 'id3', 'id0']
+
+def test_memory_cache_is_bounded_by_body_bytes():
+    messages = [dict(make_message(f'id{i}', body='x' * 100), historyId='100') for i in range(4)]
+    cache = MessageCache(max_body_bytes=250)
+    gmail_service = GmailService(FakeGmailApi(messages), cache=cache)
+
+    gmail_service.get_emails(['id0', 'id1', 'id2'])
+    assert len(cache) == 2
+    emails = gmail_service.get_emails(['id3'], GmailService.FORMAT_METADATA)
+    gmail_service.load_bodies(emails)
+    assert len(cache) == 2 and 'id1' not in cache.lookup(['id1'])
+
+def test_metadata_records_do_not_answer_full_requests_until_bodies_load():
+    fake_api = FakeGmailApi(make_messages(2))
+    gmail_service = GmailService(fake_api, cache=MessageCache())
+
+    emails = gmail_service.get_emails(['id0', 'id1'], GmailService.FORMAT_METADATA)
+    gmail_service.load_bodies(emails[:1])
+    assert [email.body for email in gmail_service.get_emails(['id0', 'id1'])] == ['Body 0', 'Body 1']
+    assert fake_api.gets == [('id0', 'metadata'), ('id1', 'metadata'), ('id0', 'full'), ('id1', 'full')]
+
+def test_raw_store_survives_restarts_and_answers_metadata_requests(tmp_path):
+    fake_api = FakeGmailApi(make_messages(3))
+    GmailService(fake_api, cache=MessageCache(raw_store=RawMessageStore(str(tmp_path)))).get_emails(['id0', 'id1'])
+    assert os.path.exists(tmp_path / 'd0' / 'id0.full.json.z')
+
+    restarted = GmailService(fake_api, cache=MessageCache(raw_store=RawMessageStore(str(tmp_path))))
+    emails = restarted.get_emails(['id0', 'id1', 'id2'], GmailService.FORMAT_METADATA)
+    assert [(email.subject, email.body) for email in emails] == [('Subject 0', None), ('Subject 1', None),
+                                                                 ('Subject 2', None)]
+    assert restarted.get_email_details('id1').body == 'Body 1'
+    assert fake_api.gets == [('id0', 'full'), ('id1', 'full'), ('id2', 'metadata')]
+
+def test_stored_emails_are_read_from_the_database(tmp_path):
+    Session = make_session_factory(tmp_path)
+    fake_api = FakeGmailApi(make_messages(2))
+    emails = GmailService(fake_api).get_emails(['id0', 'id1'])
+    session = Session()
+    EmailRepository(session).add_new_emails(emails)
+    session.close()
+
+    gmail_service = GmailService(fake_api, cache=MessageCache(session_factory=Session))
+    assert gmail_service.get_email_details('id1').subject == 'Subject 1'
+    assert [email.body for email in gmail_service.get_emails(['id0', 'id1'])] == ['Body 0', 'Body 1']
+    assert len(fake_api.gets) == 2
+
+def test_newer_history_invalidates_cached_messages(tmp_path):
+    fake_api = FakeGmailApi(make_messages(1))
+    gmail_service = GmailService(fake_api, cache=MessageCache(raw_store=RawMessageStore(str(tmp_path))))
+    gmail_service.get_emails(['id0'])
+    checkpoint = gmail_service.get_history_id()
+    fake_api.add_message(dict(make_message('id0', subject='Edited'), historyId='101'))
+
+    assert gmail_service.get_history_changes(checkpoint)[0] == ['id0']
+    assert gmail_service.get_emails(['id0'])[0].subject == 'Edited'
+    assert len(fake_api.gets) == 2
+
+def test_newer_history_bypasses_the_stored_row(tmp_path):
+    Session = make_session_factory(tmp_path)
+    fake_api = FakeGmailApi(make_messages(1))
+    session = Session()
+    EmailRepository(session).add_new_emails(GmailService(fake_api).get_emails(['id0']))
+    session.close()
+    gmail_service = GmailService(fake_api, cache=MessageCache(session_factory=Session))
+    checkpoint = gmail_service.get_history_id()
+    fake_api.add_message(dict(make_message('id0', subject='Edited'), historyId='101'))
+
+    gmail_service.get_history_changes(checkpoint)
+    assert gmail_service.get_emails(['id0'])[0].subject == 'Edited'
+    assert gmail_service.get_emails(['id0'])[0].subject == 'Edited'
+    assert len(fake_api.gets) == 2
+
+def test_raw_store_removes_the_oldest_files_beyond_its_limit(tmp_path):
+    store = RawMessageStore(str(tmp_path), max_bytes=2000)
+    for i in range(20):
+        store.put(f'id{i}', {'id': f'id{i}', 'raw': os.urandom(100).hex()})
+        # Distinct mtimes, oldest first, whatever the filesystem's timestamp resolution.
+        os.utime(store._path(f'id{i}', 'full'), (i, i))
+    assert sum(size for _, size, _ in store._files()) <= 2000
+    assert store.get('id19') is not None and store.get('id0') is None
+
+def test_pipeline_reuses_cached_messages(tmp_path):
+    Session = make_session_factory(tmp_path)
+    fake_api = FakeGmailApi(make_messages(20))
+    gmail_service = GmailService(fake_api, cache=MessageCache(session_factory=Session))
+    matcher = RuleMatcher([{"name": "All", "predicate": "ANY",
+                            "conditions": [{"field": "subject", "predicate": "contains", "value": "subject"}],
+                            "actions": [{"type": "MARK_AS_READ"}]}])
+
+    for _ in range(2):
+        report = Pipeline(gmail_service, Session, matcher).run(gmail_service.iter_message_ids(page_size=10))
+        assert report['parse']['items'] == 20
+    assert len(fake_api.gets) == 20
@@ -0,0 +1,81 @@
+import json
+import pytest
+from datetime import datetime, timezone
+from src.data.models import Email
+from src.gmail.gmail_service import GmailService
+from src.metrics import MetricsRegistry, metrics
+from src.rules.rule_processor import RuleMatcher
+from benchmarks.fake_gmail import FakeGmailApi, make_message
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+def test_histogram_quantiles_and_prometheus_output():
+    registry = MetricsRegistry()
+    registry.enable()
+    for value in (0.00002, 0.00002, 0.003, 40.0):
+        registry.observe('stage_seconds', value, stage='parse')
+    registry.increment('calls_total', 3, method='messages.get')
+    histogram = registry.histogram('stage_seconds', stage='parse')
+    assert (histogram.count, histogram.quantile(0.5), histogram.quantile(0.75), histogram.quantile(1.0)) == \
+        (4, 0.00005, 0.005, None)
+    text = registry.render('prometheus')
+    assert 'calls_total{method="messages.get"} 3' in text
+    assert 'stage_seconds_bucket{stage="parse",le="5e-05"} 2' in text
+    assert 'stage_seconds_bucket{stage="parse",le="+Inf"} 4' in text
+    assert json.loads(registry.render('json'))['histograms']['stage_seconds'][0]['count'] == 4
+    with pytest.raises(ValueError):
+        registry.render('xml')
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry()
+    calls = []
+
+    @registry.timed('work_seconds')
+    def work():
+        calls.append(1)
+    work()
+    registry.observe('stage_seconds', 1.0)
+    registry.increment('calls_total')
+    assert calls == [1]
+    assert registry.as_dict()['histograms'] == {} and registry.as_dict()['counters'] == {}
+
+def test_profiled_match_agrees_and_ranks_rules(enabled_metrics):
+    rules = [
+        {'name': 'Invoices', 'predicate': 'ALL', 'conditions': [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'invoice'},
+            {'field': 'sender', 'predicate': 'contains', 'value': 'billing'}], 'actions': []},
+        {'name': 'Spam', 'predicate': 'ANY', 'conditions': [
+            {'field': 'sender', 'predicate': 'equals', 'value': 'spam@spammer.com'}], 'actions': []},
+    ]
+    emails = [
+        Email.create('1', 'billing@shop.com', 'me@example.com', 'Your invoice', '', NOW),
+        Email.create('2', 'spam@spammer.com', 'me@example.com', 'Offer', '', NOW),
+        Email.create('3', 'friend@example.com', 'me@example.com', 'Invoice?', '', NOW),
+    ]
+    matcher = RuleMatcher(rules)
+    profiled = [matcher.match(email) for email in emails]
+    enabled_metrics.disable()
+    assert profiled == [matcher.match(email) for email in emails]
+
+    top = {rule['rule']: rule for rule in enabled_metrics.top_rules()}
+    # The needle prefilter rules out the spam message before Invoices is evaluated.
+    assert top['Invoices']['evaluations'] == 2 and top['Invoices']['hit_rate'] == 0.5
+    assert top['Spam']['index'] == 1
+    assert enabled_metrics.counter_value('rule_hits_total', rule='Spam', index=1) == 1
+    assert enabled_metrics.histogram('predicate_seconds', predicate='contains', field='sender').count >= 1
+
+def test_gmail_service_counts_calls_and_quota_units(enabled_metrics):
+    messages = [make_message(f'id{i}') for i in range(30)]
+    gmail_service = GmailService(FakeGmailApi(messages), batch_size=10)
+    gmail_service.fetch_emails(max_results=30)
+    assert enabled_metrics.counter_value('gmail_api_calls_total', method='messages.get') == 30
+    assert enabled_metrics.counter_value('gmail_quota_units_total', method='messages.get') == 150
+    assert enabled_metrics.histogram('gmail_request_seconds', method='batch').count == 3
@@ -0,0 +1,62 @@
+import base64
+from src.gmail.gmail_service import GmailService
+from src.gmail.mime import extract_body, html_to_text, iter_parts
+from unittest.mock import MagicMock
+
+def encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def part(mime_type, raw=b'', charset=None, filename='', parts=None):
+    headers = [{'name': 'Content-Type', 'value': mime_type + (f'; charset="{charset}"' if charset else '')}]
+    node = {'mimeType': mime_type, 'filename': filename, 'headers': headers, 'body': {'data': encode(raw)} if raw else {}}
+    if parts is not None:
+        node['parts'] = parts
+    return node
+
+def test_iter_parts_walks_nested_multipart_in_order():
+    payload = part('multipart/mixed', parts=[
+        part('multipart/alternative', parts=[part('text/plain', b'a'), part('text/html', b'b')]),
+        part('application/pdf', b'c', filename='c.pdf'),
+    ])
+    assert [p['mimeType'] for p in iter_parts(payload)] == ['text/plain', 'text/html', 'application/pdf']
+
+def test_extract_body_prefers_nested_plain_text_and_skips_attachments():
+    payload = part('multipart/mixed', parts=[
+        part('text/plain', b'attached notes', filename='notes.txt'),
+        part('multipart/related', parts=[
+            part('multipart/alternative', parts=[part('text/html', b'<p>html</p>'), part('text/plain', b'plain')]),
+        ]),
+    ])
+    assert extract_body(payload) == 'plain'
+
+def test_extract_body_respects_charset():
+    payload = part('multipart/alternative', parts=[part('text/plain', 'Grüße'.encode('iso-8859-1'), charset='ISO-8859-1')])
+    assert extract_body(payload) == 'Grüße'
+
+def test_extract_body_replaces_undecodable_bytes_and_unknown_charsets():
+    assert extract_body(part('text/plain', b'ok \xff')) == 'ok �'
+    assert extract_body(part('text/plain', b'ok', charset='x-unknown')) == 'ok'
+
+def test_extract_body_truncates_before_decoding():
+    raw = ('é' * 1000).encode('utf-8')
+    body = extract_body(part('text/plain', raw), max_bytes=101)
+    assert body == 'é' * 50
+    assert extract_body(part('text/plain', raw), max_bytes=None) == 'é' * 1000
+
+def test_extract_body_falls_back_to_html():
+    html = b'<html><head><style>p {}</style></head><body><p>Hello&nbsp;<b>World</b></p><div>Bye</div></body></html>'
+    payload = part('multipart/alternative', parts=[part('text/html', html)])
+    assert extract_body(payload) == 'Hello World\nBye'
+    assert extract_body(payload, html_fallback=False) == ''
+
+def test_extract_body_uses_any_single_part_payload():
+    assert extract_body(part('text/calendar', b'BEGIN:VCALENDAR')) == 'BEGIN:VCALENDAR'
+    assert extract_body({'body': {'data': encode(b'untyped')}}) == 'untyped'
+    assert extract_body(part('multipart/mixed', parts=[part('text/calendar', b'BEGIN:VCALENDAR')])) == ''
+
+def test_html_to_text_skips_scripts():
+    assert html_to_text('<script>var x = 1;</script>Text<br>More') == 'Text\nMore'
+
+def test_gmail_service_uses_configured_body_limit():
+    gmail_service = GmailService(MagicMock(), max_body_bytes=5)
+    assert gmail_service.get_email_body({'payload': part('text/plain', b'0123456789')}) == '01234'
@@ -0,0 +1,34 @@
+import pytest
+from src.main import parse_args
+from src.multi_account import AccountResult, account_name, read_account_list, run_accounts, unsupported_flags
+
+def fake_worker(token_file, argv):
+    if 'broken' in token_file:
+        raise RuntimeError("token revoked")
+    return AccountResult(account_name(token_file), len(argv), 0.0)
+
+def test_read_account_list_skips_blanks_and_comments(tmp_path):
+    accounts_file = tmp_path / 'accounts.txt'
+    accounts_file.write_text("tokens/a.json\n\n# disabled\ntokens/b.json\n")
+    assert read_account_list(str(accounts_file)) == ['tokens/a.json', 'tokens/b.json']
+    assert account_name('tokens/b.json').startswith('b-')
+
+def test_accounts_with_the_same_token_file_name_stay_apart(tmp_path):
+    assert account_name('a/token.json') != account_name('b/token.json')
+    assert account_name('a/token.json') == account_name('a/../a/token.json')
+    accounts_file = tmp_path / 'accounts.txt'
+    accounts_file.write_text("a/token.json\nb/token.json\na/./token.json\n")
+    with pytest.raises(ValueError, match='a/./token.json, a/token.json'):
+        read_account_list(str(accounts_file))
+
+def test_only_supported_sync_flags_are_accepted():
+    assert unsupported_flags(parse_args(['--all', '--incremental', '--query', 'in:inbox', '--rules', 'x.json'])) == []
+    assert unsupported_flags(parse_args(['--pipeline', '--dry-run', '--metrics', 'json'])) == \
+        ['--dry-run', '--pipeline', '--metrics']
+
+def test_run_accounts_aggregates_results_and_failures():
+    results = run_accounts(['a.json', 'broken.json', 'c.json'], ['--all'], workers=2, worker=fake_worker)
+    assert [result.account.partition('-')[0] for result in results] == ['a', 'broken', 'c']
+    assert [result.processed for result in results] == [1, 0, 1]
+    assert results[1].error == "RuntimeError: token revoked"
+    assert results[0].error is None
@@ -0,0 +1,64 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.data.models import Base
+from src.data.repository import AppliedActionRepository, EmailRepository
+from src.gmail.gmail_service import GmailService
+from src.pipeline import Pipeline, parse_workers
+from src.rules.rule_processor import RuleMatcher
+from benchmarks.fake_gmail import FakeGmailApi, make_message
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'emails.db'}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+@pytest.fixture
+def rule_matcher():
+    return RuleMatcher([{
+        "name": "Spam",
+        "predicate": "ANY",
+        "conditions": [{"field": "subject", "predicate": "contains", "value": "spam"}],
+        "actions": [{"type": "MOVE_TO_SPAM"}]
+    }])
+
+def test_pipeline_persists_and_acts_on_every_page(session_factory, rule_matcher):
+    messages = [make_message(f'id{i}', subject='spam offer' if i % 10 == 0 else 'hello') for i in range(250)]
+    fake_api = FakeGmailApi(messages, latency=0.005)
+    gmail_service = GmailService(fake_api, batch_size=50)
+    id_pages = gmail_service.iter_message_ids(page_size=50)
+
+    pipeline = Pipeline(gmail_service, session_factory, rule_matcher, workers={'fetch': 3, 'act': 2}, queue_size=2)
+    report = pipeline.run(id_pages)
+
+    assert [report[stage]['items'] for stage in ('list', 'fetch', 'parse', 'persist')] == [250] * 4
+    assert report['act']['items'] == 250
+    session = session_factory()
+    assert len(EmailRepository(session).existing_message_ids(f'id{i}' for i in range(250))) == 250
+    session.close()
+    moved = sorted(message_id for body in fake_api.modifications for message_id in body['ids'])
+    assert moved == sorted(f'id{i}' for i in range(0, 250, 10))
+    assert all(body['addLabelIds'] == ['SPAM'] for body in fake_api.modifications)
+
+def test_pipeline_skips_already_stored_messages(session_factory, rule_matcher):
+    fake_api = FakeGmailApi([make_message('id0', subject='spam')])
+    gmail_service = GmailService(fake_api)
+    Pipeline(gmail_service, session_factory, rule_matcher).run(gmail_service.iter_message_ids())
+    report = Pipeline(gmail_service, session_factory, rule_matcher).run(gmail_service.iter_message_ids())
+    assert report['act']['items'] == 0
+    assert len(fake_api.modifications) == 1
+
+def test_parse_workers_overrides_defaults():
+    workers = parse_workers('fetch=8, act=3')
+    assert workers['fetch'] == 8 and workers['act'] == 3 and workers['persist'] == 1
+    with pytest.raises(ValueError):
+        parse_workers('download=2')
+
+def test_pipeline_records_applied_actions(session_factory, rule_matcher):
+    fake_api = FakeGmailApi([make_message(f'id{i}', subject='spam' if i % 2 else 'hello') for i in range(20)])
+    gmail_service = GmailService(fake_api)
+    Pipeline(gmail_service, session_factory, rule_matcher, action_log=True).run(gmail_service.iter_message_ids())
+    session = session_factory()
+    assert AppliedActionRepository(session).status_counts() == {'applied': 10}
+    session.close()
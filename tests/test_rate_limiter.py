@@ -0,0 +1,52 @@
+from src.gmail.rate_limiter import TokenBucket, quota_units
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def test_quota_units_per_method():
+    assert quota_units('messages.get') == 5
+    assert quota_units('messages.get', 100) == 500
+    assert quota_units('messages.batchModify') == 50
+    assert quota_units('history.list') == 2
+
+def test_token_bucket_allows_burst_then_enforces_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(100, clock=clock, sleep=clock.sleep)
+    for _ in range(20):
+        bucket.acquire(5)
+    assert clock.sleeps == []
+    for _ in range(20):
+        bucket.acquire(5)
+    assert clock.now == 1.0
+    assert bucket.units_consumed == 200
+
+def test_token_bucket_charges_requests_larger_than_capacity():
+    clock = FakeClock()
+    bucket = TokenBucket(100, clock=clock, sleep=clock.sleep)
+    bucket.acquire(500)
+    assert clock.now == 4.0
+
+def test_token_bucket_throttles_and_recovers():
+    bucket = TokenBucket(160)
+    bucket.throttle()
+    bucket.throttle()
+    assert bucket.rate == 40
+    for _ in range(5):
+        bucket.relax()
+    assert bucket.rate == 80
+    for _ in range(100):
+        bucket.throttle()
+    assert bucket.rate == 10
+    for _ in range(100):
+        bucket.relax()
+    assert bucket.rate == 160
+    assert bucket.throttle_count == 102
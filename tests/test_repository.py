@@ -0,0 +1,100 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+from src.data.models import AppliedAction, Base, Email, create_schema
+from src.data.record import EmailRecord
+from src.data.repository import AppliedActionRepository, EmailRepository, SyncStateRepository
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+@pytest.fixture
+def email_repo(session):
+    return EmailRepository(session)
+
+def make_email(index, **overrides):
+    values = dict(
+        message_id=f'msg-{index}',
+        sender=f'sender{index}@example.com',
+        recipient='recipient@example.com',
+        subject=f'Subject {index}',
+        body=f'Body {index}',
+        received_date=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index)
+    )
+    values.update(overrides)
+    return Email.create(**values)
+
+def test_iter_email_rows_yields_batches(email_repo):
+    for index in range(5):
+        email_repo.add_email(make_email(index))
+    batches = list(email_repo.iter_email_rows(batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0].message_id == 'msg-0'
+    assert batches[2][0].subject == 'Subject 4'
+
+def test_email_records_are_stored_in_bulk_and_read_back(email_repo):
+    records = [EmailRecord.from_email(make_email(index, subject=f'Mixed CASE {index}')) for index in range(3)]
+    records[1].body = 'Loaded Later'
+    assert (records[1].subject_lower, records[1].body_lower) == ('mixed case 1', 'loaded later')
+    assert records[0].received_at == datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert email_repo.add_new_emails(records) == records
+    stored = email_repo.get_email_by_message_id('msg-1')
+    assert (stored.subject, stored.body) == ('Mixed CASE 1', 'Loaded Later')
+    row = next(email_repo.iter_email_rows())[2]
+    assert EmailRecord.from_email(row).to_row() == records[2].to_row()
+
+def test_sync_state_checkpoint_round_trip(session):
+    sync_repo = SyncStateRepository(session)
+    assert sync_repo.get_history_id() is None
+    sync_repo.save_history_id('12345')
+    sync_repo.save_history_id('12350')
+    assert sync_repo.get_history_id() == '12350'
+    assert sync_repo.get_history_id('other@example.com') is None
+
+def test_existing_message_ids_and_add_new_emails(email_repo):
+    email_repo.add_email(make_email(0))
+    assert email_repo.existing_message_ids(['msg-0', 'msg-1']) == {'msg-0'}
+
+    new_emails = email_repo.add_new_emails([make_email(0), make_email(1), make_email(2), make_email(1)])
+
+    assert [email.message_id for email in new_emails] == ['msg-1', 'msg-2']
+    assert email_repo.existing_message_ids(f'msg-{i}' for i in range(1200)) == {'msg-0', 'msg-1', 'msg-2'}
+
+def test_upsert_emails_inserts_and_updates(email_repo):
+    email_repo.bulk_insert([make_email(0), make_email(1)])
+    email_repo.upsert_emails([make_email(1, subject='Updated'), make_email(2)])
+
+    emails = {email.message_id: email for email in email_repo.get_all_emails()}
+    assert sorted(emails) == ['msg-0', 'msg-1', 'msg-2']
+    assert emails['msg-1'].subject == 'Updated'
+
+def test_applied_action_log_tracks_status(session):
+    action_log = AppliedActionRepository(session)
+    keys = [('msg-1', 'hash', 'read'), ('msg-1', 'hash', 'spam'), ('msg-2', 'hash', 'read')]
+    action_log.record_pending(keys)
+    action_log.mark(keys[:2], AppliedAction.STATUS_APPLIED)
+    action_log.mark(keys[2:], AppliedAction.STATUS_FAILED)
+    assert action_log.applied_keys(['msg-1', 'msg-2']) == set(keys[:2])
+    assert [(row.message_id, row.action) for rows in action_log.iter_unfinished() for row in rows] == [('msg-2', 'read')]
+
+    action_log.record_pending(keys[2:])
+    assert session.query(AppliedAction.attempts).filter(AppliedAction.message_id == 'msg-2').scalar() == 2
+    assert action_log.status_counts() == {'applied': 2, 'pending': 1}
+
+def test_schema_setup_adds_missing_indexes_to_existing_tables():
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE emails (id INTEGER PRIMARY KEY, message_id VARCHAR(255) NOT NULL UNIQUE, "
+            "sender VARCHAR(255) NOT NULL, recipient VARCHAR(255) NOT NULL, subject VARCHAR(255), body TEXT, "
+            "received_date DATETIME NOT NULL)"))
+    create_schema(engine)
+    indexed = {tuple(index['column_names']) for index in inspect(engine).get_indexes('emails')}
+    assert {('sender',), ('subject',), ('received_date',)} <= indexed
+    create_schema(engine)
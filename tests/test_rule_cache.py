@@ -0,0 +1,136 @@
+import json
+import os
+import pytest
+from datetime import datetime, timezone
+from src.data.models import Email
+from src.rules import rule_cache
+from src.rules.rule_cache import RuleSetCache, RuleSetWatcher
+from src.rules.rule_processor import RuleMatcher
+from src.rules.schema import RuleValidationError, validate_rules
+
+def make_rules(value):
+    return {"rules": [{
+        "name": "Match", "predicate": "ANY",
+        "conditions": [{"field": "subject", "predicate": "contains", "value": value},
+                       {"field": "received_date", "predicate": "greater_than", "value": "2 days"}],
+        "actions": [{"type": "MARK_AS_READ"}]
+    }]}
+
+def write_rules(path, rules, mtime=None):
+    path.write_text(json.dumps(rules))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def email(subject):
+    return Email.create('1', 'a@example.com', 'me@example.com', subject, '', datetime.now(timezone.utc))
+
+def test_validate_rules_reports_every_problem():
+    rules = {"rules": [{
+        "predicate": "SOME",
+        "conditions": [{"field": "cc", "predicate": "contains", "value": "x"},
+                       {"field": "subject", "predicate": "greater_than", "value": "1 day"},
+                       {"field": "received_date", "predicate": "less_than", "value": "1 fortnight"}],
+        "actions": [{"type": "ARCHIVE"}]
+    }]}
+    with pytest.raises(RuleValidationError) as excinfo:
+        validate_rules(rules)
+    assert excinfo.value.errors == [
+        "rules[0].predicate: must be one of ALL, ANY",
+        "rules[0].conditions[0].field: must be one of sender, recipient, subject, body, received_date",
+        "rules[0].conditions[1]: predicate greater_than cannot be used with field subject",
+        "rules[0].conditions[2].value: Unsupported time unit: fortnight",
+        "rules[0].actions[0].type: must be one of MARK_AS_READ, MARK_AS_UNREAD, MOVE_TO_INBOX, MOVE_TO_SPAM, MOVE_TO_TRASH",
+    ]
+    assert validate_rules(make_rules('x')) == make_rules('x')['rules']
+
+def test_compiled_rules_are_cached_on_disk_by_content(tmp_path, monkeypatch):
+    rules_file = tmp_path / 'rules.json'
+    write_rules(rules_file, make_rules('invoice'))
+    cache_dir = str(tmp_path / 'cache')
+    matcher, digest = RuleSetCache(cache_dir).load(str(rules_file))
+    assert os.listdir(cache_dir) == [f'{digest}.pickle']
+
+    def fail(*args, **kwargs):
+        raise AssertionError("rules were recompiled")
+    monkeypatch.setattr(RuleMatcher, '__init__', fail)
+    cached = RuleSetCache(cache_dir).load_matcher(str(rules_file))
+    assert cached is not matcher
+    assert cached.match(email('Your INVOICE')) == matcher.rules
+    assert cached.match(email('hello')) == []
+    assert cached.referenced_fields == {'subject', 'received_date'}
+
+def test_cached_rules_are_keyed_by_code_version_and_must_be_private(tmp_path, monkeypatch):
+    rules_file = tmp_path / 'rules.json'
+    write_rules(rules_file, make_rules('invoice'))
+    cache_dir = tmp_path / 'cache'
+    _, digest = RuleSetCache(str(cache_dir)).load(str(rules_file))
+
+    monkeypatch.setattr(rule_cache, 'code_version', lambda: 'another version')
+    assert RuleSetCache(str(cache_dir)).load(str(rules_file))[1] != digest
+    monkeypatch.undo()
+
+    # A cache file others could have written is recompiled rather than unpickled.
+    os.chmod(cache_dir / f'{digest}.pickle', 0o666)
+    compiled = []
+    original_init = RuleMatcher.__init__
+    monkeypatch.setattr(RuleMatcher, '__init__', lambda self, rules: compiled.append(1) or original_init(self, rules))
+    RuleSetCache(str(cache_dir)).load(str(rules_file))
+    assert compiled == [1]
+
+def test_watcher_swaps_valid_versions_and_keeps_rules_on_invalid_ones(tmp_path):
+    rules_file = tmp_path / 'rules.json'
+    write_rules(rules_file, make_rules('invoice'), mtime=1000)
+    watcher = RuleSetWatcher(str(rules_file))
+    assert not watcher.poll()
+    in_flight = watcher.matcher
+
+    write_rules(rules_file, make_rules('receipt'), mtime=2000)
+    assert watcher.poll()
+    assert watcher.matcher.match(email('receipt'))
+    assert in_flight.match(email('invoice'))
+
+    rules_file.write_text('{"rules": [{"predicate": "ALL"')
+    os.utime(rules_file, (3000, 3000))
+    assert not watcher.poll()
+    assert watcher.matcher.match(email('receipt'))
+
+def test_validate_rules_checks_regex_and_list_predicates():
+    rules = {"rules": [{
+        "predicate": "ANY",
+        "conditions": [{"field": "subject", "predicate": "domain_in", "value": ["spam.com"]},
+                       {"field": "subject", "predicate": "matches_regex", "value": "(unclosed"},
+                       {"field": "sender", "predicate": "in_list", "value": [1, 2]},
+                       {"field": "sender", "predicate": "domain_in", "value": "blocked.txt"}],
+        "actions": []
+    }]}
+    with pytest.raises(RuleValidationError) as excinfo:
+        validate_rules(rules)
+    assert excinfo.value.errors[0] == "rules[0].conditions[0]: predicate domain_in cannot be used with field subject"
+    assert excinfo.value.errors[1].startswith("rules[0].conditions[1].value: invalid regular expression")
+    assert excinfo.value.errors[2:] == ["rules[0].conditions[2].value: must be a list of strings or the path of a list file"]
+
+def test_watcher_reloads_when_a_list_file_changes(tmp_path):
+    (tmp_path / 'blocked.txt').write_text("spam.com\n")
+    os.utime(tmp_path / 'blocked.txt', (1000, 1000))
+    rules_file = tmp_path / 'rules.json'
+    write_rules(rules_file, {"rules": [{
+        "name": "Blocked", "predicate": "ANY",
+        "conditions": [{"field": "sender", "predicate": "domain_in", "value": "blocked.txt"}],
+        "actions": [{"type": "MOVE_TO_SPAM"}]
+    }]}, mtime=1000)
+    watcher = RuleSetWatcher(str(rules_file), RuleSetCache(str(tmp_path / 'cache')))
+    assert watcher.list_files == [str(tmp_path / 'blocked.txt')]
+    sender = lambda address: Email.create('1', address, 'me@example.com', 's', '', datetime.now(timezone.utc))
+    assert watcher.matcher.match(sender('a@spam.com')) and not watcher.matcher.match(sender('a@junk.net'))
+    digest = watcher.matcher.compiled_rules[0].digest
+
+    (tmp_path / 'blocked.txt').write_text("spam.com\njunk.net\n")
+    os.utime(tmp_path / 'blocked.txt', (2000, 2000))
+    assert watcher.poll()
+    assert watcher.matcher.match(sender('a@junk.net'))
+    matcher, cached_digest = RuleSetCache(str(tmp_path / 'cache')).load(str(rules_file))
+    assert cached_digest == watcher.digest
+    # Editing a list file keeps the rule's hash, so its actions are not re-applied to
+    # the messages it already handled; the hashes survive the on-disk cache.
+    assert watcher.matcher.compiled_rules[0].digest == digest
+    assert matcher.rule_hashes == {id(matcher.rules[0]): digest}
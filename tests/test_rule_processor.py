@@ -1,9 +1,16 @@
 import pytest
 from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.rules.action_planner import ActionPlanner
 from src.rules.rule_processor import RuleProcessor, RuleMatcher
+from src.rules.needle_index import AUTOMATON_MIN_NEEDLES
 from src.rules.actions import Action
-from src.data.models import Email
+from src.data.models import Base, Email
+from src.data.repository import AppliedActionRepository, EmailRepository
+from src.gmail.gmail_service import GmailService
+from benchmarks.fake_gmail import FakeGmailApi
 
 @pytest.fixture
 def sample_rules():
@@ -126,7 +133,7 @@ def test_process_email_applies_action(rule_processor):
         received_date=datetime.now(timezone.utc) - timedelta(days=2)
     )
     rule_processor.process_email(old_email)
-    rule_processor.gmail_service.mark_as_unread.assert_called_once_with(old_email.message_id)
+    rule_processor.action_planner.mark_as_unread.assert_called_once_with(old_email.message_id)
 
 def test_process_email_does_not_apply_action(rule_processor):
     recent_email = Email.create(
@@ -138,7 +145,7 @@ def test_process_email_does_not_apply_action(rule_processor):
         received_date=datetime.now(timezone.utc) - timedelta(hours=1)
     )
     rule_processor.process_email(recent_email)
-    rule_processor.gmail_service.mark_as_unread.assert_not_called()
+    rule_processor.action_planner.mark_as_unread.assert_not_called()
 
 def test_apply_actions(rule_processor):
     email = Email.create(
@@ -151,7 +158,7 @@ def test_apply_actions(rule_processor):
     )
     rule = rule_processor.rule_matcher.rules[1]  # "Move spam to Spam folder" rule
     rule_processor.apply_actions(rule, email)
-    rule_processor.gmail_service.move_message.assert_called_once_with(email.message_id, 'SPAM')
+    rule_processor.action_planner.move_message.assert_called_once_with(email.message_id, 'SPAM')
 
 # Test for RuleProcessor.from_file class method
 def test_rule_processor_from_file(sample_rules, tmp_path, mock_gmail_service):
@@ -165,4 +172,213 @@ def test_rule_processor_from_file(sample_rules, tmp_path, mock_gmail_service):
     assert isinstance(rule_processor, RuleProcessor)
     assert isinstance(rule_processor.rule_matcher, RuleMatcher)
     assert len(rule_processor.rule_matcher.rules) == 2
-    assert rule_processor.gmail_service == mock_gmail_service
+    assert rule_processor.action_planner == mock_gmail_service
+
+def test_rule_matcher_short_circuits_any(rule_matcher):
+    # Compiled rules read the pre-lowered fields of an EmailRecord.
+    email = MagicMock()
+    email.subject_lower = 'this is spam'
+    type(email).sender_lower = property(lambda self: pytest.fail("sender should not be read"))
+    spam_rule = rule_matcher.compiled_rules[1]
+    assert spam_rule.matches(email)
+
+def test_rule_matcher_rejects_invalid_rules():
+    with pytest.raises(ValueError):
+        RuleMatcher([{"name": "bad", "predicate": "SOME", "conditions": [], "actions": []}])
+    with pytest.raises(ValueError):
+        RuleMatcher([{
+            "name": "bad",
+            "predicate": "ALL",
+            "conditions": [{"field": "cc", "predicate": "contains", "value": "x"}],
+            "actions": []
+        }])
+
+def test_rule_matcher_needle_index_matches_direct_evaluation():
+    rules = [
+        {
+            "name": f"rule {i}",
+            "predicate": "ALL" if i % 2 else "ANY",
+            "conditions": [
+                {"field": "subject", "predicate": "contains", "value": f"Topic{i}"},
+                {"field": "sender", "predicate": "does_not_contain" if i % 3 else "equals", "value": f"user{i}@example.com"},
+            ],
+            "actions": [{"type": "MARK_AS_READ"}]
+        }
+        # Enough subject needles for the automaton.
+        for i in range(AUTOMATON_MIN_NEEDLES + 10)
+    ]
+    matcher = RuleMatcher(rules)
+    for i in range(45):
+        email = Email.create(
+            message_id=str(i),
+            sender=f"user{i % 7}@example.com",
+            recipient='recipient@example.com',
+            subject=f"Weekly topic{i} digest",
+            body='',
+            received_date=datetime.now(timezone.utc)
+        )
+        expected = [rule for rule in rules if matcher.rule_matches(rule, email)]
+        assert matcher.match(email) == expected
+
+def test_match_batch_agrees_with_match(rule_matcher):
+    now = datetime.now(timezone.utc)
+    emails = [
+        Email.create(
+            message_id=str(i),
+            sender='spammer@spammer.com' if i % 4 == 0 else 'friend@example.com',
+            recipient='recipient@example.com',
+            subject='Buy now SPAM' if i % 3 == 0 else 'Hello',
+            body='',
+            received_date=now - timedelta(hours=10 * i)
+        )
+        for i in range(100)
+    ]
+    matrix = rule_matcher.match_batch(emails, now=now)
+    assert len(matrix) == 2
+    for index, email in enumerate(emails):
+        assert matrix.matching_rules(index) == rule_matcher.match(email)
+    assert matrix[1] == [i % 4 == 0 or i % 3 == 0 for i in range(100)]
+    assert matrix.match_count(1) == sum(matrix[1])
+
+def test_match_batch_agrees_with_match_when_text_contains_nul():
+    contains = lambda value: {"name": repr(value), "predicate": "ALL",
+                              "conditions": [{"field": "body", "predicate": "contains", "value": value}],
+                              "actions": []}
+    matcher = RuleMatcher([contains('a\x00b'), contains('b\x00'), contains('ab'), contains('\x00')])
+    now = datetime.now(timezone.utc)
+    bodies = ['a\x00b', 'xab', 'b', 'a', 'b\x00c', '']
+    emails = [Email.create(str(i), 'a@example.com', 'me@example.com', 'Hi', body, now) for i, body in enumerate(bodies)]
+    matrix = matcher.match_batch(emails, now=now)
+    for index, email in enumerate(emails):
+        assert matrix.matching_rules(index) == matcher.match(email)
+    assert matrix[0] == [True, False, False, False, False, False]
+
+def test_needs_body_only_when_header_conditions_leave_rule_undecided():
+    matcher = RuleMatcher([
+        {
+            "name": "Invoices", "predicate": "ALL",
+            "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "billing"},
+                {"field": "body", "predicate": "contains", "value": "invoice"}
+            ],
+            "actions": []
+        },
+        {
+            "name": "Urgent", "predicate": "ANY",
+            "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "urgent"},
+                {"field": "body", "predicate": "contains", "value": "asap"}
+            ],
+            "actions": []
+        },
+    ])
+    assert matcher.referenced_fields == {'sender', 'subject', 'body'}
+
+    def headers_only(sender, subject):
+        return Email.create('1', sender, 'me@example.com', subject, None, datetime.now(timezone.utc))
+
+    assert matcher.needs_body(headers_only('billing@shop.com', 'Urgent: order'))
+    assert matcher.needs_body(headers_only('friend@example.com', 'Hello'))
+    assert not matcher.needs_body(headers_only('friend@example.com', 'URGENT reply'))
+
+def test_action_log_skips_applied_actions_and_replays_failed_ones():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    rules = [{"name": "Spam", "predicate": "ANY",
+              "conditions": [{"field": "subject", "predicate": "contains", "value": "spam"}],
+              "actions": [{"type": "MOVE_TO_SPAM"}, {"type": "MARK_AS_READ"}]}]
+    emails = [Email.create(f'id{i}', 'a@example.com', 'me@example.com', 'spam', '', datetime.now(timezone.utc))
+              for i in range(3)]
+    fake_api = FakeGmailApi([], modify_failures=[403])
+    action_log = AppliedActionRepository(session)
+    processor = RuleProcessor(RuleMatcher(rules), ActionPlanner(GmailService(fake_api)), action_log)
+
+    processor.process_emails(emails)
+    processor.flush()
+    assert fake_api.modifications == []
+    assert action_log.status_counts() == {'failed': 6}
+
+    assert processor.retry_failed() == 6
+    assert action_log.status_counts() == {'applied': 6}
+    assert len(fake_api.modifications) == 1
+
+    renamed = [dict(rules[0], name="Renamed")]
+    processor = RuleProcessor(RuleMatcher(renamed), ActionPlanner(GmailService(fake_api)), action_log)
+    processor.process_emails(emails)
+    assert processor.flush() == 0
+    assert processor.retry_failed() == 0
+    assert len(fake_api.modifications) == 1
+    session.close()
+
+def test_regex_domain_and_list_predicates(tmp_path):
+    allowlist = tmp_path / 'vips.txt'
+    allowlist.write_text("# people who are never filtered\nBoss@Example.com\n\nceo@example.com\n")
+    rules = [
+        {"name": "Regex", "predicate": "ANY", "conditions": [
+            {"field": "subject", "predicate": "matches_regex", "value": r"order #\d{4}"},
+            {"field": "subject", "predicate": "matches_regex", "value": r"^re: re:"},
+            {"field": "subject", "predicate": "matches_regex", "value": r"(\w+) \1"}], "actions": []},
+        {"name": "Blocked", "predicate": "ALL", "conditions": [
+            {"field": "sender", "predicate": "domain_in", "value": ["@Spam.com", ".bad.org"]}], "actions": []},
+        {"name": "VIP", "predicate": "ANY", "conditions": [
+            {"field": "sender", "predicate": "in_list", "value": str(allowlist)}], "actions": []},
+    ]
+    matcher = RuleMatcher(rules)
+    now = datetime.now(timezone.utc)
+    emails = [Email.create(str(i), sender, 'me@example.com', subject, '', now) for i, (sender, subject) in enumerate([
+        ('Deals <offers@news.SPAM.com>', 'Your ORDER #1234 shipped'),
+        ('"The Boss" <boss@example.com>', 'Re: RE: budget'),
+        ('x@notspam.com', 'hello hello'),
+        ('ceo@example.com', 'plain'),
+        ('y@bad.org.example', 'nothing here'),
+    ])]
+    expected = [['Regex', 'Blocked'], ['Regex', 'VIP'], ['Regex'], ['VIP'], []]
+    assert [[rule['name'] for rule in matcher.match(email)] for email in emails] == expected
+    matrix = matcher.match_batch(emails, now=now)
+    for index, email in enumerate(emails):
+        assert matrix.matching_rules(index) == matcher.match(email)
+        assert [rule for rule in rules if matcher.rule_matches(rule, email)] == matcher.match(email)
+
+def test_body_conditions_skip_emails_whose_body_was_not_downloaded():
+    matcher = RuleMatcher([{"name": "No invoices", "predicate": "ALL", "actions": [{"type": "MARK_AS_READ"}],
+                            "conditions": [{"field": "body", "predicate": "does_not_contain", "value": "invoice"}]}])
+    received = datetime.now(timezone.utc)
+    headers_only = Email.create('1', 'a@example.com', 'me@example.com', 'Hi', None, received)
+    empty_body = Email.create('2', 'a@example.com', 'me@example.com', 'Hi', '', received)
+    assert matcher.match(headers_only) == []
+    assert len(matcher.match(empty_body)) == 1
+    assert matcher.match_batch([headers_only, empty_body])[0] == [False, True]
+
+def test_actions_are_logged_with_the_emails_before_they_are_sent():
+    from src.main import process_emails
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    rules = [{"name": "Spam", "predicate": "ANY", "actions": [{"type": "MOVE_TO_SPAM"}],
+              "conditions": [{"field": "subject", "predicate": "contains", "value": "spam"}]}]
+    emails = [Email.create('id0', 'a@example.com', 'me@example.com', 'spam', '', datetime.now(timezone.utc))]
+    fake_api = FakeGmailApi([])
+    action_log = AppliedActionRepository(session)
+    crashing_planner = ActionPlanner(GmailService(fake_api))
+    crashing_planner.flush = MagicMock(side_effect=RuntimeError("killed"))
+    processor = RuleProcessor(RuleMatcher(rules), crashing_planner, action_log)
+
+    # A failure before the actions are logged leaves the email unstored, to be fetched again.
+    failing_matcher = RuleMatcher(rules)
+    failing_matcher.match = MagicMock(side_effect=RuntimeError("killed"))
+    with pytest.raises(RuntimeError):
+        process_emails(emails, EmailRepository(session), RuleProcessor(failing_matcher, crashing_planner, action_log))
+    session.rollback()
+    assert EmailRepository(session).existing_message_ids(['id0']) == set()
+
+    with pytest.raises(RuntimeError):
+        process_emails(emails, EmailRepository(session), processor)
+    session.rollback()
+    assert EmailRepository(session).existing_message_ids(['id0']) == {'id0'}
+    assert action_log.status_counts() == {'pending': 1}
+
+    recovered = RuleProcessor(RuleMatcher(rules), ActionPlanner(GmailService(fake_api)), action_log)
+    assert recovered.retry_failed() == 1
+    assert fake_api.modifications == [{'ids': ['id0'], 'addLabelIds': ['SPAM'], 'removeLabelIds': ['INBOX', 'TRASH']}]
+    session.close()
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.data.models import Base, Email
+from src.data.record import as_record
+from src.data.repository import AppliedActionRepository, EmailRepository, ScheduleRepository
+from src.gmail.gmail_service import GmailService
+from src.rules.action_planner import ActionPlanner
+from src.rules.rule_processor import RuleMatcher, RuleProcessor
+from src.rules.scheduler import RuleScheduler
+from benchmarks.fake_gmail import FakeGmailApi
+
+OLD_SPAM = {"name": "Old spam", "predicate": "ALL",
+            "conditions": [{"field": "sender", "predicate": "contains", "value": "spammer.com"},
+                           {"field": "received_date", "predicate": "greater_than", "value": "7 days"}],
+            "actions": [{"type": "MOVE_TO_TRASH"}]}
+
+def make_email(message_id, sender, age):
+    return Email.create(message_id, sender, 'me@example.com', 'Subject', '', datetime.now(timezone.utc) - age)
+
+def test_date_rules_fire_once_their_threshold_passes():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    email_repo = EmailRepository(session)
+    schedule_repo = ScheduleRepository(session)
+    fake_api = FakeGmailApi([])
+    matcher = RuleMatcher([OLD_SPAM])
+    processor = RuleProcessor(matcher, ActionPlanner(GmailService(fake_api)), AppliedActionRepository(session))
+    scheduler = RuleScheduler(matcher)
+    assert [date_rule.delay for date_rule in scheduler.date_rules] == [7 * 86400]
+
+    email_repo.add_new_emails([
+        make_email('crosses', 'a@spammer.com', timedelta(days=7, hours=12)),
+        make_email('later', 'a@spammer.com', timedelta(days=3)),
+        make_email('friend', 'a@example.com', timedelta(days=7, hours=12)),
+        make_email('ancient', 'a@spammer.com', timedelta(days=20)),
+    ])
+    # A first tick two days ago schedules every matching email; 'ancient' is already due.
+    two_days_ago = datetime.now(timezone.utc) - timedelta(days=2)
+    assert scheduler.tick(email_repo, schedule_repo, processor, now=two_days_ago) == (3, 1)
+    assert fake_api.modifications[0]['ids'] == ['ancient']
+
+    email_repo.add_new_emails([
+        make_email('late', 'b@spammer.com', timedelta(days=8)),
+        make_email('matched_on_arrival', 'b@spammer.com', timedelta(days=30)),
+    ])
+    assert scheduler.tick(email_repo, schedule_repo, processor) == (1, 2)
+    assert fake_api.modifications[1:] == [{'ids': ['crosses', 'late'], 'addLabelIds': ['TRASH'],
+                                           'removeLabelIds': ['INBOX', 'SPAM']}]
+    assert schedule_repo.pending_count() == 1
+
+    # A changed rule drops the old rule's schedule and catches up on every matching email.
+    changed = dict(OLD_SPAM, conditions=OLD_SPAM['conditions'][:1] + [
+        {"field": "received_date", "predicate": "greater_than", "value": "2 days"}])
+    assert RuleScheduler(RuleMatcher([changed])).schedule(email_repo, schedule_repo, datetime.now(timezone.utc)) == 5
+    assert schedule_repo.pending_count() == 5
+    session.close()
+
+def test_due_time_depends_on_rule_shape():
+    record = as_record(make_email('1', 'a@example.com', timedelta(0)))
+
+    def due(predicate, conditions):
+        matcher = RuleMatcher([{"name": "r", "predicate": predicate, "conditions": conditions, "actions": []}])
+        return RuleScheduler(matcher).date_rules[0].due_at(record)
+    older = lambda value: {"field": "received_date", "predicate": "greater_than", "value": value}
+    newer = lambda value: {"field": "received_date", "predicate": "less_than", "value": value}
+    sender = {"field": "sender", "predicate": "contains", "value": "example.com"}
+    assert due('ALL', [older('1 day'), older('3 days')]) == record.received_at + 3 * 86400
+    assert due('ALL', [older('3 days'), newer('2 days')]) is None
+    assert due('ANY', [older('1 day'), older('3 days')]) == record.received_at + 86400
+    assert due('ANY', [older('1 day'), sender]) is None
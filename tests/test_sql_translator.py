@@ -0,0 +1,93 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from src.data.fulltext import create_fulltext_index
+from src.data.models import Base, Email
+from src.data.repository import EmailRepository
+from src.main import archive_matches
+from src.rules.rule_processor import RuleMatcher
+from src.rules.sql_translator import UnsupportedConditionError, condition_to_sql, rule_to_sql
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+@pytest.fixture(params=['off', 'auto'])
+def email_repo(request):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    repo = EmailRepository(session, create_fulltext_index(engine, request.param))
+    repo.bulk_insert([
+        Email.create('1', 'Alerts@Bank.com', 'me@example.com', 'Your 50% discount', 'body', NOW - timedelta(days=10)),
+        Email.create('2', 'friend@example.com', 'me@example.com', 'Lunch?', 'see you', NOW - timedelta(hours=2)),
+        Email.create('3', 'news@spammer.com', 'me@example.com', 'WIN big_prizes', None, NOW - timedelta(days=3)),
+        Email.create('4', 'boss@example.com', 'me@example.com', 'lunch', 'agenda', NOW - timedelta(minutes=5)),
+    ])
+    yield repo
+    session.close()
+
+def matched_ids(email_repo, rule):
+    criterion = rule_to_sql(rule, NOW, email_repo.fulltext)
+    return sorted(row.message_id for rows in email_repo.iter_matching_rows(criterion) for row in rows)
+
+@pytest.mark.parametrize('rule', [
+    {"predicate": "ANY", "conditions": [
+        {"field": "sender", "predicate": "contains", "value": "bank.COM"},
+        {"field": "subject", "predicate": "contains", "value": "big_prizes"}]},
+    {"predicate": "ALL", "conditions": [
+        {"field": "subject", "predicate": "does_not_contain", "value": "50%"},
+        {"field": "received_date", "predicate": "less_than", "value": "1 day"}]},
+    {"predicate": "ALL", "conditions": [
+        {"field": "subject", "predicate": "equals", "value": "LUNCH"}]},
+    {"predicate": "ANY", "conditions": [
+        {"field": "received_date", "predicate": "greater_than", "value": "2 days"},
+        {"field": "sender", "predicate": "does_not_equal", "value": "friend@example.com"}]},
+    {"predicate": "ALL", "conditions": [
+        {"field": "subject", "predicate": "contains", "value": "50_"}]},
+    {"predicate": "ANY", "conditions": [
+        {"field": "body", "predicate": "contains", "value": "AGENDA"},
+        {"field": "subject", "predicate": "contains", "value": "discount"}]},
+    {"predicate": "ALL", "conditions": [
+        {"field": "body", "predicate": "does_not_contain", "value": "agenda"}]},
+])
+def test_rule_to_sql_agrees_with_rule_matcher(email_repo, rule):
+    rule = dict(rule, name="rule", actions=[])
+    matcher = RuleMatcher([rule])
+    rows = [row for batch in email_repo.iter_email_rows() for row in batch]
+    matrix = matcher.match_batch(rows, now=NOW)
+    expected = sorted(row.message_id for index, row in enumerate(rows) if matrix[0][index])
+    assert matched_ids(email_repo, rule) == expected
+
+def test_body_conditions_never_match_bodies_that_were_not_downloaded(email_repo):
+    # Email 3 was stored from a metadata-only fetch.
+    rule = {"name": "rule", "predicate": "ALL", "actions": [],
+            "conditions": [{"field": "body", "predicate": "does_not_contain", "value": "agenda"}]}
+    assert matched_ids(email_repo, rule) == ['1', '2']
+
+def test_condition_to_sql_rejects_unknown_predicate():
+    with pytest.raises(UnsupportedConditionError):
+        condition_to_sql({"field": "subject", "predicate": "starts_with", "value": "x"}, NOW)
+
+def test_fulltext_index_follows_updates_and_deletes(email_repo):
+    if email_repo.fulltext is None:
+        pytest.skip("full-text index disabled")
+
+    def indexed_ids(needle):
+        clause = email_repo.fulltext.match_clause('subject', needle)
+        return sorted(row.message_id for rows in email_repo.iter_matching_rows(clause) for row in rows)
+
+    assert indexed_ids('lunch') == ['2', '4']
+    email_repo.upsert_emails([Email.create('2', 'friend@example.com', 'me@example.com', 'Dinner?', '', NOW)])
+    assert indexed_ids('lunch') == ['4']
+    assert indexed_ids('dinner') == ['2']
+    email_repo.delete_email(email_repo.get_email_by_message_id('4'))
+    email_repo.add_email(Email.create('5', 'a@example.com', 'me@example.com', 'Team LUNCHEON', '', NOW))
+    assert indexed_ids('lunch') == ['5']
+
+def test_archive_matches_falls_back_to_python_for_regex_and_list_rules(email_repo):
+    rule = {"name": "rule", "predicate": "ANY", "actions": [], "conditions": [
+        {"field": "subject", "predicate": "matches_regex", "value": r"^win\b"},
+        {"field": "sender", "predicate": "domain_in", "value": ["bank.com"]}]}
+    matcher = RuleMatcher([rule])
+    matches = [email.message_id for rows in archive_matches(email_repo, matcher, rule, NOW) for email in rows]
+    assert matches == ['1', '3']